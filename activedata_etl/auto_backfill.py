@@ -12,7 +12,7 @@ from __future__ import unicode_literals
 from mo_future import text
 import sys
 
-from activedata_etl.imports.s3_cache import S3Cache
+from activedata_etl.imports.s3_cache import S3Cache, prefix_range
 from mo_dots import Data
 from pyLibrary import aws
 from mo_logs import startup, constants
@@ -20,8 +20,7 @@ from mo_logs import Log
 
 from mo_json import value2json
 from mo_http import http
-from jx_python import jx
-from pyLibrary.sql.sqlite import Sqlite
+from jx_sqlite.sqlite import Sqlite
 from mo_threads import Thread
 from mo_threads import Till
 from mo_times.dates import Date
@@ -31,26 +30,32 @@ from mo_times.timer import Timer
 ACTIVE_DATA = "http://activedata.allizom.org/query"
 RUN_TIME = 10 * 60
 MAX_SIZE = 10000
-QUOTED_INVALID = Sqlite().quote_value(value2json("invalid"))
+INVALID = value2json("invalid")
 
 
 def backfill_recent(cache, settings, index_queue, please_stop):
     db_filename = cache + "." + settings.source.bucket + ".sqlite"
-    db = Sqlite(db_filename)
+    db = Sqlite(filename=db_filename, upgrade=False)
     bucket = S3Cache(db=db, kwargs=settings.source)
     prime_id = settings.rollover.field
     backfill = Data(total=0)
     too_old = (Date.now().floor(Duration(settings.rollover.interval)) - Duration(settings.rollover.max))
 
-    def get_in_s3(prefix):
-        result = db.query(
-            " SELECT " +
-            "    key, annotate" +
-            " FROM files " +
-            " WHERE substr(name, 1, " + text(len(prefix)) + ")=" + db.quote_value(prefix) +
-            " AND (annotate is NULL OR annotate <> " + QUOTED_INVALID + ")" +
-            " AND last_modified > " + db.quote_value(too_old.unix)
+    def where(prefix):
+        """
+        :return: SQL AND PARAMETERS FOR THE VALID, RECENT FILES WITH GIVEN prefix
+        """
+        in_range, params = prefix_range(prefix)
+        return (
+            " WHERE bucket=? AND " + in_range +
+            " AND (annotate is NULL OR annotate <> ?)" +
+            " AND last_modified > ?",
+            (bucket.bucket.name,) + params + (INVALID, too_old.unix)
         )
+
+    def get_in_s3(prefix):
+        sql, params = where(prefix)
+        result = db.query("SELECT key, annotate FROM files" + sql, params)
         return set(d[0] for d in result.data)
 
     def decimate(prefix, please_stop):
@@ -58,16 +63,16 @@ def backfill_recent(cache, settings, index_queue, please_stop):
             return
 
         # HOW MANY WITH GIVEN PREFIX?
+        sql, params = where(prefix)
         result = db.query(
             " SELECT " +
             "    substr(name, 1, " + text(len(prefix) + 1) + ") as prefix," +
             "    count(1) as number, " +
             "    avg(last_modified) as `avg` " +
             " FROM files " +
-            " WHERE substr(name, 1, " + text(len(prefix)) + ")=" + db.quote_value(prefix) +
-            " AND (annotate is NULL OR annotate <> " + QUOTED_INVALID + ")" +
-            " AND last_modified > " + db.quote_value(too_old.unix) +
-            " GROUP BY substr(name, 1, " + text(len(prefix) + 1) + ")"
+            sql +
+            " GROUP BY substr(name, 1, " + text(len(prefix) + 1) + ")",
+            params
         )
 
         # TODO: PULL THE SAME COUNTS FROM ES, BUT GROUPBY ON _id IS BROKEN
@@ -123,11 +128,12 @@ def backfill_recent(cache, settings, index_queue, please_stop):
                 })
         if invalid:
             Log.note("{{num}} invalid keys", num=len(invalid))
-            for g, some in jx.chunk(invalid, size=100):
-                db.execute(
-                    "UPDATE files SET annotate=" + QUOTED_INVALID + " WHERE key in (" +
-                    ",".join(db.quote_value(k) for k in some) +
-                    ")"
+            # key IS NOT INDEXED, SO LIMIT THE UPDATE TO THE prefix RANGE
+            in_range, params = prefix_range(prefix)
+            with db.transaction() as t:
+                t.execute_many(
+                    "UPDATE files SET annotate=? WHERE bucket=? AND " + in_range + " AND key=?",
+                    [(INVALID, bucket.bucket.name) + params + (k,) for k in invalid]
                 )
         backfill.total += len(keys) - len(invalid)
 
@@ -12,7 +12,7 @@ from __future__ import unicode_literals
 import jx_elasticsearch
 from jx_base.expressions import TRUE
 from jx_python import jx
-from mo_dots import coalesce
+from mo_dots import Data, coalesce
 from mo_future import text
 from mo_logs import Log
 from mo_logs import startup, constants
@@ -24,6 +24,9 @@ from pyLibrary import aws
 from pyLibrary.aws import s3
 from pyLibrary.env.git import get_remote_revision
 
+ES_PAGE = 100000  # WIDTH OF THE id RANGE REQUESTED FROM ES AT ONCE
+FULL_CHUNK = b"\xff" * 4096  # IdBitmap.missing() SKIPS THIS MANY COMPLETE BYTES AT ONCE
+
 
 def diff(settings, please_stop=None):
     if settings.elasticsearch and not settings.elasticsearch.id_field:
@@ -46,31 +49,32 @@ def diff(settings, please_stop=None):
         else:
             es_filter = coalesce(settings.es_filter, {"match_all": {}})
 
-        # EVERYTHING FROM ELASTICSEARCH
-        in_es = get_all_in_es(esq, settings.range, es_filter, settings.elasticsearch.id_field)
-        if not in_es:
+        max_in_es = get_max_in_es(esq, settings.range, es_filter, settings.elasticsearch.id_field)
+        if max_in_es is None:
             Log.alert("nothing in es to backfill")
             return
     else:
-        in_es = set()
-
-    in_range = None
-    if settings.range:
-        max_in_es = MAX(in_es)
-        _min = coalesce(settings.range.min, 0)
-        _max = coalesce(
-            settings.range.max,
-            coalesce(settings.limit, 0) + max_in_es + 1,
-            _min + coalesce(settings.limit, 1000000)
-        )
-        in_range = set(range(_min, _max))
-        in_es &= in_range
-
-        if not in_range - in_es:
-            Log.note("Nothing to do")
-            return
+        max_in_es = None
+
+    _min = coalesce(settings.range.min, 0)
+    _max = coalesce(
+        settings.range.max,
+        None if max_in_es is None else coalesce(settings.limit, 0) + max_in_es + 1,
+        _min + coalesce(settings.limit, 1000000)
+    )
+    in_range = Data(min=_min, max=_max)
+
+    if settings.elasticsearch:
+        # EVERYTHING FROM ELASTICSEARCH
+        in_es = get_all_in_es(esq, in_range, es_filter, settings.elasticsearch.id_field)
+    else:
+        in_es = IdBitmap(_min, _max)
+
+    if next(in_es.missing(), None) is None:
+        Log.note("Nothing to do")
+        return
 
-    remaining_in_s3 = get_all_s3(in_es, in_range, settings)
+    remaining_in_s3 = get_all_s3(in_es, settings)
 
     if not remaining_in_s3:
         Log.note("Nothing to insert into ES")
@@ -100,29 +104,41 @@ def diff(settings, please_stop=None):
             ])
 
 
-def get_all_in_es(esq, in_range, es_filter, field):
-    if es_filter == None:
-        es_filter = TRUE
-
-    range_filter = []
-    if in_range:
-        if in_range.min:
-            range_filter.append({"gte": {field: in_range.min}})
-        if in_range.max:
-            range_filter.append({"lt": {field: in_range.max}})
-
+def get_max_in_es(esq, in_range, es_filter, field):
+    """
+    :return: LARGEST id IN ES, WITHIN in_range, OR None
+    """
     result = esq.query({
         "from": esq.es.settings.alias,
-        "edges": {"name": "value", "value": field},
-        "where": {"and": [es_filter] + range_filter},
-        "limit": 100000,
+        "select": {"name": "value", "value": field},
+        "where": {"and": [coalesce(es_filter, TRUE)] + _range_filter(in_range, field)},
+        "sort": {field: "desc"},
+        "limit": 1,
         "format": "list"
     })
-
-    in_es = set()
-    for rec in result.data:
+    for value in result.data:
         with suppress_exception:
-            in_es.add(int(rec.value))
+            return int(value)
+    return None
+
+
+def get_all_in_es(esq, in_range, es_filter, field):
+    """
+    :return: IdBitmap OF THE ids IN ES, FROM in_range.min UP TO (NOT INCLUDING) in_range.max
+    """
+    in_es = IdBitmap(in_range.min, in_range.max)
+
+    # ONE id WINDOW AT A TIME, SO NO RESPONSE IS BIGGER THAN ES_PAGE
+    for start in range(in_range.min, in_range.max, ES_PAGE):
+        window = Data(min=start, max=min(start + ES_PAGE, in_range.max))
+        result = esq.query({
+            "from": esq.es.settings.alias,
+            "edges": {"name": "value", "value": field},
+            "where": {"and": [coalesce(es_filter, TRUE)] + _range_filter(window, field)},
+            "limit": ES_PAGE,
+            "format": "list"
+        })
+        in_es.extend(_ints(rec.value for rec in result.data))
 
     Log.note(
         "got {{num}} from {{index}}",
@@ -133,52 +149,180 @@ def get_all_in_es(esq, in_range, es_filter, field):
     return in_es
 
 
-def get_all_s3(in_es, in_range, settings):
+def _ints(values):
+    for v in values:
+        with suppress_exception:
+            yield int(v)
+
+
+def _range_filter(in_range, field):
+    range_filter = []
+    if in_range:
+        if in_range.min:
+            range_filter.append({"gte": {field: in_range.min}})
+        if in_range.max:
+            range_filter.append({"lt": {field: in_range.max}})
+    return range_filter
+
+
+class IdBitmap(object):
+    """
+    SET OF INTEGER ids FROM min UP TO (NOT INCLUDING) max, ONE BIT PER id
+
+    10 MILLION ids TAKE 1.25MB, AND THE GAPS ARE FOUND WITHOUT VISITING EVERY id
+    """
+
+    def __init__(self, min, max):
+        self.min = min
+        self.max = max
+        self.bits = bytearray((max - min + 7) // 8)
+        self.count = 0
+
+    def add(self, id):
+        if not self.min <= id < self.max:
+            return
+        i = id - self.min
+        mask = 1 << (i & 7)
+        byte = self.bits[i >> 3]
+        if not byte & mask:
+            self.bits[i >> 3] = byte | mask
+            self.count += 1
+
+    def extend(self, ids):
+        bits, lo, hi = self.bits, self.min, self.max
+        count = 0
+        for id in ids:
+            if not lo <= id < hi:
+                continue
+            i = id - lo
+            mask = 1 << (i & 7)
+            byte = bits[i >> 3]
+            if not byte & mask:
+                bits[i >> 3] = byte | mask
+                count += 1
+        self.count += count
+
+    def __contains__(self, id):
+        if not self.min <= id < self.max:
+            return False
+        i = id - self.min
+        return bool(self.bits[i >> 3] & (1 << (i & 7)))
+
+    def __len__(self):
+        return self.count
+
+    def last(self):
+        """
+        :return: LARGEST id IN THE SET, OR None
+        """
+        size = len(self.bits.rstrip(b"\x00"))
+        if not size:
+            return None
+        byte = self.bits[size - 1]
+        return self.min + (size - 1) * 8 + byte.bit_length() - 1
+
+    def missing(self):
+        """
+        :return: GENERATOR OF (start, end) RANGES OF ids NOT IN THE SET, LARGEST
+                 FIRST; end IS NOT INCLUDED
+        """
+        bits = self.bits
+        end = None  # END OF THE CURRENT RUN OF MISSING ids
+        chunk_size = len(FULL_CHUNK)
+        for c in reversed(range(0, len(bits), chunk_size)):
+            chunk = bits[c:c + chunk_size]
+            if chunk == FULL_CHUNK:
+                if end is not None:
+                    yield self.min + (c + chunk_size) * 8, end
+                    end = None
+                continue
+            for b in reversed(range(len(chunk))):
+                base = self.min + (c + b) * 8
+                byte = chunk[b]
+                if byte == 0xFF:
+                    if end is not None:
+                        yield base + 8, end
+                        end = None
+                    continue
+                if byte == 0 and base + 8 <= self.max:
+                    if end is None:
+                        end = base + 8
+                    continue
+                for bit in range(7, -1, -1):
+                    id = base + bit
+                    if id >= self.max:
+                        continue
+                    if byte & (1 << bit):
+                        if end is not None:
+                            yield id + 1, end
+                            end = None
+                    elif end is None:
+                        end = id + 1
+        if end is not None:
+            yield self.min, end
+
+
+def get_all_s3(in_es, settings):
+    """
+    :param in_es: IdBitmap OF THE ids ALREADY IN ES; ITS min AND max ARE THE RANGE TO FILL
+    :return: UP TO settings.limit ids IN S3, BUT NOT IN ES, LARGEST FIRST
+    """
     in_s3 = []
-    min_range = coalesce(MIN(in_range), 0)
+    min_range = in_es.min
     bucket = s3.Bucket(settings.source)
     limit = coalesce(settings.limit, 1000)
-    max_allowed = MAX([settings.range.max, MAX(in_es)])
+    max_allowed = MAX([settings.range.max, in_es.last()])
     extra_digits = ceiling(log10(MIN([max_allowed-settings.range.min, limit])))
     source_prefix = coalesce(settings.source.prefix, "")
+    shards = []  # PREFIXES, IN THE ORDER THEY ARE LISTED
+
+    def all_shards():
+        # EACH PREFIX IS A SHARD, FROM THE LARGEST DOWN
+        _, end = next(in_es.missing())
+        prefix = text(end - 1)[:-extra_digits]
+        prefix_max = int(prefix + ("999999999999"[:extra_digits]))
+        while prefix != "0" and min_range <= prefix_max:
+            shards.append(source_prefix + prefix)
+            yield {"prefix": source_prefix + prefix, "delimiter": ":"}
+            if prefix == "":
+                break
+            prefix = text(int(prefix) - 1)
+            prefix_max = int(prefix + ("999999999999"[:extra_digits]))
+
+    # EVERYTHING FROM S3
+    with Timer("Scanning S3 bucket {{bucket}} with prefix {{prefix|quote}}", {"bucket": bucket.name, "prefix": source_prefix}):
+        listing = s3.list_shards(bucket.bucket, all_shards())
+        try:
+            current = 0
+            prefixes = set()  # ids THAT ARE NOT NUMBERS
+            seen = IdBitmap(in_es.min, in_es.max)
+            for p in listing:
+                if not p.name.startswith(shards[current]):
+                    # THE PREVIOUS SHARD IS DONE, DO WE NEED MORE?
+                    if len(in_s3) >= limit:
+                        break
+                    while not p.name.startswith(shards[current]):
+                        current += 1
 
-    prefix = text(max(in_range - in_es))[:-extra_digits]
-    prefix_max = int(prefix + ("999999999999"[:extra_digits]))
-    while prefix != "0" and len(in_s3) < limit and min_range <= prefix_max:
-        # EVERYTHING FROM S3
-        with Timer(
-            "Scanning S3 bucket {{bucket}} with prefix {{prefix|quote}}",
-            {"bucket": bucket.name, "prefix": source_prefix+prefix}
-        ):
-            prefixes = set()
-            for p in bucket.list(prefix=source_prefix+prefix, delimiter=":"):
                 if p.name.startswith("bb.") or p.name.startswith("tc."):
                     pp = p.name.split(":")[0].split(".")[1]
                 else:
                     pp = p.name.split(":")[0].split(".")[0]
-                prefixes.add(pp)
-            prefixes = list(prefixes)
-
-        for i, q in enumerate(prefixes):
-            if i % 1000 == 0:
-                Log.note("Scrubbed {{p|percent(decimal=1)}}", p=i / len(prefixes))
-            try:
-                p = int(q)
-                if in_range and p not in in_range:
+                try:
+                    q = int(pp)
+                except Exception as e:
+                    if pp not in prefixes:
+                        prefixes.add(pp)
+                        Log.note("delete key? {{key|quote}}", key=pp)
                     continue
-                if p in in_es:
+                if not in_es.min <= q < in_es.max:
                     continue
-                # if p >= max_allowed:
-                #     continue
-
-                in_s3.append(p)
-            except Exception as e:
-                Log.note("delete key? {{key|quote}}", key=q)
-
-        if prefix == "":
-            break
-        prefix = text(int(prefix) - 1)
-        prefix_max = int(prefix + ("999999999999"[:extra_digits]))
+                if q in in_es or q in seen:
+                    continue
+                seen.add(q)
+                in_s3.append(q)
+        finally:
+            listing.close()
 
     in_s3 = jx.reverse(jx.sort(in_s3))[:limit:]
     return in_s3
@@ -23,31 +23,98 @@ from jx_python import jx
 from mo_dots import coalesce, listwrap, Data, Null, wrap, is_data
 from mo_future import text
 from mo_hg.hg_mozilla_org import HgMozillaOrg
+from mo_json import value2json, json2value
 from mo_kwargs import override
-from mo_logs import Log, startup, constants, strings
+from mo_logs import Log, startup, constants, strings, STDOUT
 from mo_logs.exceptions import suppress_exception, Except
 from mo_math import MIN
 from mo_testing import fuzzytestcase
-from mo_threads import Thread, Signal, Queue, Lock, Till, MAIN_THREAD
-from mo_times import Timer, Date, SECOND
+from mo_threads import Thread, Signal, Queue, Lock, Till, MAIN_THREAD, Process, THREAD_STOP
+from mo_times import Timer, Date, SECOND, MINUTE
 from pyLibrary import aws
 from pyLibrary.aws.s3 import strip_extension, key_prefix, KEY_IS_WRONG_FORMAT
 from pyLibrary.meta import MemorySample
 from tuid.client import TuidClient
 
 EXTRA_WAIT_TIME = 20 * SECOND  # WAIT TIME TO SEND TO AWS, IF WE wait_forever
+STATS_PREFIX = "ETL_STATS "  # MARKS THE stdout LINES A WORKER PROCESS USES TO REPORT stats
+STATS_INTERVAL = 60 * SECOND
+RESTART_DELAY = 10 * SECOND  # WAIT BEFORE RESTARTING A DEAD WORKER PROCESS
+SHUTDOWN_WAIT = 5 * MINUTE  # TIME GIVEN TO A WORKER PROCESS TO FINISH ITS WORK ITEM
+MAX_CONCURRENT_FETCH = 8  # NUMBER OF KEYS A MULTI-KEY WORK ITEM DOWNLOADS AT ONCE
+
+stats_locker = Lock()
+stats = Data(done=0, retried=0, rejected=0)  # NUMBER OF WORK ITEMS HANDLED BY THIS PROCESS
 
 
 class ConcatSources(object):
     """
     MAKE MANY SOURCES LOOK LIKE ONE
+
+    SOURCES ARE DOWNLOADED BY A POOL OF num_threads THREADS, NEVER MORE THAN
+    num_threads AHEAD OF THE CONSUMER, AND DELIVERED IN THE ORIGINAL ORDER
     """
 
-    def __init__(self, sources):
+    def __init__(self, sources, num_threads=MAX_CONCURRENT_FETCH):
         self.sources = sources
+        self.num_threads = num_threads
 
     def read(self):
-        return "\n".join(s.read() for s in self.sources)
+        return "\n".join(self._prefetch(lambda s: s.read()))
+
+    def read_lines(self):
+        for lines in self._prefetch(lambda s: list(s.read_lines())):
+            for line in lines:
+                yield line
+
+    def _prefetch(self, get):
+        """
+        :param get: FUNCTION THAT DOWNLOADS ONE SOURCE
+        :return: GENERATOR OF get(source), IN THE ORDER OF self.sources
+        """
+        num = len(self.sources)
+        window = max(1, self.num_threads)
+        results = [None] * num
+        errors = [None] * num
+        fetched = [Signal() for _ in range(num)]
+        consumed = [Signal() for _ in range(num)]
+        locker = Lock()
+        todo = iter(range(num))
+
+        def fetch(please_stop):
+            while not please_stop:
+                with locker:
+                    i = next(todo, None)
+                if i is None:
+                    return
+                if i >= window:
+                    # DO NOT GET TOO FAR AHEAD OF THE CONSUMER
+                    (consumed[i - window] | please_stop).wait()
+                    if please_stop:
+                        return
+                try:
+                    results[i] = get(self.sources[i])
+                except Exception as e:
+                    errors[i] = Except.wrap(e)
+                fetched[i].go()
+
+        threads = [
+            Thread.run("fetch source " + text(t), fetch)
+            for t in range(min(window, num))
+        ]
+        try:
+            for i in range(num):
+                fetched[i].wait()
+                if errors[i]:
+                    Log.error("Can not read {{key}}", key=self.sources[i].key, cause=errors[i])
+                result, results[i] = results[i], None
+                consumed[i].go()
+                yield result
+        finally:
+            for t in threads:
+                t.please_stop.go()
+            for t in threads:
+                t.join()
 
 
 class ETL(Thread):
@@ -314,6 +381,8 @@ class ETL(Thread):
                         is_ok = self._dispatch_work(todo)
                         if is_ok:
                             self.work_queue.commit()
+                            with stats_locker:
+                                stats.done += 1
                         else:
                             self.work_queue.rollback()
                     except Exception as e:
@@ -326,6 +395,12 @@ class ETL(Thread):
                         previous_attempts = coalesce(todo.previous_attempts, 0)
                         todo.previous_attempts = previous_attempts + 1
 
+                        with stats_locker:
+                            if previous_attempts > 10:
+                                stats.rejected += 1
+                            else:
+                                stats.retried += 1
+
                         if previous_attempts < coalesce(self.settings.min_attempts, 3):
                             # SILENT
                             try:
@@ -365,6 +440,104 @@ class ETL(Thread):
             raise e
 
 
+class Supervisor(object):
+    """
+    RUN MANY ETL WORKER PROCESSES, RESTART THE ONES THAT DIE, AND COMBINE THEIR stats
+    EACH WORKER IS THIS SAME PROGRAM, WITH THE SAME ARGUMENTS, PLUS --worker
+    """
+
+    def __init__(self, num_processes, please_stop):
+        self.please_stop = please_stop
+        self.locker = Lock()
+        self.restarts = 0
+        self.retired = Data(done=0, retried=0, rejected=0)  # stats FROM PROCESSES THAT HAVE STOPPED
+        self.current = [Data() for _ in range(num_processes)]  # LAST stats REPORTED BY EACH PROCESS
+        self.threads = [
+            Thread.run("supervise ETL process " + text(i), self._supervise, i, please_stop=please_stop)
+            for i in range(num_processes)
+        ]
+        Thread.run("combine ETL stats", self._report, please_stop=please_stop)
+
+    def _supervise(self, num, please_stop):
+        command = [sys.executable] + sys.argv + ["--worker=" + text(num)]
+        while not please_stop:
+            process = Process("ETL process " + text(num), command, debug=False)
+            Thread.run("forward stderr of ETL process " + text(num), _forward, num, process.stderr, please_stop=process.service_stopped)
+            while True:
+                line = process.stdout.pop(till=please_stop)
+                if please_stop or line is THREAD_STOP:
+                    break
+                elif line and line.startswith(STATS_PREFIX):
+                    with suppress_exception:
+                        with self.locker:
+                            self.current[num] = json2value(line[len(STATS_PREFIX):])
+                elif line:
+                    Log.note("[worker {{num}}] {{line}}", num=num, line=line)
+
+            if please_stop:
+                # ASK NICELY, THEN KILL
+                process.stdin.add("exit")
+                (Till(seconds=SHUTDOWN_WAIT.seconds) | process.service_stopped).wait()
+                process.stop()
+                process.join()
+                break
+
+            process.join()
+            with self.locker:
+                last, self.current[num] = self.current[num], Data()
+                for k in self.retired.keys():
+                    self.retired[k] += coalesce(last[k], 0)
+                self.restarts += 1
+            Log.warning(
+                "ETL process {{num}} stopped (returncode={{code}}), restarting",
+                num=num,
+                code=process.returncode
+            )
+            (Till(seconds=RESTART_DELAY.seconds) | please_stop).wait()
+
+    def _report(self, please_stop):
+        previous = Data(done=0, retried=0, rejected=0)
+        while not please_stop:
+            (Till(seconds=STATS_INTERVAL.seconds) | please_stop).wait()
+            with self.locker:
+                total = wrap({
+                    k: v + sum(coalesce(c[k], 0) for c in self.current)
+                    for k, v in self.retired.items()
+                })
+                restarts = self.restarts
+            Log.note(
+                "ETL processes done {{total.done}} (+{{rate}}), retried {{total.retried}}, rejected {{total.rejected}}, restarts {{restarts}}",
+                total=total,
+                rate=total.done - previous.done,
+                restarts=restarts
+            )
+            previous = total
+
+
+def _forward(num, queue, please_stop):
+    """
+    SEND THE LINES FROM A WORKER'S queue TO THIS PROCESS' LOG
+    """
+    while not please_stop:
+        line = queue.pop(till=please_stop)
+        if line is THREAD_STOP:
+            break
+        elif line:
+            Log.note("[worker {{num}}] {{line}}", num=num, line=line)
+
+
+def report_stats(please_stop):
+    """
+    USED BY A WORKER PROCESS TO SEND ITS stats TO THE Supervisor
+    """
+    while not please_stop:
+        (Till(seconds=STATS_INTERVAL.seconds) | please_stop).wait()
+        with stats_locker:
+            line = STATS_PREFIX + value2json(stats) + "\n"
+        STDOUT.write(line.encode("utf8"))
+        STDOUT.flush()
+
+
 sinks_locker = Lock()
 sinks = []  # LIST OF (settings, sink) PAIRS
 
@@ -393,7 +566,8 @@ def get_container(settings):
                     return e[1]
 
             es = elasticsearch.Cluster(kwargs=settings).get_or_create_index(kwargs=settings)
-            output = es.threaded_queue(max_size=2000, batch_size=1000)
+            # batch_size IS ONLY A CAP, THE INDEX ADAPTS THE BYTES PER BULK
+            output = es.threaded_queue(max_size=coalesce(settings.queue_size, 2000), batch_size=coalesce(settings.batch_size, 1000))
             setattr(output, "keys", lambda prefix: set())
 
             sinks.append((settings, output))
@@ -431,6 +605,13 @@ def main():
                 "type": str,
                 "dest": "id",
                 "required": False
+            },
+            {
+                "name": ["--worker"],
+                "help": "(used by the supervisor) number of this worker process",
+                "type": int,
+                "dest": "worker",
+                "required": False
             }
         ])
         constants.set(settings.constants)
@@ -440,13 +621,24 @@ def main():
             etl_one(settings)
             return
 
+        stopper = Signal()
+        num_processes = coalesce(settings.param.processes, 1)
+        if num_processes > 1 and settings.args.worker == None:
+            # EACH PROCESS OWNS ITS OWN QUEUE, hg AND tuid CLIENTS
+            Supervisor(num_processes, please_stop=stopper)
+            aws.capture_termination_signal(stopper)
+            MAIN_THREAD.wait_for_shutdown_signal(stopper, allow_exit=True)
+            return
+
         resources = Data(
             hg=HgMozillaOrg(use_cache=True, kwargs=settings.hg),
             local_es_node=settings.local_es_node,
             tuid_mapper=TuidClient(settings.tuid_client)
         )
 
-        stopper = Signal()
+        if settings.args.worker != None:
+            Thread.run("report ETL stats", report_stats, please_stop=stopper)
+
         for i in range(coalesce(settings.param.threads, 1)):
             ETL(
                 name="ETL Loop " + text(i),
@@ -15,6 +15,7 @@ from __future__ import unicode_literals
 
 import json
 import sys
+from array import array
 
 from activedata_etl.imports.coverage_util import LANGUAGE_MAPPINGS
 from mo_dots import wrap, Null
@@ -26,6 +27,7 @@ EMIT_RECORDS_WITH_ZERO_COVERAGE = True
 LINE_LIMIT = 10000
 
 COMMANDS = ('TN:', 'SF:', 'FNF:', 'FNH:', 'LF:', 'LH:', 'LN:', 'DA:', 'FN:', 'FNDA:', 'BRDA:', 'BRF:', 'BRH:', 'end_of_record')
+IGNORED = {'TN', 'FNF', 'FNH', 'LF', 'LH', 'LN', 'BRDA', 'BRF', 'BRH'}  # RECORDS THAT DO NOT CHANGE THE OUTPUT
 
 
 def parse_lcov_coverage(source_key, source_name, stream):
@@ -33,24 +35,42 @@ def parse_lcov_coverage(source_key, source_name, stream):
     Parses lcov coverage from a stream
     http://ltp.sourceforge.net/coverage/lcov/geninfo.1.php
 
+    ONE PASS, ONE FILE AT A TIME: LINE NUMBERS ARE COLLECTED IN arrays, AND
+    ONLY BECOME SORTED LISTS WHEN THE FILE'S RECORD IS EMITTED
+
     :param source_key:
     :param source_name:
-    :param stream:
-    :return:
+    :param stream: LINES OF lcov OUTPUT
+    :return: GENERATOR OF COVERAGE RECORDS, ONE PER SOURCE FILE
     """
 
     current_source = None
+    source_file = None
     done = set()
 
     for line in stream:
         try:
-            if len(line) == 0:
+            if not line:
+                continue
+            elif line.startswith('DA:'):
+                # DA:<line number>,<execution count>[,<checksum>] IS MOST OF THE FILE
+                comma = line.find(',', 3)
+                if comma == -1:
+                    line_number, execution_count = int(line[3:].strip() or 0), 0
+                else:
+                    end = line.find(',', comma + 1)
+                    count = (line[comma + 1:] if end == -1 else line[comma + 1:end]).strip()
+                    line_number, execution_count = int(line[3:comma] or 0), int(count) if count else 0
+                if execution_count > 0:
+                    current_source['lines_covered'].append(line_number)
+                else:
+                    current_source['lines_uncovered'].append(line_number)
                 continue
             elif not line.startswith(COMMANDS):
                 source_file += "\n" + line
                 continue
 
-            line = line.strip()
+            line = line.rstrip()
 
             if line == 'end_of_record':
                 for source in coco_format(current_source):
@@ -65,73 +85,54 @@ def parse_lcov_coverage(source_key, source_name, stream):
                     elif source.file.total_covered:
                         yield source
                 current_source = None
-            elif ':' in line:
-                cmd, data = line.split(":", 1)
-
-                if cmd == 'TN':
-                    test_name = data.strip()
-                elif cmd == 'SF':
-                    source_file = data
-                    if source_file in done:
-                        Log.error("Note expected to revisit a file")
-                    current_source = {
-                        'file': source_file,
-                        'functions': {},
-                        'lines_covered': set(),
-                        'lines_uncovered': set()
-                    }
-                elif cmd == 'FNF':
-                    functions_found = int(data)
-                elif cmd == 'FNH':
-                    functions_hit = int(data)
-                elif cmd == 'LF':
-                    lines_found = int(data)
-                elif cmd == 'LH':
-                    lines_hit = int(data)
-                elif cmd == 'DA':
-                    line_number, execution_count = n_tuple(map(lambda v: int(v) if v else 0, data.split(",")), 2)
-                    if execution_count > 0:
-                        current_source['lines_covered'].add(line_number)
-                    else:
-                        current_source['lines_uncovered'].add(line_number)
-                elif cmd == 'FN':
-                    min_line, function_name = data.split(",", 1)
-
-                    current_source['functions'][function_name] = {
-                        'start': int(min_line),
-                        'execution_count': 0
-                    }
-                elif cmd == 'FNDA':
+                continue
+
+            colon = line.find(':')
+            if colon == -1:
+                Log.error("unknown line {{line}} in {{source}}", line=line, source=source_name)
+            cmd, data = line[:colon], line[colon + 1:]
+
+            if cmd in IGNORED:
+                continue
+            elif cmd == 'SF':
+                source_file = data
+                if source_file in done:
+                    Log.error("Note expected to revisit a file")
+                current_source = {
+                    'file': source_file,
+                    'functions': {},
+                    'lines_covered': array(str('i')),
+                    'lines_uncovered': array(str('i'))
+                }
+            elif cmd == 'FN':
+                min_line, function_name = data.split(",", 1)
+
+                current_source['functions'][function_name] = {
+                    'start': int(min_line),
+                    'execution_count': 0
+                }
+            elif cmd == 'FNDA':
+                try:
+                    fn_execution_count, function_name = data.split(",", 1)
                     try:
-                        fn_execution_count, function_name = data.split(",", 1)
-                        try:
-                            current_source['functions'][function_name]['execution_count'] = int(fn_execution_count)
-                        except Exception as e:
-                            if fn_execution_count != "0":
-                                if DEBUG:
-                                    Log.note("No mention of FN:{{func}}, but it has been called", func=function_name, cause=e)
+                        current_source['functions'][function_name]['execution_count'] = int(fn_execution_count)
                     except Exception as e:
-                        Log.warning("problem with FNDA line {{line|quote}}", line=line, cause=e)
-                elif cmd == 'BRDA':
-                    # BRDA:<line number>,<block number>,<branch number>,<taken>
-                    # <taken> is a number or a dash ("-") or does not exist
-                    line, block, branch, taken = n_tuple(data.split(","), 4)
-                    pass
-                elif cmd == 'BRF':
-                    num_branches_found = data
-                elif cmd == 'BRH':
-                    num_branches_hit = data
-                else:
-                    Log.error('Unsupported cmd {{cmd}} with data {{data}} in {{source|quote}} for key {{key}}', key=source_key, source=source_name, cmd=cmd, data=data)
+                        if fn_execution_count != "0":
+                            if DEBUG:
+                                Log.note("No mention of FN:{{func}}, but it has been called", func=function_name, cause=e)
+                except Exception as e:
+                    Log.warning("problem with FNDA line {{line|quote}}", line=line, cause=e)
             else:
-                Log.error("unknown line {{line}} in {{source}}", line=line, source=source_name)
+                Log.error('Unsupported cmd {{cmd}} with data {{data}} in {{source|quote}} for key {{key}}', key=source_key, source=source_name, cmd=cmd, data=data)
         except Exception as e:
             Log.error("Problem in line {{line}} in {{source}}", line=line, source=source_name, cause=e)
 
 
 def coco_format(details):
     # TODO: DO NOT IGNORE METHODS
-    coverable_line_count = len(details['lines_covered']) + len(details['lines_uncovered'])
+    covered = _sorted_lines(details['lines_covered'])
+    uncovered = _sorted_lines(details['lines_uncovered'])
+    coverable_line_count = len(covered) + len(uncovered)
     language = [lang for lang, extensions in LANGUAGE_MAPPINGS if details['file'].endswith(extensions)]
 
     source = wrap({
@@ -139,17 +140,25 @@ def coco_format(details):
         "is_file": True,
         "file": {
             "name": details['file'],
-            'covered': sorted(details["lines_covered"]),
-            'uncovered': sorted(details['lines_uncovered']),
-            "total_covered": len(details['lines_covered']),
-            "total_uncovered": len(details['lines_uncovered']),
-            "percentage_covered": len(details['lines_covered']) / coverable_line_count if coverable_line_count else None
+            'covered': covered,
+            'uncovered': uncovered,
+            "total_covered": len(covered),
+            "total_uncovered": len(uncovered),
+            "percentage_covered": len(covered) / coverable_line_count if coverable_line_count else None
         }
     })
 
     return [source]
 
 
+def _sorted_lines(lines):
+    """
+    :param lines: array OF LINE NUMBERS, USUALLY ASCENDING, MAYBE WITH REPEATS
+    :return: SORTED LIST OF DISTINCT LINE NUMBERS
+    """
+    return sorted(set(lines))
+
+
 def n_tuple(values, length):
     """
     RETURN A LIST OF length
@@ -165,7 +174,7 @@ def n_tuple(values, length):
 def js_coverage_format(sources):
     results = []
     for key, value in sources.iteritems():
-        lines_covered = sorted(value['lines_covered'])
+        lines_covered = _sorted_lines(value['lines_covered'])
 
         lines_covered_set = set(lines_covered)
 
@@ -173,7 +182,7 @@ def js_coverage_format(sources):
             'sourceFile': value['file'],
             'testUrl': value['file'],
             'covered': lines_covered,
-            'uncovered': sorted(value['lines_uncovered']),
+            'uncovered': _sorted_lines(value['lines_uncovered']),
             'methods': {}
         }
 
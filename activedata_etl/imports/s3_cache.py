@@ -9,18 +9,21 @@
 from __future__ import division
 from __future__ import unicode_literals
 
-from mo_future import text
+from mo_future import text, unichr
 from mo_kwargs import override
 
-from mo_dots import listwrap
+from jx_sqlite.sqlite import quote_column
+from mo_dots import Data, listwrap
 from mo_logs import Log
 from mo_threads import Signal
 from mo_threads import Thread
 from mo_times.dates import Date
 from pyLibrary import aws
+from pyLibrary.aws.s3 import digit_shards, list_shards
 from jx_python import jx
 
 DEBUG = True
+FILES_COLUMNS = ("bucket", "key", "name", "last_modified", "size", "prefix", "primary_id")
 
 
 class S3Cache(object):
@@ -29,39 +32,18 @@ class S3Cache(object):
     def __init__(self, db, bucket, key_format, kwargs):
         self.bucket = aws.s3.Bucket(kwargs)
         self.db = db
-        details = self.db.query("PRAGMA table_info(files)")
-        if not details.data:
-            self.db.execute("""
-                CREATE TABLE files (
-                   bucket TEXT,
-                   key TEXT,
-                   name TEXT,
-                   last_modified REAL,
-                   size INTEGER,
-                   annotate TEXT, 
-                   CONSTRAINT pk PRIMARY KEY (bucket, name)
-                )            
-            """)
+        setup_files(db)
         self.settings = kwargs
         self.up_to_date = Signal()
         if key_format.startswith("t."):
-            suffix = db.quote_value(key_format[3])
-            selector = "cast(substr(name, 4, instr(substr(name, 4), " + suffix + ") - 1) as decimal)"
-            prefixes = [
-                {"prefix": "tc", "selector": selector},
-                {"prefix": "bb", "selector": selector}
-            ]
+            prefixes = ["tc", "bb"]
         else:
-            suffix = db.quote_value(key_format[1])
-            selector = "cast(substr(name, 1, instr(name, " + suffix + ") - 1) as decimal)"
-            prefixes = [
-                {"prefix": "", "selector": selector}
-            ]
+            prefixes = [""]
 
         result = db.query("SELECT sum(size) FROM files")
         Log.note("{{source}} has {{num|comma}} bytes of data", source=bucket, num=result.data[0][0])
 
-        threads = [self._top_up(**p) for p in prefixes]
+        threads = [self._top_up(p) for p in prefixes]
         for t in threads:
             t.join()
 
@@ -70,17 +52,15 @@ class S3Cache(object):
 
         self.up_to_date.go()
 
-
-    def _top_up(self, prefix, selector):
+    def _top_up(self, prefix):
         def update(prefix, bucket, please_stop):
+            # THE (bucket, prefix, primary_id) INDEX ANSWERS max() WITHOUT A SCAN
+            result = self.db.query(
+                "SELECT max(primary_id) AS " + quote_column("max") + " FROM files WHERE bucket=? AND prefix=?",
+                (bucket.name, prefix)
+            )
+            maximum = result.data[0][0]
             if prefix:
-                result = self.db.query(
-                    " SELECT max(" + selector + ") as " + self.db.quote_column("max") +
-                    " FROM files " +
-                    " WHERE bucket=" + self.db.quote_value(bucket.name) +
-                    " AND substr(name, 1, " + text(len(prefix)) + ")=" + self.db.quote_value(prefix)
-                )
-                maximum = result.data[0][0]
                 for mp in listwrap(self.settings.min_primary):
                     if mp.startswith(prefix):
                         mini = int(mp.split(".")[1].split(":")[0])
@@ -92,85 +72,171 @@ class S3Cache(object):
                 else:
                     biggest = prefix + "."
             else:
-                result = self.db.query(
-                    " SELECT max(" + selector + ") as " + self.db.quote_column("max") +
-                    " FROM files " +
-                    " WHERE bucket=" + self.db.quote_value(bucket.name)
-                )
-                maximum = result.data[0][0]
                 if maximum:
                     biggest = text(maximum)
                 else:
                     biggest = None
-            bad_count = 0
-            for g, metas in jx.chunk(bucket.bucket.list(prefix=prefix, marker=biggest), size=100):
-                if please_stop:
-                    Log.error("Request to stop encountered")
-                if bad_count > 100:
-                    # Log.note("Bad count is {{count}}", count=bad_count)
-                    Log.note("Exit because 1000 records show nothing older")
-                    return
-                data = []
-                delete_me = []
-                for meta in metas:
-                    primary = int(meta.key[len(prefix):].lstrip(".").split(".")[0].split(":")[0])
-                    if bucket.name == "active-data-jobs" and primary > 2000:
-                        delete_me.append(meta.key)
-                        continue
-
-                    if primary < maximum:
-                        continue
-
-                    data.append((
-                        bucket.name,
-                        meta.key.split(".json")[0],
-                        meta.key,
-                        Date(meta.last_modified).unix,
-                        meta.size
-                    ))
-
-                if delete_me:
-                    Log.note("delete keys {{key}}", key=delete_me)
-                    bucket.bucket.delete_keys(delete_me)
-                    bad_count = 0
-
-                if data:
-                    bad_count = 0
-                    if DEBUG:
-                        Log.note("add {{num}} keys to cache for prefix {{prefix|quote}} ({{biggest}})", num=len(data), prefix=prefix, biggest=sorted(d[1] for d in data)[-1])
-
-                    self.upsert_to_db(data)
-                else:
-                    bad_count += 1
+
+            # AN INTERRUPTED TOP-UP LEFT A CURSOR; CONTINUE FROM THERE, WITH ITS maximum
+            cursor = self.db.query("SELECT marker, maximum FROM listing WHERE bucket=? AND prefix=?", (bucket.name, prefix)).data
+            if cursor:
+                biggest, maximum = cursor[0]
+                Log.note("Resume listing {{bucket}} (prefix={{prefix|quote}}) after {{marker}}", bucket=bucket.name, prefix=prefix, marker=biggest)
+
+            if maximum:
+                # A TOP-UP: THE NEW KEYS ARE ALL JUST ABOVE biggest, SO SHARDS WOULD GAIN NOTHING
+                listing = list_shards(bucket.bucket, [Data(prefix=prefix, marker=biggest)], num_threads=1)
+            else:
+                # A FULL SCAN: LIST THE WHOLE KEY SPACE IN CONCURRENT SHARDS
+                listing = list_shards(bucket.bucket, digit_shards(prefix + "." if prefix else "", biggest))
+            try:
+                self._scan(prefix, maximum, bucket, listing, please_stop)
+            finally:
+                listing.close()
             Log.note("Cache for {{bucket}} (prefix={{prefix|quote}}) is up to date", bucket=bucket.name, prefix=prefix)
 
         return Thread.run("top up "+self.bucket.name, update, prefix, self.bucket)
 
-    def upsert_to_db(self, data):
+    def _scan(self, prefix, maximum, bucket, listing, please_stop):
         """
-        INSERT DATA INTO DATABASE, IGNORE CONSTRAINT ERRORS
-        :param data:
-        :return:
+        ADD THE KEYS FROM listing TO THE CACHE, REMEMBERING HOW FAR WE GOT
         """
-        try:
-            self.db.query(
-                "INSERT INTO files (bucket, key, name, last_modified, size) " +
-                "\nUNION ALL\n".join(
-                    "SELECT " + ",".join(self.db.quote_value(v) for v in d)
-                    for d in data
-                )
-            )
-        except Exception as e:
-            if "UNIQUE constraint failed" in e:
-                if len(data) == 1:
-                    return  # TODO: P
-                else:
-                    split = int(round(len(data)/2, 0))
-                    self.upsert_to_db(data[:split])
-                    self.upsert_to_db(data[split:])
+        bad_count = 0
+        for g, metas in jx.chunk(listing, size=100):
+            if please_stop:
+                Log.error("Request to stop encountered")
+            if bad_count > 100:
+                # Log.note("Bad count is {{count}}", count=bad_count)
+                Log.note("Exit because 1000 records show nothing older")
+                break
+            data = []
+            delete_me = []
+            for meta in metas:
+                primary = parse_primary(prefix, meta.key)
+                if bucket.name == "active-data-jobs" and primary > 2000:
+                    delete_me.append(meta.key)
+                    continue
+
+                if maximum and primary < maximum:
+                    continue
+
+                data.append((
+                    bucket.name,
+                    meta.key.split(".json")[0],
+                    meta.key,
+                    Date(meta.last_modified).unix,
+                    meta.size,
+                    prefix,
+                    primary
+                ))
+
+            if delete_me:
+                Log.note("delete keys {{key}}", key=delete_me)
+                bucket.bucket.delete_keys(delete_me)
+                bad_count = 0
+
+            if data:
+                bad_count = 0
+                if DEBUG:
+                    Log.note("add {{num}} keys to cache for prefix {{prefix|quote}} ({{biggest}})", num=len(data), prefix=prefix, biggest=sorted(d[1] for d in data)[-1])
+
+                self.upsert_to_db(data)
             else:
-                Log.warning("Do not know what to do", cause=e)
+                bad_count += 1
+            self._save_cursor(bucket.name, prefix, metas.last().key, maximum)
+
+        # DONE, NEXT TOP-UP STARTS FROM THE BIGGEST KEY
+        self._save_cursor(bucket.name, prefix, None, None)
+
+    def _save_cursor(self, bucket, prefix, marker, maximum):
+        with self.db.transaction() as t:
+            if marker is None:
+                t.execute("DELETE FROM listing WHERE bucket=? AND prefix=?", (bucket, prefix))
+            else:
+                t.execute(
+                    "INSERT OR REPLACE INTO listing (bucket, prefix, marker, maximum) VALUES (?, ?, ?, ?)",
+                    (bucket, prefix, marker, maximum)
+                )
 
+    def upsert_to_db(self, data):
+        """
+        INSERT DATA INTO DATABASE, IGNORE KEYS ALREADY THERE
+        :param data: LIST OF TUPLES, IN FILES_COLUMNS ORDER
+        """
+        with self.db.transaction() as t:
+            t.execute_many(
+                "INSERT OR IGNORE INTO files (" + ",".join(FILES_COLUMNS) + ") VALUES (" + ",".join("?" * len(FILES_COLUMNS)) + ")",
+                data
+            )
 
 
+def setup_files(db):
+    """
+    CREATE THE files TABLE, OR ADD THE PARSED KEY COLUMNS TO AN OLD ONE
+    """
+    with db.transaction() as t:
+        # WHERE AN INTERRUPTED LISTING STOPPED
+        t.execute("CREATE TABLE IF NOT EXISTS listing (bucket TEXT, prefix TEXT, marker TEXT, maximum INTEGER, PRIMARY KEY(bucket, prefix))")
 
+    details = db.query("PRAGMA table_info(files)")
+    if not details.data:
+        with db.transaction() as t:
+            t.execute("""
+                CREATE TABLE files (
+                   bucket TEXT,
+                   key TEXT,
+                   name TEXT,
+                   last_modified REAL,
+                   size INTEGER,
+                   annotate TEXT,
+                   prefix TEXT,
+                   primary_id INTEGER,
+                   CONSTRAINT pk PRIMARY KEY (bucket, name)
+                )
+            """)
+            t.execute("CREATE INDEX files_primary ON files(bucket, prefix, primary_id)")
+        return
+
+    if "primary_id" in [c[1] for c in details.data]:
+        return
+
+    with db.transaction() as t:
+        t.execute("ALTER TABLE files ADD COLUMN prefix TEXT")
+        t.execute("ALTER TABLE files ADD COLUMN primary_id INTEGER")
+    rows = db.query("SELECT rowid, name FROM files").data
+    Log.note("parse {{num|comma}} cached keys", num=len(rows))
+    with db.transaction() as t:
+        t.execute_many(
+            "UPDATE files SET prefix=?, primary_id=? WHERE rowid=?",
+            [(p, _try_primary(p, name), rowid) for rowid, name in rows for p in [_get_prefix(name)]]
+        )
+        t.execute("CREATE INDEX files_primary ON files(bucket, prefix, primary_id)")
+
+
+def parse_primary(prefix, key):
+    """
+    :return: THE FIRST NUMBER IN key, AFTER prefix
+    """
+    return int(key[len(prefix):].lstrip(".").split(".")[0].split(":")[0])
+
+
+def _try_primary(prefix, key):
+    try:
+        return parse_primary(prefix, key)
+    except Exception:
+        return None
+
+
+def _get_prefix(name):
+    if name[:2] in ("tc", "bb"):
+        return name[:2]
+    return ""
+
+
+def prefix_range(prefix):
+    """
+    :return: SQL AND PARAMETERS MATCHING THE names STARTING WITH prefix, AS A RANGE THE PRIMARY KEY CAN USE
+    """
+    if not prefix:
+        return "1=1", ()
+    return "name>=? AND name<?", (prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1))
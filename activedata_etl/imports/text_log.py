@@ -11,6 +11,7 @@ from __future__ import unicode_literals
 
 import re
 from copy import copy
+from datetime import datetime
 
 import mo_math
 
@@ -31,8 +32,10 @@ MAX_TIMING_ERROR = SECOND  # SOME TIMESTAMPS ARE ONLY ACCURATE TO ONE SECOND
 MAX_HARNESS_TIMING_ERROR = 5 * MINUTE
 
 
-def process_tc_live_backing_log(source_key, all_log_lines, from_url, task_record):
+def process_tc_live_backing_log(source_key, all_log_lines, from_url, task_record, stop_after=None):
     """
+    :param stop_after: OPTIONAL LINE PREFIX (eg "=== Task Finished ===") AFTER WHICH THE REST OF THE LOG IS NOT READ
+
         [taskcluster 2016-10-04 17:09:02.626Z] Task ID: abzkq-CjS_KJzNEhE6nVhA
         [taskcluster 2016-10-04 17:09:02.626Z] Worker ID: i-0348d7e9408f77f42
         [taskcluster 2016-10-04 17:09:02.626Z] Worker Group: us-east-1c
@@ -72,6 +75,7 @@ def process_tc_live_backing_log(source_key, all_log_lines, from_url, task_record
     new_mozharness_line = NewHarnessLines()
 
     total_bytes = 0
+    last_prefix = None
 
     for log_ascii in all_log_lines:
         total_bytes += len(log_ascii) + 1
@@ -88,9 +92,12 @@ def process_tc_live_backing_log(source_key, all_log_lines, from_url, task_record
 
         try:
             prefix = strings.between(log_line, "[", "]")
-            if prefix and log_line.startswith("[" + prefix):
+            if prefix and prefix == last_prefix and log_line.startswith("[" + prefix):
+                # SAME STEP AND TIMESTAMP AS THE PREVIOUS LINE, SO THE TIMINGS DO NOT CHANGE
+                curr_line = log_line[len(prefix) + 3:]
+            elif prefix and log_line.startswith("[" + prefix):
                 prefix_words = prefix.split(' ')
-                tc_timestamp = Date(' '.join(prefix_words[1:]))
+                tc_timestamp = parse_tc_timestamp(' '.join(prefix_words[1:]))
                 step_name = prefix_words[0]
                 curr_line = log_line[len(prefix) + 3:]
 
@@ -104,6 +111,7 @@ def process_tc_live_backing_log(source_key, all_log_lines, from_url, task_record
                     action.timings.append(task_step)
                 task_step.start_time = mo_math.min(task_step.start_time, tc_timestamp)
                 task_step.end_time = MAX([task_step.end_time, tc_timestamp])
+                last_prefix = prefix
             else:
                 # OLD, NON-PREFIXED, FORMAT IS LEGITIMATE
                 process_head = False
@@ -113,6 +121,10 @@ def process_tc_live_backing_log(source_key, all_log_lines, from_url, task_record
             process_head = False
             curr_line = log_line
 
+        if stop_after and curr_line.startswith(stop_after):
+            DEBUG and Log.note("Stop reading {{url}} after {{num}} bytes", url=from_url, num=total_bytes)
+            break
+
         if process_head:
             # [taskcluster 2016-10-04 17:09:02.626Z] Task ID: abzkq-CjS_KJzNEhE6nVhA
             # [taskcluster 2016-10-04 17:09:02.626Z] Worker ID: i-0348d7e9408f77f42
@@ -448,6 +460,27 @@ def process_text_log(all_log_lines, from_url, source_key):
 
 
 
+# [taskcluster 2016-10-04 17:09:02.626Z]
+# [task 2016-10-04T17:09:03.773242Z]
+TC_TIMESTAMP = re.compile(r"(\d\d\d\d)-(\d\d)-(\d\d)[ T](\d\d):(\d\d):(\d\d)(?:\.(\d+))?Z$")
+
+
+def parse_tc_timestamp(value):
+    """
+    SAME AS Date(value), BUT WITHOUT TRYING EVERY DATE FORMAT FOR THE
+    FORMATS FOUND IN TASKCLUSTER LOG PREFIXES
+    """
+    match = TC_TIMESTAMP.match(value)
+    if not match:
+        return Date(value)
+    year, month, day, hour, minute, second, fraction = match.groups()
+    micro = int((fraction or "")[:6].ljust(6, "0"))  # Date() TRUNCATES TO MICROSECONDS
+    return Date(datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), micro))
+
+
+# 12:23:12     INFO - [mozharness: 2016-11-10 20:23:12.172233Z]
+NEW_MOZLOG_PREFIX = "[mozharness: "
+NEW_MOZLOG_PREFIX_START = len("12:23:12     INFO - ")
 NEW_MOZLOG_STEP = re.compile(r"\d\d:\d\d:\d\d     INFO - \[mozharness\: (.*)Z\] .*")
 NEW_MOZLOG_START_STEP = re.compile(r"\d\d:\d\d:\d\d     INFO - \[mozharness\: (.*)Z\] (Running|Skipping) (.*) step.")
 NEW_MOZLOG_END_STEP = [
@@ -485,6 +518,9 @@ class NewHarnessLines(object):
         12:23:12     INFO - [mozharness: 2016-11-10 20:23:12.172233Z] Finished run-tests step (success)
         """
 
+        if not curr_line.startswith(NEW_MOZLOG_PREFIX, NEW_MOZLOG_PREFIX_START):
+            # CHEAP REJECTION OF ALMOST EVERY LINE
+            return None
         if not NEW_MOZLOG_STEP.match(curr_line):
             return None
 
@@ -196,6 +196,8 @@ def main():
                     rollover_max=w.rollover.max,
                     queue_size=coalesce(w.queue_size, 1000),
                     batch_size=unwrap(w.batch_size),
+                    readers=w.readers,
+                    read_ahead=w.read_ahead,
                     kwargs=w.elasticsearch
                 ),
                 bucket=s3.Bucket(w.source),
@@ -214,6 +216,12 @@ def main():
         def monitor_progress(please_stop):
             while not please_stop:
                 Log.note("Remaining in SQS: {{num}}", num=len(main_work_queue))
+                for index, bulk in elasticsearch.bulk_stats().items():
+                    Log.note(
+                        "{{index}}: {{bulks}} bulks, last {{last_docs}} docs ({{last_bytes|comma}} bytes) in {{last_seconds|round(places=2)}}sec, budget {{batch_bytes|comma}} bytes, {{rejected}} rejected, {{retried_docs}} docs retried, {{failed_docs}} docs failed {{item_errors|json}}",
+                        index=index,
+                        **bulk
+                    )
                 (please_stop | Till(seconds=10)).wait()
 
         Thread.run(name="monitor progress", target=monitor_progress, please_stop=please_stop)
@@ -8,12 +8,13 @@
 #
 from __future__ import unicode_literals
 
+from itertools import groupby
 from math import log10
+from tempfile import TemporaryFile
 
 from activedata_etl import etl2key, key2etl
 from activedata_etl.s3_clear import Version
-from mo_collections import UniqueIndex
-from mo_dots import wrap
+from mo_dots import wrap, set_default, Data
 from mo_future import text
 from mo_json import json2value, value2json
 from mo_kwargs import override
@@ -22,6 +23,9 @@ from mo_math import ceiling
 from mo_times.timer import Timer
 from pyLibrary.aws import s3
 from pyLibrary.aws.s3 import key_prefix
+from pyLibrary.convert import bytes2sha1
+
+VOLATILE_ETL_PROPERTIES = ["timestamp", "duration", "machine", "revision"]  # NOT PART OF THE CONTENT HASH
 
 
 class S3Bucket(object):
@@ -34,11 +38,18 @@ class S3Bucket(object):
         aws_secret_access_key=None,  # CREDENTIAL
         region=None,  # NAME OF AWS REGION, REQUIRED FOR SOME BUCKETS
         public=False,
+        manifest_bucket=None,  # NAME OF BUCKET TO HOLD CONTENT HASHES, SO UNCHANGED RECORDS ARE NOT WRITTEN AGAIN
         debug=False,
         kwargs=None
     ):
         self.bucket = s3.Bucket(kwargs)
         self.settings = kwargs
+        if manifest_bucket:
+            if manifest_bucket == bucket:
+                Log.error("Manifests must be kept in a different bucket than {{bucket}}", bucket=bucket)
+            self.manifest = s3.Bucket(set_default({"bucket": manifest_bucket, "public": False}, kwargs))
+        else:
+            self.manifest = None
 
     def __getattr__(self, item):
         return getattr(self.bucket, item)
@@ -74,15 +85,30 @@ class S3Bucket(object):
             return maxi
 
     def extend(self, documents, overwrite=False):
-        parts = {}
-        for d in wrap(documents):
-            parent_key = etl2key(key2etl(d.id).source)
-            d.value._id = d.id
-            sub = parts.setdefault(parent_key, [])
-            sub.append(d.value)
-
-        for k, docs in parts.items():
-            self._extend(k, docs, overwrite=overwrite)
+        """
+        documents ARE STREAMED TO S3, ONE RUN OF SAME-PARENT DOCUMENTS AT A TIME.
+        ONLY THE FIRST DOCUMENT WITH A GIVEN etl.id IS KEPT.  A PARENT WHOSE
+        DOCUMENTS ARE NOT CONTIGUOUS IS WRITTEN ONCE PER RUN, EACH RUN MERGED
+        WITH WHAT WAS WRITTEN BEFORE, SO ITS LATER RUNS ARE FIRST IN THE KEY
+        """
+        def parent(d):
+            return etl2key(key2etl(d.id).source)
+
+        def values(docs, ids):
+            for d in docs:
+                etl_id = d.value.etl.id
+                if etl_id in ids:
+                    continue
+                ids.add(etl_id)
+                d.value._id = d.id
+                yield d.value
+
+        parts = {}  # MAP FROM PARENT KEY TO THE etl.id WRITTEN TO IT
+        for k, docs in groupby((wrap(d) for d in documents), parent):
+            # A PARENT SEEN BEFORE MUST BE MERGED WITH WHAT WAS JUST WRITTEN
+            seen = k in parts
+            ids = parts.setdefault(k, set())
+            self._extend(k, values(docs, ids), overwrite=overwrite and not seen)
 
         return set(parts.keys())
 
@@ -90,33 +116,136 @@ class S3Bucket(object):
         self.bucket.write_lines(key, lines)
 
     def _extend(self, key, documents, overwrite=False):
-        if overwrite:
+        if self.manifest:
+            self._extend_with_manifest(key, documents, overwrite=overwrite)
+            return
+
+        if overwrite or self.bucket.get_meta(key) == None:
             self.bucket.write_lines(key, (value2json(d) for d in documents))
             return
 
-        meta = self.bucket.get_meta(key)
-        if meta != None:
-            documents = UniqueIndex(keys="etl.id", data=documents)
+        def lines():
+            # NEW DOCUMENTS FIRST, THEN THE OLD ONES THEY DO NOT REPLACE
+            new_ids = set()
+            for d in documents:
+                new_ids.add(d.etl.id)
+                yield value2json(d)
+
             try:
-                content = self.bucket.read_lines(key)
-                old_docs = UniqueIndex(keys="etl.id", data=list(map(json2value, content)))
+                for line in self.bucket.read_lines(key):
+                    if not line.strip():
+                        continue
+                    if json2value(line).etl.id not in new_ids:
+                        yield line
             except Exception as e:
-                Log.warning("problem looking at existing records", e)
                 # OLD FORMAT (etl header, followed by list of records)
-                old_docs = UniqueIndex(keys="etl.id")
-
-            residual = old_docs - documents
-            overlap = old_docs & documents
-            # IS IT CHEAPER TO SEE IF THERE IS A DIFF, RATHER THAN WRITE NEW DATA TO S3?
-
-            # CAN NOT PERFORM FUZZY MATCH, THE etl PROPERTY WILL HAVE CHANGED
-            # fuzzytestcase.assertAlmostEqual(documents._data, overlap._data)
+                Log.warning("problem looking at existing records", e)
 
-            if residual:
-                documents = documents | residual
+        # CAN NOT PERFORM FUZZY MATCH, THE etl PROPERTY WILL HAVE CHANGED
+        self.bucket.write_lines(key, lines())
 
-        self.bucket.write_lines(key, (value2json(d) for d in documents))
+    def _extend_with_manifest(self, key, documents, overwrite=False):
+        """
+        THE MANIFEST HOLDS A CONTENT HASH FOR EACH etl.id IN key, AND THE etag
+        OF THE S3 OBJECT IT DESCRIBES.  WITH IT WE CAN SKIP THE WRITE WHEN
+        NOTHING CHANGED, AND SKIP READING THE OLD OBJECT WHEN ALL ITS RECORDS
+        ARE REPLACED
+        """
+        meta = self.bucket.get_meta(key)
+        old_hashes = None
+        if meta != None and not overwrite:
+            manifest = self._read_manifest(key)
+            if manifest.etag == meta.etag:
+                old_hashes = manifest.records
+            # ELSE THE OBJECT WAS WRITTEN BY SOMEONE ELSE; MANIFEST IS NOT TRUSTED
+
+        with TemporaryFile() as spool:
+            # SPOOL NEW DOCUMENTS, AND HASH THEM
+            hashes = Data()
+            for d in documents:
+                spool.write(value2json(d).encode("utf8") + b"\n")
+                hashes[text(d.etl.id)] = content_hash(d)
+
+            def new_lines():
+                spool.seek(0)
+                for line in spool:
+                    yield line.decode("utf8").rstrip("\n")
+
+            if meta == None or overwrite:
+                lines = new_lines()
+            elif old_hashes != None:
+                if all(hashes[k] == v for k, v in old_hashes.items()) and len(old_hashes.keys()) == len(hashes.keys()):
+                    Log.note("No change to {{key}} in {{bucket}}", key=key, bucket=self.bucket.name)
+                    return
+                elif all(hashes[k] for k in old_hashes.keys()):
+                    # EVERY OLD RECORD IS REPLACED, NO NEED TO READ THEM
+                    lines = new_lines()
+                else:
+                    lines = self._merge_lines(key, new_lines(), hashes)
+            else:
+                lines = self._merge_lines(key, new_lines(), hashes)
+
+            etag = self.bucket.write_lines(key, lines)
+        self.manifest.write(key, value2json({"etag": etag, "records": hashes}))
+
+    def _merge_lines(self, key, new_lines, hashes):
+        """
+        NEW LINES, THEN THE OLD ONES NOT REPLACED (ADDING THEIR HASHES)
+        """
+        new_ids = set(hashes.keys())
+        for line in new_lines:
+            yield line
+
+        try:
+            for line in self.bucket.read_lines(key):
+                if not line.strip():
+                    continue
+                old = json2value(line)
+                old_id = text(old.etl.id)
+                if old_id not in new_ids:
+                    hashes[old_id] = content_hash(old)
+                    yield line
+        except Exception as e:
+            Log.warning("problem looking at existing records", e)
+
+    def _read_manifest(self, key):
+        try:
+            content = self.manifest.read(key)
+            if content:
+                return json2value(content)
+        except Exception as e:
+            Log.warning("problem reading manifest for {{key}}", key=key, cause=e)
+        return Data()
 
     def add(self, doc):
         Log.error("Not supported")
 
+
+def content_hash(doc):
+    """
+    HASH OF THE DOCUMENT, IGNORING THE PARTS OF etl THAT CHANGE ON EVERY RUN
+    """
+    doc = wrap(doc)
+    etl, _id = doc.etl, doc._id
+    try:
+        doc.etl = _stable_etl(etl)
+        doc._id = None
+        return bytes2sha1(value2json(doc).encode("utf8"))
+    finally:
+        doc.etl = etl
+        doc._id = _id
+
+
+def _stable_etl(etl):
+    if etl == None:
+        return None
+    output = Data()
+    for k, v in etl.items():
+        if k in VOLATILE_ETL_PROPERTIES:
+            continue
+        elif k == "source":
+            output.source = _stable_etl(v)
+        else:
+            output[k] = v
+    return output
+
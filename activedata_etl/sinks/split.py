@@ -23,6 +23,7 @@ class Split(object):
         return self.A.keys(prefix=prefix) | self.B.keys(prefix=prefix)
 
     def extend(self, documents):
+        documents = list(documents)  # MAY BE A GENERATOR, BUT BOTH SINKS NEED IT
         self.A.extend(documents)
         self.B.extend(documents)
 
@@ -100,14 +100,14 @@ def process_directory(source_key, tmpdir, gcno_file, gcda_file, destination, tas
         count = 0
 
         if DEBUG_LCOV_FILE:
-            lcov_coverage = list(parse_lcov_coverage(source_key, tmpdir, DEBUG_LCOV_FILE.read_lines()))
+            lcov_coverage = parse_lcov_coverage(source_key, tmpdir, DEBUG_LCOV_FILE.read_lines())
         elif os.name == 'nt':
             # grcov DOES NOT SUPPORT WINDOWS YET
             dest_dir = (tmpdir / "ccov").abspath
             unzip_files(gcno_file, gcda_file, dest_dir)
             while not please_stop:
                 try:
-                    lcov_coverage = list(run_lcov_on_windows(dest_dir))  # TODO: Remove list()
+                    lcov_coverage = run_lcov_on_windows(dest_dir)
                     break
                 except Exception as e:
                     if "Could not remove file" in e:
@@ -201,6 +201,10 @@ def run_lcov_on_linux(directory_path):
 
 
 def run_lcov_on_windows(directory_path):
+    """
+    RUN lcov TO COMPLETION (SO FILE PROBLEMS RAISE HERE), THEN STREAM ITS OUTPUT
+    :return: generator of coverage docs
+    """
     WINDOWS_TEMP_DIR = "c:/msys64/tmp/ccov"
     MSYS2_TEMP_DIR = "/tmp/ccov"
 
@@ -245,8 +249,7 @@ def run_lcov_on_windows(directory_path):
             break
         Till(till=expiry).wait()
 
-    for cov in parse_lcov_coverage(Null, directory_path, open(windows_dest_file.abspath, "rb")):
-        yield cov
+    return parse_lcov_coverage(Null, directory_path, open(windows_dest_file.abspath, "rb"))
 
 
 def best_suffix(a, candidates):
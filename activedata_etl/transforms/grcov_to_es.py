@@ -20,7 +20,7 @@ from mo_future import text
 from mo_json import value2json
 from mo_logs import Log, machine_metadata
 from mo_times import Timer, Date
-from mo_http.big_data import ibytes2ilines
+from mo_http.big_data import sbytes2ilines
 
 IGNORE_ZERO_COVERAGE = False
 IGNORE_METHOD_COVERAGE = True
@@ -61,7 +61,7 @@ def process_grcov_artifact(source_key, resources, destination, artifact, task_cl
                     Log.error("expecting only one artifact in the grcov.zip file while processing {{key}}", key=source_key)
 
                 def renamed_files():
-                    for source in parse_lcov_coverage(source_key, artifact.url, ibytes2ilines(zipped.open(zip_name))):
+                    for source in parse_lcov_coverage(source_key, artifact.url, sbytes2ilines(zipped.open(zip_name))):
                         if please_stop:
                             return
                         if IGNORE_ZERO_COVERAGE and source.file.total_covered == 0:
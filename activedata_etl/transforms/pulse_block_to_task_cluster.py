@@ -9,12 +9,14 @@
 from __future__ import division
 from __future__ import unicode_literals
 
+import zlib
+from copy import copy
+
 import mo_math
-import requests
 
 from activedata_etl import etl2key
 from activedata_etl.imports.resource_usage import normalize_resource_usage
-from activedata_etl.imports.task import decode_metatdata_name
+from activedata_etl.imports.task import decode_metatdata_name, minimize_task
 from activedata_etl.imports.text_log import process_tc_live_backing_log
 from activedata_etl.transforms import (
     TRY_AGAIN_LATER,
@@ -26,6 +28,7 @@ from activedata_etl.transforms import (
 )
 from jx_python import jx
 from mo_dots import set_default, Data, unwraplist, listwrap, wrap, coalesce, Null, is_data
+from mo_future import OrderedDict
 from mo_files import URL, mimetype
 from mo_future import text
 from mo_hg.hg_mozilla_org import minimize_repo
@@ -33,24 +36,57 @@ from mo_json import json2value, value2json
 from mo_logs import Log, machine_metadata, strings
 from mo_logs.exceptions import suppress_exception, Except
 from mo_testing.fuzzytestcase import assertAlmostEqual
+from mo_threads import Lock, Signal, Thread
+from mo_times import Duration
 from mo_times.dates import Date
 from pyLibrary import convert
+from pyLibrary.convert import bytes2sha1
 from mo_http import http
 
 DEBUG = False
 DISABLE_LOG_PARSING = False
-MAX_THREADS = 5
+LOG_STOP_AFTER = None  # SET TO "=== Task Finished ===" TO SKIP THE ARTIFACT UPLOAD LINES AT THE END OF EACH LOG
+MAX_THREADS = 5  # CONCURRENT TASK FETCHES PER BLOCK
+MAX_PER_HOST = 10  # CONCURRENT REQUESTS TO ONE HOST, OVER ALL BLOCKS IN THIS PROCESS
+MAX_SEEN_TASKS = 200000  # TASKS REMEMBERED FOR DUPLICATE DETECTION
+SEEN_TASKS_DURATION = "day"  # HOW LONG AN UNSEEN TASK IS REMEMBERED
+LOOKUP_BUILD_TASKS = False  # SET TO True TO FILL normalized.build FROM THE BUILD TASK IN THE task INDEX (NEEDS local_es_node)
+MAX_BUILD_TASKS = 10000  # BUILD TASK IDS REMEMBERED
+BUILD_TASK_DURATION = "hour"  # HOW LONG A FOUND BUILD TASK IS TRUSTED
+MISSING_BUILD_DURATION = "10minute"  # HOW LONG BEFORE A MISSING BUILD TASK IS LOOKED UP AGAIN
+BUILD_TASK_BATCH = 200  # BUILD TASK IDS PER terms QUERY
 
-seen_tasks = {}
 new_seen_tc_properties = set()
 
 
 def process(source_key, source, destination, resources, please_stop=None):
     output = []
-    source_etl = None
 
     lines = list(enumerate(source.read_lines()))
-    session = requests.session()
+    fetched = TaskPrefetch([_task_id(line) for _, line in lines])
+    builds = None
+    try:
+        if LOOKUP_BUILD_TASKS and resources.local_es_node.host:
+            # LOOK UP THE BUILDS THE BLOCK DEPENDS ON, WHILE THE LINES ARE PROCESSED
+            builds = Thread.run("prefetch builds", _prefetch_builds, source_key, resources, fetched)
+        _process_lines(source_key, lines, fetched, output, resources, please_stop)
+    finally:
+        if builds:
+            builds.please_stop.go()
+            builds.join()
+        fetched.stop()
+    DEBUG and Log.note("{{num}} tasks seen: {{stats|json}}", num=len(seen_tasks), stats=seen_tasks.stats)
+
+    keys = destination.extend({"id": etl2key(t.etl), "value": t} for t in output)
+    return keys
+
+
+def _prefetch_builds(source_key, resources, fetched, please_stop):
+    build_tasks.prefetch(source_key, resources, fetched.dependencies(please_stop), please_stop)
+
+
+def _process_lines(source_key, lines, fetched, output, resources, please_stop):
+    source_etl = None
     for line_number, line in lines:
         if please_stop:
             Log.error("Shutdown detected. Stopping early")
@@ -67,8 +103,7 @@ def process(source_key, source, destination, resources, please_stop=None):
                 num=line_number,
                 artifact=tc_message.artifact.name,
             )
-            task_url = strings.expand_template(TC_MAIN_URL, {"task_id": task_id})
-            task = http.get_json(task_url, retry=TC_RETRY, session=session)
+            task = fetched.get(line_number, TC_MAIN_URL, task_id)
             if task.code == "ResourceNotFound":
                 Log.note(
                     "Can not find task {{task}} while processing key {{key}}",
@@ -102,8 +137,7 @@ def process(source_key, source, destination, resources, please_stop=None):
 
             # if not tc_message.status.runs.last().resolved:
             # UPDATE TASK STATUS (tc_message MAY BE OLD)
-            status_url = strings.expand_template(TC_STATUS_URL, {"task_id": task_id})
-            task_status = http.get_json(status_url, retry=TC_RETRY, session=session)
+            task_status = fetched.get(line_number, TC_STATUS_URL, task_id)
             consume(task_status, "status.taskId")
             temp_runs, task_status.status.runs = (
                 task_status.status.runs,
@@ -123,9 +157,8 @@ def process(source_key, source, destination, resources, please_stop=None):
 
             # get the artifact list for the taskId
             try:
-                artifacts = normalized.task.artifacts = http.get_json(
-                    strings.expand_template(TC_ARTIFACTS_URL, {"task_id": task_id}),
-                    retry=TC_RETRY,
+                artifacts = normalized.task.artifacts = fetched.get(
+                    line_number, TC_ARTIFACTS_URL, task_id
                 ).artifacts
             except Exception as e:
                 Log.error(
@@ -188,21 +221,8 @@ def process(source_key, source, destination, resources, please_stop=None):
             }
 
             tc_message.artifact = "." if tc_message.artifact else Null
-            if normalized.task.id in seen_tasks:
-                try:
-                    assertAlmostEqual(
-                        [tc_message, task, artifacts],
-                        seen_tasks[normalized.task.id],
-                        places=11,
-                    )
-                except Exception as e:
-                    Log.error("Not expected", cause=e)
-            else:
-                tc_message._meta = Null
-                tc_message.runs = Null
-                tc_message.runId = Null
-                tc_message.artifact = Null
-                seen_tasks[normalized.task.id] = [tc_message, task, artifacts]
+            if not seen_tasks.check(normalized.task.id, [tc_message, task, artifacts], strip=_strip_message):
+                Log.error("Not expected: task {{task}} changed since it was last seen", task=normalized.task.id)
 
             output.append(normalized)
         except Exception as e:
@@ -221,18 +241,236 @@ def process(source_key, source, destination, resources, please_stop=None):
                     cause=e,
                 )
 
-    keys = destination.extend({"id": etl2key(t.etl), "value": t} for t in output)
-    return keys
+
+def _strip_message(doc):
+    # THESE DIFFER BETWEEN MESSAGES ABOUT THE SAME TASK, SO ARE NOT EXPECTED
+    tc_message = copy(doc[0])
+    tc_message._meta = Null
+    tc_message.runs = Null
+    tc_message.runId = Null
+    tc_message.artifact = Null
+    return [tc_message] + list(doc[1:])
+
+
+def _task_id(line):
+    """
+    :return: THE TASK ID IN THE PULSE MESSAGE, OR None IF THE LINE CAN NOT BE READ
+    """
+    try:
+        return json2value(line).status.taskId
+    except Exception:
+        return None
+
+
+class HostLimit(object):
+    """
+    LIMIT THE NUMBER OF CONCURRENT REQUESTS TO ANY ONE HOST
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.locker = Lock("host limit")
+        self.active = {}
+
+    def acquire(self, url):
+        host = URL(url).host
+        with self.locker:
+            while self.active.get(host, 0) >= self.limit:
+                self.locker.wait()
+            self.active[host] = self.active.get(host, 0) + 1
+        return host
+
+    def release(self, host):
+        with self.locker:
+            self.active[host] -= 1
+
+
+host_limit = HostLimit(MAX_PER_HOST)
+
+
+class SeenTasks(object):
+    """
+    REMEMBER WHAT IS EXPECTED OF EACH TASK SEEN, TO DETECT TASKS THAT CHANGE
+    BETWEEN MESSAGES. THE LEAST RECENTLY SEEN TASKS ARE FORGOTTEN ONCE
+    THERE ARE MORE THAN max_size, OR WHEN NOT SEEN FOR duration
+    """
+
+    def __init__(self, max_size=MAX_SEEN_TASKS, duration=SEEN_TASKS_DURATION):
+        self.max_size = max_size
+        self.duration = Duration(duration).seconds
+        self.locker = Lock("seen tasks")
+        self.seen = OrderedDict()  # MAP FROM TASK ID TO (digest, compressed json, last_seen), OLDEST FIRST
+        self.stats = Data(checked=0, duplicates=0, identical=0, mismatches=0, evicted=0)
+
+    def check(self, task_id, doc, strip=None):
+        """
+        :param task_id: TASK ID
+        :param doc: JSON-SERIALIZABLE CONTENT THAT SHOULD NOT CHANGE FOR THE TASK
+        :param strip: FUNCTION THAT RETURNS A COPY OF doc WITHOUT WHAT LATER MESSAGES NEED NOT MATCH
+        :return: False IF THE TASK WAS SEEN BEFORE WITH DIFFERENT CONTENT
+        """
+        now = Date.now().unix
+        content = value2json(strip(doc) if strip else doc)
+        digest = bytes2sha1(content.encode("utf8"))
+        with self.locker:
+            self.stats.checked += 1
+            previous = self.seen.pop(task_id, None)
+            if previous is None:
+                self.seen[task_id] = digest, zlib.compress(content.encode("utf8")), now
+                self._evict(now)
+                return True
+
+            # KEEP THE FIRST doc, SO EVERY LATER MESSAGE IS COMPARED TO THE SAME CONTENT
+            self.seen[task_id] = previous[0], previous[1], now
+            self.stats.duplicates += 1
+            if digest == previous[0]:
+                # SAME AS THE FIRST, SO NO NEED TO DECODE IT
+                self.stats.identical += 1
+                return True
+
+        # ONLY WHAT WAS FIRST SEEN IS EXPECTED; PROPERTIES ADDED LATER ARE IGNORED
+        expected = json2value(zlib.decompress(previous[1]).decode("utf8"))
+        try:
+            assertAlmostEqual(doc, expected, places=11)
+            return True
+        except Exception:
+            with self.locker:
+                self.stats.mismatches += 1
+            return False
+
+    def _evict(self, now):
+        expired = now - self.duration
+        while self.seen:
+            task_id = next(iter(self.seen))
+            _, _, last_seen = self.seen[task_id]
+            if len(self.seen) <= self.max_size and last_seen >= expired:
+                break
+            del self.seen[task_id]
+            self.stats.evicted += 1
+
+    def __len__(self):
+        return len(self.seen)
+
+
+seen_tasks = SeenTasks()
+
+
+class TaskPrefetch(object):
+    """
+    FETCH THE TASK, STATUS AND ARTIFACT LIST FOR EVERY LINE IN A BLOCK, WITH
+    A POOL OF num_threads THREADS. EACH LINE IS FETCHED IN THE SAME ORDER,
+    AND STOPS AT THE SAME POINT, AS THE SERIAL CODE WOULD. get() RETURNS
+    THE DOCUMENT, OR RAISES THE ERROR, THE SERIAL CODE WOULD HAVE SEEN.
+    WITH NO session, THE KEEP-ALIVE CONNECTIONS OF mo_http.http.pool ARE USED
+    """
+
+    def __init__(self, task_ids, session=None, num_threads=MAX_THREADS, limit=None):
+        self.task_ids = task_ids
+        self.session = session
+        self.limit = coalesce(limit, host_limit)
+        self.results = [{} for _ in task_ids]
+        self.depends = [[] for _ in task_ids]  # THE TASK IDS EACH LINE'S TASK DEPENDS ON
+        self.fetched = [Signal() for _ in task_ids]
+        self.locker = Lock()
+        self.todo = iter(range(len(task_ids)))
+        self.threads = [
+            Thread.run("fetch tasks " + text(t), self._fetch_all)
+            for t in range(min(max(1, num_threads), len(task_ids)))
+        ]
+
+    def _fetch_all(self, please_stop):
+        while not please_stop:
+            with self.locker:
+                i = next(self.todo, None)
+            if i is None:
+                return
+            try:
+                task_id = self.task_ids[i]
+                if task_id is None:
+                    # get() WILL FETCH, IF THE LINE IS EVER READ
+                    continue
+                task = self._fetch(i, TC_MAIN_URL, task_id)
+                if task is None or task.code == "ResourceNotFound":
+                    continue
+                self.depends[i] = listwrap(task.dependencies)
+                if self._fetch(i, TC_STATUS_URL, task_id) is None:
+                    continue
+                self._fetch(i, TC_ARTIFACTS_URL, task_id)
+            finally:
+                self.fetched[i].go()
+
+    def _fetch(self, i, template, task_id):
+        try:
+            value = self._get(template, task_id)
+            self.results[i][template] = value, None
+            return value
+        except Exception as e:
+            self.results[i][template] = None, Except.wrap(e)
+            return None
+
+    def _get(self, template, task_id):
+        url = strings.expand_template(template, {"task_id": task_id})
+        host = self.limit.acquire(url)
+        try:
+            return http.get_json(url, retry=TC_RETRY, session=self.session)
+        finally:
+            self.limit.release(host)
+
+    def get(self, i, template, task_id):
+        """
+        :param i: LINE NUMBER
+        :param template: ONE OF TC_MAIN_URL, TC_STATUS_URL, TC_ARTIFACTS_URL
+        :param task_id: THE TASK ON THAT LINE
+        :return: THE JSON DOCUMENT
+        """
+        self.fetched[i].wait()
+        result = self.results[i].pop(template, None)
+        if result is None or self.task_ids[i] != task_id:
+            # NOT PREFETCHED
+            return self._get(template, task_id)
+        value, error = result
+        if error:
+            raise error
+        return value
+
+    def dependencies(self, please_stop, batch_size=BUILD_TASK_BATCH):
+        """
+        :return: GENERATOR OF LISTS OF THE TASK IDS THE FETCHED TASKS DEPEND ON,
+        IN LINE ORDER. A LIST IS GIVEN ONCE IT HAS batch_size IDS, OR WHEN THE
+        NEXT LINE IS STILL BEING FETCHED
+        """
+        batch = []
+        for i, fetched in enumerate(self.fetched):
+            if batch and (len(batch) >= batch_size or not fetched):
+                yield batch
+                batch = []
+            (fetched | please_stop).wait()
+            if please_stop:
+                return
+            batch.extend(self.depends[i])
+        if batch:
+            yield batch
+
+    def stop(self):
+        for t in self.threads:
+            t.please_stop.go()
+        for t in self.threads:
+            t.join()
 
 
 def read_actions(source_key, normalized, url):
     if DISABLE_LOG_PARSING:
         return
     try:
-        all_log_lines = http.get(url).get_all_lines(encoding=Null)
-        normalized.action = process_tc_live_backing_log(
-            source_key, all_log_lines, url, normalized
-        )
+        response = http.get(url)
+        try:
+            all_log_lines = response.get_all_lines(encoding=Null)
+            normalized.action = process_tc_live_backing_log(
+                source_key, all_log_lines, url, normalized, stop_after=LOG_STOP_AFTER
+            )
+        finally:
+            # THE LOG MAY NOT BE READ TO THE END
+            response.close()
     except Exception as e:
         e = Except.wrap(e)
         if "Connection broken: error(104," in e:
@@ -706,20 +944,162 @@ def set_build_info(source_key, normalized, task, env, resources):
         )
 
     # FIND BUILD TASK
-    # if treeherder.jobKind == "test":
-    #     build_task = get_build_task(source_key, resources, normalized)
-    #     if build_task:
-    #         if DEBUG:
-    #             Log.note(
-    #                 "Got build {{build}} for test {{test}}",
-    #                 build=build_task.task.id,
-    #                 test=normalized.task.id,
-    #             )
-    #         minimize_task(build_task)
-    #         set_default(normalized.build, build_task)
+    if LOOKUP_BUILD_TASKS and resources.local_es_node.host and treeherder.jobKind == "test":
+        build_task = get_build_task(source_key, resources, normalized)
+        if build_task:
+            if DEBUG:
+                Log.note(
+                    "Got build {{build}} for test {{test}}",
+                    build=build_task.task.id,
+                    test=normalized.task.id,
+                )
+            minimize_task(build_task)
+            set_default(normalized.build, build_task)
 
 
-MISSING_BUILDS = set()
+MISSING_BUILDS = set()  # BUILD TASK IDS ALREADY ALERTED AS MISSING
+
+
+class BuildTasks(object):
+    """
+    PER-PROCESS CACHE OF THE BUILD TASKS IN THE task INDEX, BY TASK ID. IDS
+    WITH NO BUILD TASK ARE ALSO REMEMBERED, BUT FOR LESS TIME, BECAUSE THE
+    BUILD MAY NOT BE INDEXED YET. DOCUMENTS ARE KEPT AS JSON, SO EVERY CALLER
+    GETS ITS OWN COPY TO CHANGE
+    """
+
+    def __init__(
+        self,
+        max_size=MAX_BUILD_TASKS,
+        duration=BUILD_TASK_DURATION,
+        missing_duration=MISSING_BUILD_DURATION,
+    ):
+        self.max_size = max_size
+        self.duration = Duration(duration).seconds
+        self.missing_duration = Duration(missing_duration).seconds
+        self.locker = Lock("build tasks")
+        self.cache = OrderedDict()  # MAP FROM TASK ID TO (expires, JSON LIST OF BUILD TASKS), OLDEST FIRST
+        self.pending = {}  # MAP FROM TASK ID TO THE Signal OF THE QUERY LOOKING FOR IT
+        self.stats = Data(hits=0, misses=0, queries=0, evicted=0)
+
+    def get(self, resources, task_ids):
+        """
+        :param task_ids: TASK IDS THAT MAY BE BUILD TASKS
+        :return: LIST OF BUILD TASKS FOUND FOR task_ids
+        """
+        task_ids = list(OrderedDict((t, True) for t in task_ids))
+        found = {}
+        in_flight = []
+        with self.locker:
+            for task_id in task_ids:
+                content = self._lookup(task_id)
+                if content is not None:
+                    found[task_id] = content
+                elif task_id in self.pending:
+                    in_flight.append(self.pending[task_id])
+        if in_flight:
+            # A PREFETCH IS ALREADY LOOKING, WAIT FOR IT RATHER THAN ASK AGAIN
+            for done in in_flight:
+                done.wait()
+            with self.locker:
+                for task_id in task_ids:
+                    if task_id not in found:
+                        content = self._lookup(task_id, count=False)
+                        if content is not None:
+                            found[task_id] = content
+        todo = [t for t in task_ids if t not in found]
+        if todo:
+            found.update(self._query(resources, todo))
+        return [b for t in task_ids for b in json2value(found[t])]
+
+    def prefetch(self, source_key, resources, batches, please_stop=None):
+        """
+        FILL THE CACHE FOR EACH BATCH OF TASK IDS, AS THE BATCHES ARRIVE
+        """
+        for batch in batches:
+            if please_stop:
+                return
+            with self.locker:
+                todo = [
+                    t
+                    for t in sorted(set(batch))
+                    if t not in self.pending and self._lookup(t, count=False) is None
+                ]
+            for i in range(0, len(todo), BUILD_TASK_BATCH):
+                try:
+                    self._query(resources, todo[i : i + BUILD_TASK_BATCH])
+                except Exception as e:
+                    Log.warning(
+                        "Failure to prefetch build tasks while processing {{key}}",
+                        key=source_key,
+                        cause=e,
+                    )
+                    return
+
+    def _lookup(self, task_id, count=True):
+        value = self.cache.pop(task_id, None)
+        if value is None or value[0] < Date.now().unix:
+            if count:
+                self.stats.misses += 1
+            return None
+        self.cache[task_id] = value
+        if count:
+            self.stats.hits += 1
+        return value[1]
+
+    def _query(self, resources, task_ids):
+        """
+        :return: MAP FROM TASK ID TO JSON LIST OF ITS BUILD TASKS
+        """
+        done = Signal()
+        with self.locker:
+            for task_id in task_ids:
+                self.pending.setdefault(task_id, done)
+        try:
+            return self._search(resources, task_ids)
+        finally:
+            with self.locker:
+                for task_id in task_ids:
+                    if self.pending.get(task_id) is done:
+                        del self.pending[task_id]
+            done.go()
+
+    def _search(self, resources, task_ids):
+        response = http.post_json(
+            URL(
+                value=resources.local_es_node.host,
+                port=coalesce(resources.local_es_node.port, 9200),
+                path="task/task/_search",
+            ),
+            headers={"Content-Type": mimetype.JSON},
+            data={
+                "query": {"terms": {"task.id": task_ids}},
+                "from": 0,
+                "size": 10 * len(task_ids),
+            },
+            retry={"times": 3, "sleep": 15},
+        )
+        builds = {t: [] for t in task_ids}
+        for h in response.hits.hits:
+            if h._source.treeherder.jobKind == "build" and h._source.task.id in builds:
+                builds[h._source.task.id].append(h._source)
+
+        now = Date.now().unix
+        output = {}
+        with self.locker:
+            self.stats.queries += 1
+            for task_id, found in builds.items():
+                content = output[task_id] = value2json(found)
+                expires = now + (self.duration if found else self.missing_duration)
+                self.cache.pop(task_id, None)
+                self.cache[task_id] = expires, content
+            while len(self.cache) > self.max_size:
+                self.cache.pop(next(iter(self.cache)))
+                self.stats.evicted += 1
+        return output
+
+
+build_tasks = BuildTasks()
 
 
 def get_build_task(source_key, resources, normalized_task):
@@ -745,20 +1125,7 @@ def get_build_task(source_key, resources, normalized_task):
         )
         return Null
     try:
-        response = http.post_json(
-            URL(
-                value=resources.local_es_node.host,
-                port=coalesce(resources.local_es_node.port, 9200),
-                path="task/task/_search",
-            ),
-            headers={"Content-Type": mimetype.JSON},
-            data={
-                "query": {"terms": {"task.id": build_task_id}},
-                "from": 0,
-                "size": 10,
-            },
-            retry={"times": 3, "sleep": 15},
-        )
+        found = build_tasks.get(resources, build_task_id)
     except Exception as e:
         Log.warning(
             "Failure to get build task while processing {{key}}",
@@ -767,14 +1134,7 @@ def get_build_task(source_key, resources, normalized_task):
         )
         return Null
 
-    candidates = jx.sort(
-        [
-            h._source
-            for h in response.hits.hits
-            if h._source.treeherder.jobKind == "build"
-        ],
-        "run.start_time",
-    )
+    candidates = jx.sort(found, "run.start_time")
     if not candidates:
         if not any(b in MISSING_BUILDS for b in build_task_id):
             Log.alert(
@@ -8,12 +8,15 @@
 #
 from __future__ import division, unicode_literals
 
+from collections import OrderedDict
+from tempfile import TemporaryFile
+
 from activedata_etl.transforms import TRY_AGAIN_LATER
 from activedata_etl.transforms.pulse_block_to_es import transform_buildbot
 from jx_python import jx
 from mo_dots import Data, Null, coalesce, set_default, wrap
 from mo_future import text, is_text
-from mo_json import json2value, scrub
+from mo_json import json2value, scrub, value2json
 from mo_logs import Log, machine_metadata, strings
 from mo_logs.exceptions import Except
 from mo_math import MAX, MIN
@@ -25,6 +28,7 @@ from mo_times.dates import parse
 
 DEBUG = True
 ACCESS_DENIED = "Access Denied to {{url}} in {{key}}"
+MAX_ENDED_TESTS = 100  # ENDED TESTS KEPT IN MEMORY, IN CASE LATER LOG LINES REFER TO THEM
 
 
 def last(l):
@@ -96,24 +100,21 @@ def process_unittest(source_key, etl_header, buildbot_summary, unittest_log, des
             Log.alert("Test is {{days|round(decimal=1)}} days old", days=age / DAY)
         Log.note("Done\n{{data|indent}}", data=buildbot_summary.run.stats)
 
-    new_keys = []
-    new_data = []
-
-    if not summary.tests:
+    if not summary.stats.total:
         key = source_key + ".0"
-        new_keys.append(key)
-
-        new_data.append({
+        destination.extend([{
             "id": key,
             "value": buildbot_summary
-        })
-    else:
-        for i, t in enumerate(summary.tests):
-            key = source_key + "." + text(i)
-            new_keys.append(key)
+        }])
+        return [key]
 
-            new_data.append({
-                "id": key,
+    new_keys = [source_key + "." + text(i) for i in range(summary.stats.total)]
+
+    def new_data():
+        # ONE TEST RECORD AT A TIME, SO THE SINK CAN STREAM THEM
+        for i, t in enumerate(summary.tests):
+            yield {
+                "id": new_keys[i],
                 "value": set_default(
                     {
                         "result": t,
@@ -121,8 +122,9 @@ def process_unittest(source_key, etl_header, buildbot_summary, unittest_log, des
                     },
                     buildbot_summary
                 )
-            })
-    destination.extend(new_data)
+            }
+
+    destination.extend(new_data())
     return new_keys
 
 
@@ -195,15 +197,20 @@ def accumulate_logs(source_key, url, lines, suite_name, please_stop):
 
 
 class LogSummary(object):
+    """
+    ONLY THE TESTS IN PROGRESS (AND A FEW RECENTLY ENDED) ARE KEPT IN MEMORY
+    THE REST ARE SPOOLED TO A TEMP FILE, AND READ BACK WHEN summary().tests IS ITERATED
+    """
     def __init__(self, source_key, url):
         self.source_key = source_key
         self.url = url
         self.suite_name = None
         self.start_time = None
         self.end_time = None
-        self.tests = {}
-        self.logs = {}
-        self.stats = Data()
+        self.tests = {}  # MAP FROM TEST NAME TO MOST RECENT RUN OF THAT TEST
+        self.ended = OrderedDict()  # NAMES OF ENDED TESTS STILL IN self.tests, OLDEST FIRST
+        self.spool = TemporaryFile()  # FINISHED TESTS, ONE JSON PER LINE
+        self.stats = Data(total=0, ok=0)
         self.groups = None
         self.test_to_group = {}   # MAP FROM TEST NAME TO GROUP NAME
 
@@ -255,8 +262,12 @@ class LogSummary(object):
                 KNOWN_TEST_PROPERTIES.add(k)
                 Log.warning("do not know about new test property {{name|quote}} in {{key}} ", name=k, key=self.source_key)
 
-        tests = self.tests.setdefault(log.test, [])
-        tests.append(test)
+        previous = self.tests.get(log.test)
+        if previous:
+            # TEST IS RUN AGAIN, THE PREVIOUS RUN WILL NOT CHANGE
+            self.ended.pop(log.test, None)
+            self._spool(previous)
+        self.tests[log.test] = test
         self.end_time = log.time
 
 
@@ -276,7 +287,6 @@ class LogSummary(object):
             Log.warning("Log has blank 'test' property! Do not know how to handle. In {{key}} ", key=self.source_key)
             return
 
-        self.logs.setdefault(log.test, []).append(log)
         test = self._get_test(log)
         test.stats.action.test_status += 1
         test.end_time = log.time
@@ -308,15 +318,12 @@ class LogSummary(object):
                 }]
 
     def process_output(self, log):
-        if log.test:
-            self.logs.setdefault(log.test, []).append(log)
         pass
 
     def log(self, log):
         if not log.test:
             return
 
-        self.logs.setdefault(log.test, []).append(log)
         test = self._get_test(log)
         test.stats.action.log += 1
         test.end_time = log.time
@@ -326,8 +333,6 @@ class LogSummary(object):
         if not log.test:
             log.test = "!!SUITE CRASH!!"
 
-        self.logs.setdefault(log.test, []).append(log)
-
         test = self._get_test(log)
         test.ok = False
         test.crash=True,
@@ -341,7 +346,6 @@ class LogSummary(object):
         # test.crash_result.action = None
 
     def test_end(self, log):
-        self.logs.setdefault(log.test, []).append(log)
         test = self._get_test(log)
         test.ok = True if log.expected == None or log.expected == log.status else False
         if not all(test.subtests.ok):
@@ -352,45 +356,66 @@ class LogSummary(object):
         test.duration = coalesce(test.end_time - test.start_time, log.extra.runtime)
         test.extra = test.extra
 
+        self.ended[log.test] = True
+        if len(self.ended) > MAX_ENDED_TESTS:
+            oldest, _ = self.ended.popitem(last=False)
+            self._spool(self.tests.pop(oldest))
+
     def _get_test(self, log):
-        test = last(self.tests.get(log.test))
+        test = self.tests.get(log.test)
         if not test:
             test = Data(
                 test=log.test,
                 start_time=log.time,
                 missing_test_start=True
             )
-            self.tests[log.test] = [test]
+            self.tests[log.test] = test
         return test
 
+    def _spool(self, test):
+        """
+        FINISH test, COUNT IT, AND MOVE IT OUT OF MEMORY
+        """
+        test.duration = test.end_time - test.start_time
+        if not test.status:
+            test.ok = False
+            test.missing_test_end = True
+
+        self.stats.total += 1
+        try:
+            if test.status:
+                self.stats.status[test.status.lower()] += 1
+        except Exception as e:
+            Log.warning("problem with key {{key}} on item {{i}}", key=self.source_key, i=self.stats.total - 1, cause=e)
+        if test.ok:
+            self.stats.ok += 1
+
+        self.spool.write(value2json(test).encode("utf8") + b"\n")
+
     def suite_end(self, log):
         pass
 
     def summary(self):
-        self.tests = tests = wrap([vv for v in self.tests.values() for vv in v])
-
-        for t in tests:
-            t.duration = t.end_time - t.start_time
-            if t.status:
-                continue
-
-            t.ok = False
+        tests, self.tests = self.tests, None
+        self.ended = None
+        for t in tests.values():
+            self._spool(t)
+        self.tests = SpooledTests(self.spool)
+        self.test_to_group = None  # REMOVED
+        return self
 
-            t.missing_test_end = True
 
-        self.stats.total = len(tests)
-        # COUNT THE NUMBER OF EACH RESULT
-        for i, t in enumerate(tests):
-            try:
-                if t.status:
-                    self.stats.status[t.status.lower()] += 1
-            except Exception as e:
-                Log.warning("problem with key {{key}} on item {{i}}", key=self.source_key, i=i, cause=e)
-                break
+class SpooledTests(object):
+    """
+    ITERABLE OVER THE SPOOLED TESTS, IN THE ORDER THEY WERE FINISHED
+    """
+    def __init__(self, spool):
+        self.spool = spool
 
-        self.stats.ok = sum(1 for t in tests if t.ok)
-        self.test_to_group = None  # REMOVED
-        return self
+    def __iter__(self):
+        self.spool.seek(0)
+        for line in self.spool:
+            yield json2value(line.decode("utf8"))
 
 
 def fix_suite_property_name(k):
@@ -0,0 +1,112 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import division
+from __future__ import unicode_literals
+
+import random
+
+from activedata_etl.backfill import IdBitmap, get_all_in_es, get_max_in_es
+from mo_dots import Data, unwrap, wrap
+from mo_logs import Log
+from mo_testing.fuzzytestcase import FuzzyTestCase
+from mo_times.timer import Timer
+
+NUM_IDS = 1000000
+
+
+class TestBackfill(FuzzyTestCase):
+    """
+    FINDING THE ids MISSING FROM ES
+    """
+
+    def test_same_as_sets(self):
+        rand = random.Random(42)
+        for lo, hi, density in [(0, 1, 0), (0, 8, 1), (3, 70000, 0.5), (1000, 41000, 0.999), (5, 33000, 0.001)]:
+            present = set(i for i in range(lo, hi) if rand.random() < density)
+            bitmap = IdBitmap(lo, hi)
+            for i in present:
+                bitmap.add(i)
+            bitmap.add(hi)  # OUT OF RANGE IS IGNORED
+
+            expected = sorted(set(range(lo, hi)) - present, reverse=True)
+            result = [i for start, end in bitmap.missing() for i in reversed(range(start, end))]
+            self.assertEqual(result, expected)
+            self.assertEqual(len(bitmap), len(present))
+            self.assertEqual(bitmap.last(), max(present) if present else None)
+            self.assertTrue(all(i in bitmap for i in present))
+
+    def test_missing_ranges(self):
+        bitmap = IdBitmap(10, 100)
+        for i in list(range(10, 20)) + list(range(50, 90)):
+            bitmap.add(i)
+        self.assertEqual(list(bitmap.missing()), [(90, 100), (20, 50)])
+
+    def test_paged_es(self):
+        present = set(i for i in range(0, 250000) if i % 7)
+        esq = LocalES(present)
+        with Timer("fetch ids from es"):
+            in_es = get_all_in_es(esq, Data(min=1000, max=250000), None, "etl.id")
+        self.assertEqual(len(esq.queries), 3)  # [1000, 101000), [101000, 201000), [201000, 250000)
+        self.assertEqual(len(in_es), len([i for i in present if i >= 1000]))
+        self.assertEqual(next(in_es.missing()), (249998, 249999))
+        self.assertEqual(get_max_in_es(esq, Data(min=0, max=1000), None, "etl.id"), 999)
+
+    def test_speed(self):
+        rand = random.Random(42)
+        ids = [i for i in range(NUM_IDS) if rand.random() < 0.99]
+        with Timer("sets") as sets:
+            in_es = set(ids)
+            in_range = set(range(0, NUM_IDS))
+            in_es &= in_range
+            expected = max(in_range - in_es)
+        with Timer("bitmap") as bitmap:
+            in_es = IdBitmap(0, NUM_IDS)
+            in_es.extend(ids)
+            _, end = next(in_es.missing())
+        self.assertEqual(end - 1, expected)
+        Log.note(
+            "{{num}} ids: sets {{sets|round(places=3)}}sec, bitmap {{bitmap|round(places=3)}}sec in {{bytes|comma}} bytes",
+            num=NUM_IDS,
+            sets=sets.duration.seconds,
+            bitmap=bitmap.duration.seconds,
+            bytes=len(in_es.bits)
+        )
+
+
+class LocalES(object):
+    """
+    ANSWER THE edges, AND sort, QUERIES backfill SENDS, FROM A SET OF ids
+    """
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.queries = []
+        self.settings = wrap({"index": "test"})
+        self.es = Data(settings=self.settings)
+        self.settings.alias = "test"
+
+    def query(self, query):
+        query = wrap(query)
+        lo, hi = 0, None
+        for f in query.where["and"]:
+            f = unwrap(f)
+            if not isinstance(f, dict):
+                continue
+            if "gte" in f:
+                lo = f["gte"]["etl.id"]
+            if "lt" in f:
+                hi = f["lt"]["etl.id"]
+        found = sorted(i for i in self.ids if i >= lo and (hi is None or i < hi))
+        if query.sort:
+            return wrap({"data": list(reversed(found))[:query.limit]})
+        self.queries.append(query)
+        if len(found) > query.limit:
+            Log.error("window has more than {{limit}} ids", limit=query.limit)
+        return wrap({"data": [{"value": i} for i in found]})
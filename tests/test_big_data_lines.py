@@ -0,0 +1,167 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import division
+from __future__ import unicode_literals
+
+from io import BytesIO
+
+from mo_future import next
+from mo_http import big_data
+from mo_http.big_data import READ_SIZE, bytes2zip, get_decoder, ibytes2ilinelists, ibytes2ilines, icompressed2ibytes, sbytes2ilines, scompressed2ibytes
+from mo_logs import Log
+from mo_testing.fuzzytestcase import FuzzyTestCase
+from mo_times.timer import Timer
+
+NUM_LINES = 300000
+LONG_LINE = 4 * 1000 * 1000  # BYTES IN ONE JSON RECORD
+OLD_READ_SIZE = 4096
+
+
+class TestBigDataLines(FuzzyTestCase):
+    """
+    SPLITTING BYTE BLOCKS INTO LINES
+    """
+
+    def test_same_lines(self):
+        content = "first\n\nthird line, été ☃\nlast, with no newline".encode("utf8")
+        expected = content.decode("utf8").split("\n")
+        for size in [1, 2, 3, 7, 100]:
+            blocks = [content[i:i + size] for i in range(0, len(content), size)]
+            self.assertEqual(list(ibytes2ilines(iter(blocks))), expected)
+            self.assertEqual(list(ibytes2ilines(iter(blocks), encoding=None)), content.split(b"\n"))
+
+    def test_trailing_newline(self):
+        self.assertEqual(list(ibytes2ilines(iter([b"a\n", b"", b"b\n"]))), ["a", "b"])
+        self.assertEqual(list(ibytes2ilines(iter([b"a\n\n"]))), ["a", ""])
+        self.assertEqual(list(ibytes2ilines(iter([]))), [])
+
+    def test_flexible(self):
+        self.assertEqual(list(ibytes2ilines(iter([b"ok\nbad \xff\n"]), flexible=True)), ["ok", "bad "])
+
+    def test_lists(self):
+        lists = list(ibytes2ilinelists(iter([b"a\nb", b"c", b"d\ne\n", b"f"])))
+        self.assertEqual(lists, [["a"], ["bcd", "e"], ["f"]])
+
+    def test_closer(self):
+        closed = []
+        list(ibytes2ilines(iter([b"a\nb"]), closer=lambda: closed.append(True)))
+        self.assertEqual(closed, [True])
+
+    def test_streams(self):
+        content = "\n".join(_lines(1000)).encode("utf8")
+        self.assertEqual(list(sbytes2ilines(BytesIO(content))), _lines(1000))
+        self.assertEqual(list(ibytes2ilines(scompressed2ibytes(BytesIO(bytes2zip(content))))), _lines(1000))
+
+    def test_long_line_speed(self):
+        record = ('{"data":"' + "x" * LONG_LINE + '"}').encode("utf8")
+        content = record + b"\n" + record
+        with Timer("old") as old:
+            result = list(_old_ibytes2ilines(_blocks(content, OLD_READ_SIZE)))
+        with Timer("new") as new:
+            lines, decoded = _decoding(lambda: list(ibytes2ilines(_blocks(content, OLD_READ_SIZE))))
+        self.assertEqual(lines, result)
+        Log.note(
+            "two {{size|comma}} byte lines, in {{block}} byte blocks: old {{old|round(places=3)}}sec, new {{new|round(places=3)}}sec",
+            size=len(record),
+            block=OLD_READ_SIZE,
+            old=old.duration.seconds,
+            new=new.duration.seconds
+        )
+        # EACH LINE IS DECODED ONCE, AS ONE PIECE, NOT ONCE PER BLOCK
+        self.assertEqual(decoded, [len(record), len(record)])
+
+    def test_speed(self):
+        content = "\n".join(_lines(NUM_LINES)).encode("utf8")
+        compressed = bytes2zip(content)
+        for name, old_source, new_source in [
+            ("plain", lambda: _blocks(content, OLD_READ_SIZE), lambda: _blocks(content, READ_SIZE)),
+            ("gzip", lambda: icompressed2ibytes(_blocks(compressed, OLD_READ_SIZE)), lambda: icompressed2ibytes(_blocks(compressed, READ_SIZE)))
+        ]:
+            with Timer("old") as old:
+                old_count = sum(1 for _ in _old_ibytes2ilines(old_source()))
+            blocks = []
+            with Timer("new") as new:
+                new_count, decoded = _decoding(lambda: sum(1 for _ in ibytes2ilines(_counted(new_source(), blocks))))
+            self.assertEqual(new_count, old_count)
+            Log.note(
+                "{{name}}: old {{old|comma}} lines/sec, new {{new|comma}} lines/sec",
+                name=name,
+                old=int(NUM_LINES / old.duration.seconds),
+                new=int(NUM_LINES / new.duration.seconds)
+            )
+            # ONE DECODE PER BLOCK, NOT ONE PER LINE
+            self.assertLessEqual(len(decoded), len(blocks) + 1)
+            self.assertLessEqual(sum(decoded), len(content))  # EACH BYTE IS DECODED ONCE
+
+
+def _lines(num):
+    return ['{"id":' + str(i) + ',"name":"line ' + str(i) + '","value":' + str(i * 7 % 1000) + '}' for i in range(num)]
+
+
+def _decoding(run):
+    """
+    :return: (run() RESULT, SIZE OF EACH decode() DONE BY big_data)
+    """
+    decoded = []
+    get_decoder = big_data.get_decoder
+
+    def counted(*args, **kwargs):
+        decode = get_decoder(*args, **kwargs)
+        return lambda v: decoded.append(len(v)) or decode(v)
+
+    big_data.get_decoder = counted
+    try:
+        return run(), decoded
+    finally:
+        big_data.get_decoder = get_decoder
+
+
+def _counted(blocks, seen):
+    for b in blocks:
+        seen.append(len(b))
+        yield b
+
+
+def _blocks(content, size):
+    for i in range(0, len(content), size):
+        yield content[i:i + size]
+
+
+def _old_ibytes2ilines(generator, encoding="utf8", flexible=False, closer=None):
+    """
+    THE SPLITTER BEFORE bytearray, TO COMPARE WITH
+    """
+    decode = get_decoder(encoding=encoding, flexible=flexible)
+    try:
+        _buffer = next(generator)
+    except StopIteration:
+        return
+
+    s = 0
+    e = _buffer.find(b"\n")
+    while True:
+        while e == -1:
+            try:
+                next_block = next(generator)
+                _buffer = _buffer[s:] + next_block
+                s = 0
+                e = _buffer.find(b"\n")
+            except StopIteration:
+                _buffer = _buffer[s:]
+                del generator
+                if closer:
+                    closer()
+                if _buffer:
+                    yield decode(_buffer)
+                return
+
+        yield decode(_buffer[s:e])
+        s = e + 1
+        e = _buffer.find(b"\n", s)
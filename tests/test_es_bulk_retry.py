@@ -0,0 +1,222 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import division
+from __future__ import unicode_literals
+
+import time
+
+from jx_elasticsearch import elasticsearch
+from jx_elasticsearch.elasticsearch import ID, BulkSize, Index, IterableBytes, bulk_stats, get_encoder
+from mo_dots import wrap
+from mo_future import text
+from mo_json import CAN_NOT_DECODE_JSON, json2value, value2json
+from mo_logs import Except, Log
+from mo_testing.fuzzytestcase import FuzzyTestCase
+from mo_threads import Lock, Till
+from mo_threads.queues import ThreadedQueue
+from mo_times.timer import Timer
+
+NUM_DOCS = 5000
+BANDWIDTH = 20 * 1000 * 1000  # BYTES PER SECOND TO THE CLUSTER
+BULK_LATENCY = 0.01  # SECONDS PER BULK REQUEST
+REJECTED = {"type": "es_rejected_execution_exception", "reason": "rejected execution of coordinating operation"}
+NOT_PARSED = {"type": "mapper_parsing_exception", "reason": "failed to parse [run.timestamp]"}
+
+
+class TestEsBulkRetry(FuzzyTestCase):
+    """
+    Index.extend() AGAINST A CLUSTER THAT REJECTS SOME ITEMS OF EACH BULK
+    """
+
+    def setUp(self):
+        self.sleep, elasticsearch.BULK_RETRY_SLEEP = elasticsearch.BULK_RETRY_SLEEP, 0.01
+
+    def tearDown(self):
+        elasticsearch.BULK_RETRY_SLEEP = self.sleep
+
+    def test_only_rejected_are_sent_again(self):
+        cluster = LocalCluster(rejections={"3": 2, "7": 1})
+        index = _index(cluster, "test_only_rejected_are_sent_again")
+        index.extend(_records(100))
+
+        self.assertEqual([len(b) for b in cluster.bulks], [100, 2, 1])
+        self.assertEqual(cluster.bulks[1:], [["3", "7"], ["3"]])
+        self.assertEqual(len(cluster.docs), 100)
+        self.assertEqual(index.encoded, 100)  # NOTHING ENCODED TWICE
+        self.assertEqual(cluster.docs["3"], {"etl": {"id": 3}})
+        self.assertEqual(bulk_stats()["test_only_rejected_are_sent_again"], {
+            "bulks": 3,
+            "docs": 103,
+            "retried_docs": 3,
+            "failed_docs": 0,
+            "rejected": 2,
+            "item_errors": {"es_rejected_execution_exception": 3}
+        })
+
+    def test_bad_items_are_not_sent_again(self):
+        cluster = LocalCluster(rejections={"2": 1}, bad={"5"})
+        index = _index(cluster, "test_bad_items_are_not_sent_again")
+        try:
+            index.extend(_records(10))
+            self.assertTrue(False, "expecting error")
+        except Exception as e:
+            e = Except.wrap(e)
+            self.assertEqual(e.params.failed, [5])
+            self.assertIn("mapper_parsing_exception", e)
+        self.assertEqual(cluster.bulks[1:], [["2"]])
+        self.assertEqual(len(cluster.docs), 9)
+        self.assertEqual(bulk_stats()["test_bad_items_are_not_sent_again"], {"retried_docs": 1, "failed_docs": 1})
+
+    def test_give_up(self):
+        cluster = LocalCluster(rejections={"4": 100})
+        index = _index(cluster, "test_give_up")
+        try:
+            index.extend(_records(10))
+            self.assertTrue(False, "expecting error")
+        except Exception as e:
+            self.assertEqual(Except.wrap(e).params.failed, [4])
+        self.assertEqual(len(cluster.bulks), elasticsearch.BULK_RETRIES + 1)
+        self.assertEqual(bulk_stats()["test_give_up"], {"retried_docs": elasticsearch.BULK_RETRIES, "failed_docs": 1})
+
+    def test_queue_keeps_only_failed(self):
+        cluster = LocalCluster(rejections={"7": elasticsearch.BULK_RETRIES + 1})
+        index = _index(cluster, "test_queue_keeps_only_failed")
+        queue = ThreadedQueue("test", index, batch_size=50, max_size=1000, period=0.1, silent=True)
+        for r in _records(100):
+            queue.add(r)
+        queue.stop()
+
+        self.assertEqual(len(cluster.docs), 100)
+        self.assertEqual(cluster.sent["7"], elasticsearch.BULK_RETRIES + 2)
+        self.assertEqual(sum(cluster.sent.values()), 100 + elasticsearch.BULK_RETRIES + 1)  # NO GOOD RECORD IS SENT AGAIN
+
+    def test_undecodable_record(self):
+        cluster = LocalCluster(rejections={"2": 1})
+        index = _index(cluster, "test_undecodable_record")
+        encode = index.encode
+
+        def strict_encode(r):
+            if r["json"] == "{not json":
+                Log.error(CAN_NOT_DECODE_JSON)
+            return encode(r)
+
+        index.encode = strict_encode
+        records = _records(4)
+        records[1] = {"json": "{not json"}
+        index.extend(records)  # THE RECORD IS SKIPPED, THE REST LINE UP WITH THEIR ITEMS
+        self.assertEqual(cluster.bulks, [["0", "2", "3"], ["2"]])
+
+    def test_bytes_replayed(self):
+        encoded = []
+        data = IterableBytes(lambda r: encoded.append(r) or ("a", None, "{}"), [{"value": {}}])
+        self.assertEqual(b"".join(data), b"".join(data))
+        self.assertEqual(len(encoded), 1)
+        self.assertEqual(data.num_bytes, len(b"".join(data)))
+
+    def test_speed(self):
+        # ES IS BUSY: ONE IN TEN ITEMS IS REJECTED THE FIRST TIME IT IS SEEN
+        records = _records(NUM_DOCS)
+        rejections = {text(i): 1 for i in range(0, NUM_DOCS, 10)}
+
+        whole = LocalCluster(rejections=dict(rejections))
+        index = _index(whole, "test_speed_whole")
+        with Timer("send the whole bulk again") as resend_all:
+            _old_extend(index, records)
+
+        partial = LocalCluster(rejections=dict(rejections))
+        index = _index(partial, "test_speed_partial")
+        with Timer("send the rejected items again") as resend_failed:
+            index.extend(records)
+
+        self.assertEqual(len(whole.docs), NUM_DOCS)
+        self.assertEqual(len(partial.docs), NUM_DOCS)
+        Log.note(
+            "{{num}} docs, 10% rejected: whole bulk again {{whole|round(places=3)}}sec ({{whole_bytes|comma}} bytes), rejected only {{partial|round(places=3)}}sec ({{partial_bytes|comma}} bytes)",
+            num=NUM_DOCS,
+            whole=resend_all.duration.seconds,
+            whole_bytes=whole.bytes,
+            partial=resend_failed.duration.seconds,
+            partial_bytes=partial.bytes
+        )
+        self.assertLess(partial.bytes, whole.bytes)
+        self.assertEqual(sum(whole.sent.values()), 2 * NUM_DOCS)
+        self.assertEqual(sum(partial.sent.values()), NUM_DOCS + len(rejections))  # ONLY THE REJECTED ARE SENT AGAIN
+
+
+def _records(num):
+    return [{"json": value2json({"_id": text(i), "etl": {"id": i}})} for i in range(num)]
+
+
+def _index(cluster, name):
+    index = Index.__new__(Index)
+    index.settings = wrap({"index": name, "read_only": False, "consistency": "one"})
+    index.debug = False
+    index.cluster = cluster
+    index.path = "/" + name + "/test"
+    index.bulk_size = BulkSize(name)
+    index.encoded = 0
+    encode = get_encoder(ID)
+
+    def counting_encode(r):
+        index.encoded += 1
+        return encode(r)
+
+    index.encode = counting_encode
+    return index
+
+
+def _old_extend(index, records):
+    """
+    WHAT THE ThreadedQueue DID BEFORE: ENCODE AND SEND THE WHOLE BULK, UNTIL ALL ITEMS ARE INDEXED
+    """
+    while True:
+        items = index.cluster.post(index.path + "/_bulk", data=IterableBytes(index.encode, records))["items"]
+        if all(item.index.status in [200, 201] for item in items):
+            return
+        Till(seconds=elasticsearch.BULK_RETRY_SLEEP).wait()
+
+
+class LocalCluster(object):
+    """
+    ANSWER _bulk REQUESTS, REJECTING THE GIVEN ids A NUMBER OF TIMES, AND NEVER ACCEPTING THE bad ONES
+    """
+
+    def __init__(self, rejections=None, bad=()):
+        self.version = "6.2.4"
+        self.locker = Lock()
+        self.rejections = rejections or {}  # MAP FROM id TO TIMES IT WILL BE REJECTED
+        self.bad = bad
+        self.docs = {}
+        self.bulks = []  # ids IN EACH BULK
+        self.sent = {}  # MAP FROM id TO TIMES IT WAS SENT
+        self.bytes = 0
+
+    def post(self, path, data=None, **kwargs):
+        content = b"".join(data)
+        time.sleep(BULK_LATENCY + len(content) / BANDWIDTH)
+        lines = content.decode("utf8").split("\n")
+        items = []
+        ids = []
+        with self.locker:
+            self.bytes += len(content)
+            for action, doc in zip(lines[0::2], lines[1::2]):
+                id = json2value(action)["index"]["_id"]
+                ids.append(id)
+                self.sent[id] = self.sent.get(id, 0) + 1
+                if id in self.bad:
+                    items.append({"index": {"_id": id, "status": 400, "error": NOT_PARSED}})
+                elif self.rejections.get(id, 0):
+                    self.rejections[id] -= 1
+                    items.append({"index": {"_id": id, "status": 429, "error": REJECTED}})
+                else:
+                    self.docs[id] = json2value(doc)
+                    items.append({"index": {"_id": id, "status": 201}})
+            self.bulks.append(ids)
+        return wrap({"items": items})
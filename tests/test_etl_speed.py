@@ -9,14 +9,25 @@
 #
 from __future__ import unicode_literals
 from __future__ import division
+
+import resource
+import time
+
+from mo_future import text
+from mo_json import json2value, value2json
 from mo_logs import Log
-from mo_dots import Data
+from mo_dots import Data, coalesce
 from mo_http.big_data import GzipLines
 from mo_files import File
 from mo_testing.fuzzytestcase import FuzzyTestCase
+from mo_threads import Lock
 from mo_times.timer import Timer
+from activedata_etl.etl import ConcatSources
 from activedata_etl.transforms import get_test_result_content
-from activedata_etl.transforms.unittest_logs_to_sink import process_unittest_in_s3
+from activedata_etl.transforms.unittest_logs_to_sink import process_unittest_in_s3, process_unittest
+
+LATENCY = 0.05  # SECONDS TO DOWNLOAD ONE KEY
+locker = Lock()
 
 
 class TestEtlSpeed(FuzzyTestCase):
@@ -59,6 +70,92 @@ class TestEtlSpeed(FuzzyTestCase):
         )
         Log.stop()
 
+    def test_unittest_memory(self):
+        content = File("tests/resources/51586_5124145.52.json.gz").read_bytes()
+        lines = iter(GzipLines(content))
+        etl_header = json2value(next(lines).decode("utf8")).etl
+        next(lines)  # BUILDBOT SUMMARY
+        num_bytes = Data(total=0)
+
+        def log_lines():
+            for line in lines:
+                num_bytes.total += len(line) + 1
+                yield line.decode("utf8")
+
+        destination = CountingSink()
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        with Timer("ETL structured log") as timer:
+            keys = process_unittest(
+                "51586.52",
+                etl_header,
+                Data(run={"suite": {"name": "mochitest"}}),
+                log_lines(),
+                destination
+            )
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        Log.note(
+            "{{tests}} tests from {{mb|round(places=3)}}MB at {{rate|round(places=3)}}MB/sec, peak memory grew {{growth|comma}}KB",
+            tests=destination.count,
+            mb=num_bytes.total / 1000000,
+            rate=num_bytes.total / 1000000 / timer.duration.seconds,
+            growth=after - before
+        )
+        self.assertEqual(destination.count, len(keys))
+
+    def test_concat_sources(self):
+        active = Data(now=0, max=0)
+        sources = [SlowSource(k, active) for k in range(16)]
+        with Timer("serial fetch") as serial:
+            expected = [line for s in sources for line in s.read_lines()]
+        with Timer("parallel fetch") as parallel:
+            result = list(ConcatSources(sources, num_threads=8).read_lines())
+
+        Log.note(
+            "{{num}} keys in {{serial|round(places=3)}}sec serially, {{parallel|round(places=3)}}sec in parallel",
+            num=len(sources),
+            serial=serial.duration.seconds,
+            parallel=parallel.duration.seconds
+        )
+        self.assertEqual(result, expected)
+        self.assertGreater(active.max, 1)  # KEYS WERE DOWNLOADED AT THE SAME TIME
+        self.assertEqual(ConcatSources(sources[:2]).read(), "0:0\n0:1\n0:2\n1:0\n1:1\n1:2")
+
+
+class SlowSource(object):
+    """
+    AN S3 KEY WITH DOWNLOAD LATENCY
+    """
+
+    def __init__(self, key, active=None):
+        self.key = key
+        self.active = coalesce(active, Data(now=0, max=0))  # DOWNLOADS IN PROGRESS, OVER ALL SOURCES
+
+    def read(self):
+        return "\n".join(self.read_lines())
+
+    def read_lines(self):
+        with locker:
+            self.active.now += 1
+            self.active.max = max(self.active.max, self.active.now)
+        time.sleep(LATENCY)
+        with locker:
+            self.active.now -= 1
+        return [text(self.key) + ":" + text(i) for i in range(3)]
+
+
+class CountingSink(object):
+    """
+    CONSUME RECORDS ONE AT A TIME, LIKE A STREAMING SINK
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def extend(self, values):
+        for v in values:
+            value2json(v)
+            self.count += 1
 
 
 class Accumulator(object):
@@ -0,0 +1,85 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import division
+from __future__ import unicode_literals
+
+from mo_dots import wrap
+from mo_files import TempDirectory
+from mo_hg import disk_cache
+from mo_hg.disk_cache import DiskCache
+from mo_testing.fuzzytestcase import FuzzyTestCase
+from mo_times import Date
+
+
+class TestHgDiskCache(FuzzyTestCase):
+
+    def setUp(self):
+        self.temp = TempDirectory()
+        self.filename = (self.temp / "hg_cache.sqlite").abspath
+
+    def tearDown(self):
+        self.temp.__exit__(None, None, None)
+
+    def test_warm_restart(self):
+        first = DiskCache(filename=self.filename)
+        first.set_revision("mozilla-central", "en-US", _revision("abcdef0123456789", diff=True), True, True)
+        first.set_push("mozilla-central", "abcdef0123456789", wrap({"id": 42, "date": Date.now().unix}))
+        first.close()
+
+        # A NEW PROCESS ON THE SAME HOST SEES THE SAME DOCUMENTS
+        second = DiskCache(filename=self.filename)
+        rev = second.get_revision("mozilla-central", "en-US", "abcdef012345", False, True)
+        self.assertEqual(rev.changeset.id, "abcdef0123456789")
+        self.assertEqual(rev.changeset.diff, None)
+        self.assertEqual(rev.changeset.moves, [{"old": "a", "new": "b"}])
+        with_diff = second.get_revision("mozilla-central", "en-US", "abcdef012345", True, True)
+        self.assertEqual(with_diff.changeset.diff, [{"new": {"name": "a"}}])
+        self.assertEqual(second.get_push("mozilla-central", "abcdef012345").id, 42)
+        self.assertEqual(second.stats.hits, 3)
+        second.close()
+
+    def test_missing_variant(self):
+        cache = DiskCache(filename=self.filename)
+        cache.set_revision("mozilla-central", "en-US", _revision("0123456789ab", diff=False), False, True)
+        self.assertEqual(cache.get_revision("mozilla-central", "en-US", "0123456789ab", True, True), None)
+        self.assertEqual(cache.get_revision("try", "en-US", "0123456789ab", False, True), None)
+        self.assertEqual(cache.stats.misses, 2)
+        cache.close()
+
+    def test_eviction(self):
+        cache = DiskCache(filename=self.filename, max_entries=10)
+        for i in range(disk_cache.EVICT_INTERVAL):
+            cache.set_revision("mozilla-central", "en-US", _revision("%012d" % i, diff=False), False, True)
+        self.assertEqual(cache.stats.evicted, disk_cache.EVICT_INTERVAL - 10)
+        self.assertEqual(cache.get_revision("mozilla-central", "en-US", "%012d" % 0, False, True), None)
+        self.assertNotEqual(
+            cache.get_revision("mozilla-central", "en-US", "%012d" % (disk_cache.EVICT_INTERVAL - 1), False, True),
+            None
+        )
+        cache.close()
+
+    def test_content_is_blob(self):
+        cache = DiskCache(filename=self.filename)
+        cache.set_push("mozilla-central", "abcdef0123456789", wrap({"id": 42}))
+        self.assertEqual(cache.db.query("SELECT typeof(content) FROM push").data[0][0], "blob")
+        cache.close()
+
+
+def _revision(changeset_id, diff):
+    return wrap({
+        "branch": {"name": "mozilla-central", "locale": "en-US"},
+        "changeset": {
+            "id": changeset_id,
+            "id12": changeset_id[:12],
+            "diff": [{"new": {"name": "a"}}] if diff else None,
+            "moves": [{"old": "a", "new": "b"}]
+        },
+        "push": {"id": 42, "date": Date.now().unix}
+    })
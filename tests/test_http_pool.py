@@ -0,0 +1,179 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import division
+from __future__ import unicode_literals
+
+import time
+from contextlib import closing
+
+from mo_http import http
+from mo_http.http import SessionPool
+from mo_logs import Log
+from mo_testing.fuzzytestcase import FuzzyTestCase
+from mo_threads import Thread
+from mo_times.timer import Timer
+from requests import sessions
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+NUM_REQUESTS = 200
+CONNECT_LATENCY = 0.01  # SECONDS TO SET UP A CONNECTION, LIKE A TLS HANDSHAKE
+LATENCY = 0.02  # SECONDS PER /slow REQUEST
+
+
+class TestHttpPool(FuzzyTestCase):
+    """
+    mo_http.http.request() WITH NO session USES THE PROCESS-WIDE SessionPool
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalServer(("localhost", 0), Handler)
+        cls.thread = Thread.run("local http server", cls.server.serve)
+        cls.port = str(cls.server.server_address[1])
+        cls.url = "http://localhost:" + cls.port
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.thread.join()
+
+    def setUp(self):
+        self.pool = http.pool
+        self.server.connections = 0
+        self.server.max_active = 0
+
+    def tearDown(self):
+        http.pool.close()
+        http.pool = self.pool
+
+    def test_reuse(self):
+        http.pool = SessionPool()
+        for i in range(20):
+            self.assertEqual(http.get(self.url + "/" + str(i)).all_content, str(i).encode("utf8"))
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(http.pool.stats(), {"hosts": 1, "requests": 20, "connections": 1, "reused": 19, "waits": 0, "evicted": 0})
+
+    def test_hosts(self):
+        http.pool = SessionPool()
+        for host in ["localhost", "127.0.0.1", "LOCALHOST", "localhost"]:
+            http.get("http://" + host + ":" + self.port + "/a").all_content
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(http.pool.stats(), {"hosts": 2, "requests": 4, "connections": 2, "reused": 2})
+
+    def test_limit(self):
+        http.pool = SessionPool(max_per_host=2)
+
+        def fetch(please_stop):
+            for i in range(3):
+                http.get(self.url + "/slow").all_content
+
+        threads = [Thread.run("fetch " + str(t), fetch) for t in range(6)]
+        for t in threads:
+            t.join()
+        stats = http.pool.stats()
+        self.assertEqual(self.server.max_active, 2)
+        self.assertEqual(stats.requests, 18)
+        self.assertGreater(stats.waits, 0)
+
+    def test_idle(self):
+        http.pool = SessionPool(idle=0)
+        http.get(self.url + "/a").all_content
+        time.sleep(0.01)
+        http.get(self.url + "/b").all_content
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(http.pool.stats(), {"hosts": 1, "requests": 2, "connections": 2, "reused": 0, "evicted": 1})
+
+    def test_no_cookies(self):
+        http.pool = SessionPool()
+        http.get(self.url + "/cookie").all_content
+        http.get(self.url + "/a").all_content
+        self.assertEqual(self.server.cookies, [])
+
+    def test_given_session(self):
+        http.pool = SessionPool()
+        with closing(sessions.Session()) as session:
+            http.get(self.url + "/a", session=session).all_content
+        self.assertEqual(http.pool.stats().requests, 0)
+
+    def test_speed(self):
+        with Timer("new session per request") as separate:
+            for i in range(NUM_REQUESTS):
+                with closing(sessions.Session()) as session:
+                    http.get(self.url + "/a", session=session).all_content
+        separate_connections = self.server.connections
+
+        self.server.connections = 0
+        http.pool = SessionPool()
+        with Timer("pooled sessions") as pooled:
+            for i in range(NUM_REQUESTS):
+                http.get(self.url + "/a").all_content
+
+        self.assertEqual(separate_connections, NUM_REQUESTS)
+        self.assertEqual(self.server.connections, 1)
+        Log.note(
+            "{{num}} requests: new session per request {{separate|round(places=3)}}sec, pooled {{pooled|round(places=3)}}sec, stats {{stats|json}}",
+            num=NUM_REQUESTS,
+            separate=separate.duration.seconds,
+            pooled=pooled.duration.seconds,
+            stats=http.pool.stats()
+        )
+        self.assertEqual(http.pool.stats(), {"requests": NUM_REQUESTS, "connections": 1, "reused": NUM_REQUESTS - 1})
+
+
+class LocalServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    connections = 0
+    active = 0
+    max_active = 0
+    cookies = []
+
+    def serve(self, please_stop):
+        self.serve_forever(poll_interval=0.1)
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    ANSWER WITH THE PATH, KEEPING THE CONNECTION OPEN FOR MORE REQUESTS
+    """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # HEADERS AND BODY ARE SEPARATE WRITES
+
+    def setup(self):
+        self.server.connections += 1
+        time.sleep(CONNECT_LATENCY)
+        BaseHTTPRequestHandler.setup(self)
+
+    def do_GET(self):
+        server = self.server
+        server.active += 1
+        server.max_active = max(server.max_active, server.active)
+        try:
+            if self.headers.get("Cookie"):
+                server.cookies.append(self.headers.get("Cookie"))
+            if self.path == "/slow":
+                time.sleep(LATENCY)
+            content = self.path[1:].encode("utf8")
+            self.send_response(200)
+            if self.path == "/cookie":
+                self.send_header("Set-Cookie", "session=1; Path=/")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        finally:
+            server.active -= 1
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,134 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import division
+from __future__ import unicode_literals
+
+from activedata_etl.imports import parse_lcov
+from activedata_etl.imports.parse_lcov import parse_lcov_coverage
+from mo_logs import Log
+from mo_testing.fuzzytestcase import FuzzyTestCase
+from mo_times.timer import Timer
+
+NUM_FILES = 2000
+LINES_PER_FILE = 1000
+
+SAMPLE = """TN:
+SF:/builds/worker/workspace/build/src/dom/base/Element.cpp
+FN:10,_ZN7mozilla3dom7Element4InitEv
+FN:40,_ZN7mozilla3dom7Element4KillEv
+FNDA:3,_ZN7mozilla3dom7Element4InitEv
+FNDA:0,_ZN7mozilla3dom7Element4KillEv
+FNF:2
+FNH:1
+DA:10,3
+DA:11,3
+DA:12,0
+DA:40,0
+DA:41,0,AbCdEf
+DA:11,3
+DA:13,-1
+BRDA:11,0,0,2
+BRDA:11,0,1,-
+BRF:2
+BRH:1
+LF:6
+LH:2
+end_of_record
+SF:/builds/worker/workspace/build/src/dom/base/Empty.cpp
+DA:1,0
+end_of_record
+"""
+
+
+class TestLcovSpeed(FuzzyTestCase):
+    """
+    parse_lcov_coverage() ON A LARGE, STREAMED, lcov FILE
+    """
+
+    def test_sample(self):
+        result = list(parse_lcov_coverage("key", "sample", SAMPLE.split("\n")))
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result[0], {
+            "language": ["c/c++"],
+            "is_file": True,
+            "file": {
+                "name": "/builds/worker/workspace/build/src/dom/base/Element.cpp",
+                "covered": [10, 11],
+                "uncovered": [12, 13, 40, 41],
+                "total_covered": 2,
+                "total_uncovered": 4,
+                "percentage_covered": 2 / 6
+            }
+        })
+        self.assertEqual(result[1].file.covered, [])
+
+    def test_line_endings(self):
+        # LINES READ FROM A FILE STILL HAVE THEIR \n
+        result = list(parse_lcov_coverage("key", "sample", [l + "\n" for l in SAMPLE.split("\n")]))
+        self.assertEqual(result[0].file.name, "/builds/worker/workspace/build/src/dom/base/Element.cpp")
+        self.assertEqual(result[0].file.uncovered, [12, 13, 40, 41])
+
+    def test_zero_coverage(self):
+        old, parse_lcov.EMIT_RECORDS_WITH_ZERO_COVERAGE = parse_lcov.EMIT_RECORDS_WITH_ZERO_COVERAGE, False
+        try:
+            result = list(parse_lcov_coverage("key", "sample", SAMPLE.split("\n")))
+        finally:
+            parse_lcov.EMIT_RECORDS_WITH_ZERO_COVERAGE = old
+        self.assertEqual(len(result), 1)
+
+    def test_speed(self):
+        stream = _lcov_stream(NUM_FILES, LINES_PER_FILE)
+        count = 0
+        with Timer("parse lcov") as timer:
+            for source in parse_lcov_coverage("key", "synthetic", stream):
+                if count % 97 == 0:
+                    self.assertEqual(source.file.covered, _covered(count, LINES_PER_FILE))
+                count += 1
+        self.assertEqual(count, NUM_FILES)
+        Log.note(
+            "{{mb|round(places=3)}}MB of lcov in {{duration|round(places=3)}}sec: {{rate|round(places=3)}}MB/sec",
+            mb=stream.bytes / 1000000,
+            duration=timer.duration.seconds,
+            rate=stream.bytes / 1000000 / timer.duration.seconds
+        )
+
+
+def _covered(f, num_lines):
+    return [i for i in range(1, num_lines + 1) if (i * 7 + f) % 3]
+
+
+class _lcov_stream(object):
+    """
+    GENERATE lcov LINES AS THEY ARE READ; NOTHING IS HELD IN MEMORY
+    """
+
+    def __init__(self, num_files, num_lines):
+        self.num_files = num_files
+        self.num_lines = num_lines
+        self.bytes = 0
+
+    def __iter__(self):
+        for line in self._lines():
+            self.bytes += len(line) + 1
+            yield line
+
+    def _lines(self):
+        for f in range(self.num_files):
+            yield "TN:"
+            yield "SF:/builds/worker/workspace/build/src/dom/file_" + str(f) + ".cpp"
+            for i in range(1, self.num_lines, 50):
+                yield "FN:" + str(i) + ",_ZN7mozilla3dom4func" + str(i) + "Ev"
+                yield "FNDA:" + str(i % 4) + ",_ZN7mozilla3dom4func" + str(i) + "Ev"
+            for i in range(1, self.num_lines + 1):
+                yield "DA:" + str(i) + "," + (str(i % 13 + 1) if (i * 7 + f) % 3 else "0")
+                if i % 10 == 0:
+                    yield "BRDA:" + str(i) + ",0,0,-"
+            yield "LF:" + str(self.num_lines)
+            yield "end_of_record"
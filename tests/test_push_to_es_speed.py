@@ -0,0 +1,251 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import division
+from __future__ import unicode_literals
+
+import time
+
+from jx_elasticsearch import elasticsearch, rollover_index
+from jx_elasticsearch.elasticsearch import ID, TARGET_BULK_SECONDS, BulkSize, bulk_stats, get_encoder
+from jx_elasticsearch.rollover_index import RolloverIndex, fix
+from jx_elasticsearch.typed_inserter import TypedInserter
+from mo_dots import wrap
+from mo_future import text
+from mo_json import json2value, value2json
+from mo_logs import Except, Log
+from mo_testing.fuzzytestcase import FuzzyTestCase
+from mo_threads import Lock, THREAD_STOP, Thread
+from mo_threads.queues import ThreadedQueue
+from mo_times.timer import Timer
+
+NUM_KEYS = 40
+DOCS_PER_KEY = 200
+S3_LATENCY = 0.02  # SECONDS TO DOWNLOAD ONE KEY
+BULK_LATENCY = 0.01  # SECONDS PER BULK REQUEST
+
+
+class TestPushToEsSpeed(FuzzyTestCase):
+    """
+    MEASURE RolloverIndex.copy() AGAINST A LOCAL S3 AND ES STAND-IN
+    """
+
+    def test_copy_speed(self):
+        single = self._run(readers=1)
+        parallel = self._run(readers=8)
+        Log.note(
+            "1 reader: {{single.key_rate|round(places=3)}} keys/sec, {{single.doc_rate|round(places=3)}} docs/sec; "
+            "8 readers: {{parallel.key_rate|round(places=3)}} keys/sec, {{parallel.doc_rate|round(places=3)}} docs/sec",
+            single=single,
+            parallel=parallel
+        )
+        self.assertEqual(single.max_reads, 1)
+        self.assertGreater(parallel.max_reads, 1)  # KEYS WERE READ AT THE SAME TIME
+
+    def test_bad_key_does_not_confirm(self):
+        es = LocalRolloverIndex(readers=4)
+        source = LocalBucket(bad_keys={"3"})
+        confirmed = []
+        es.copy([text(k) for k in range(8)], source, done_copy=lambda: confirmed.append(True))
+        es.close()
+        self.assertEqual(confirmed, [])
+        self.assertEqual(es.index.count, 7 * DOCS_PER_KEY)
+
+    def test_pass_through(self):
+        encode = get_encoder(ID)
+        self.assertEqual(encode({"json": '{"_id":"a.1","etl":{"id":1}}'}), ("a.1", None, '{"etl":{"id":1}}'))
+        self.assertEqual(encode({"json": '{"_id":"a\\"2"}'}), ('a"2', None, '{}'))
+        # _id NOT FIRST, SO DECODE
+        self.assertEqual(encode({"json": '{"A":1,"_id":"a.3"}'}), ("a.3", None, '{"A":1}'))
+
+        line = '{"_id":"a.4","build":{"revision":"0123456789abcdef"},"run":{"timestamp":1500000000}}'
+        row, _ = fix("a", 1, line, LocalBucket(), None, None)
+        self.assertEqual(row, {"json": line})
+
+        typed = TypedInserter(None, ID)
+        self.assertEqual(typed.typed_encode(row), typed.typed_encode({"value": json2value(line)}))
+
+    def test_typed_decoded_by_readers(self):
+        es = LocalRolloverIndex(readers=4, typed=True)
+        threads = []
+        decode = rollover_index.json2value
+        rollover_index.json2value = lambda *a, **k: threads.append(Thread.current().name) or decode(*a, **k)
+        try:
+            es.copy([text(k) for k in range(4)], LocalBucket())
+            es.close()
+        finally:
+            rollover_index.json2value = decode
+        self.assertEqual(es.index.count, 4 * DOCS_PER_KEY)
+        self.assertEqual(es.index.json, 0)  # THE WRITER IS NOT LEFT TO DECODE
+        self.assertEqual(len(threads), 4 * DOCS_PER_KEY)
+        self.assertTrue(all(t.startswith("read from ") for t in threads))
+
+    def test_encode_speed(self):
+        encode = get_encoder(ID)
+        lines = LocalBucket().read_lines("0") * 50
+
+        with Timer("decode and encode") as decoded:
+            for line in lines:
+                encode({"value": json2value(line)})
+
+        # COUNT THE DECODES AND ENCODES DONE BY THE ENCODER
+        calls = []
+        originals = elasticsearch.json2value, elasticsearch.value2json
+        elasticsearch.json2value = lambda v, *a, **k: calls.append(v) or originals[0](v, *a, **k)
+        elasticsearch.value2json = lambda v, *a, **k: calls.append(v) or originals[1](v, *a, **k)
+        try:
+            with Timer("pass through") as passed:
+                for line in lines:
+                    encode({"json": line})
+        finally:
+            elasticsearch.json2value, elasticsearch.value2json = originals
+
+        Log.note(
+            "decode/encode {{slow|round(places=3)}} docs/sec, pass-through {{fast|round(places=3)}} docs/sec",
+            slow=len(lines) / decoded.duration.seconds,
+            fast=len(lines) / passed.duration.seconds
+        )
+        self.assertEqual(calls, [])  # PASSED THROUGH WITHOUT DECODING
+
+    def test_batch_by_bytes(self):
+        index = LocalIndex()
+        queue = ThreadedQueue(
+            "test", index, batch_size=1000, max_size=2000, silent=True,
+            batch_bytes=10000, item_size=lambda r: len(r["json"])
+        )
+        for i in range(100):
+            queue.add({"json": "x" * (100 if i < 50 else 1000)})
+        queue.stop()
+        self.assertEqual(index.count, 100)
+        self.assertLessEqual(max(index.sizes), 100)
+        self.assertGreaterEqual(len(index.sizes), 5)  # 50 BIG ITEMS NEED AT LEAST 5 BATCHES
+
+    def test_hopeless_batch_keeps_tail(self):
+        index = LocalIndex(fail_batches=1)
+        given = []
+
+        def errors(e, _buffer):
+            # LIKE Index.threaded_queue() ON A HOPELESS ERROR
+            given.append(len(_buffer))
+            del _buffer[:]
+
+        queue = ThreadedQueue(
+            "test", index, batch_size=1000, max_size=2000, silent=True, error_target=errors,
+            batch_bytes=1000, item_size=lambda r: len(r["json"])
+        )
+        for i in range(50):
+            queue.add({"json": "x" * 100})
+        queue.stop()
+        self.assertEqual(given, [10])  # ONLY THE FAILED BATCH IS GIVEN UP
+        self.assertEqual(index.count, 40)
+
+    def test_bulk_size_adapts(self):
+        size = BulkSize("test_bulk_size_adapts")
+        start = size.batch_bytes
+        size.success(1000, start, 0.5)
+        self.assertGreater(size.batch_bytes, start)
+
+        grown = size.batch_bytes
+        size.failure(1000, grown, 2, Except(template="429 EsRejectedExecutionException"))
+        self.assertLess(size.batch_bytes, grown)
+        self.assertEqual(bulk_stats()["test_bulk_size_adapts"]["rejected"], 1)
+
+        shrunk = size.batch_bytes
+        size.success(1000, shrunk, TARGET_BULK_SECONDS * 2)
+        self.assertLess(size.batch_bytes, shrunk)
+        self.assertEqual(size.item_size({"json": "abc"}), 3)
+
+    def _run(self, readers):
+        es = LocalRolloverIndex(readers=readers)
+        source = LocalBucket()
+        confirmed = []
+        with Timer("copy with {{num}} readers", {"num": readers}) as timer:
+            num = es.copy([text(k) for k in range(NUM_KEYS)], source, done_copy=lambda: confirmed.append(True))
+            es.close()
+
+        self.assertEqual(num, NUM_KEYS * DOCS_PER_KEY)
+        self.assertEqual(es.index.count, NUM_KEYS * DOCS_PER_KEY)
+        self.assertEqual(confirmed, [True])
+        return wrap({
+            "key_rate": NUM_KEYS / timer.duration.seconds,
+            "doc_rate": es.index.count / timer.duration.seconds,
+            "max_reads": source.max_reads
+        })
+
+
+class LocalRolloverIndex(RolloverIndex):
+    """
+    RolloverIndex WITH ONE IN-PROCESS INDEX, SO NO CLUSTER IS NEEDED
+    """
+
+    def __init__(self, readers, typed=False):
+        self.settings = wrap({"index": "test", "readers": readers, "typed": typed})
+        self.index = LocalIndex()
+        self.queue = ThreadedQueue("test", self.index, batch_size=500, max_size=1000, silent=True)
+
+    def _get_queue(self, row):
+        return self.queue
+
+    def close(self):
+        self.queue.stop()
+
+
+class LocalIndex(object):
+    """
+    MIMIC THE BULK API OF elasticsearch.Index, WITH LATENCY
+    """
+
+    def __init__(self, fail_batches=0):
+        self.locker = Lock()
+        self.count = 0
+        self.json = 0  # RECORDS GIVEN AS json TEXT
+        self.sizes = []
+        self.fail_batches = fail_batches  # NUMBER OF BULKS TO REJECT, FIRST
+
+    def extend(self, records):
+        time.sleep(BULK_LATENCY)
+        with self.locker:
+            if self.fail_batches:
+                self.fail_batches -= 1
+                Log.error("400 MapperParsingException")
+            self.count += len(records)
+            self.json += sum(1 for r in records if "json" in r)
+            self.sizes.append(len(records))
+
+    def add(self, record):
+        if record is THREAD_STOP:
+            return
+        self.extend([record])
+
+
+class LocalBucket(object):
+    """
+    MIMIC s3.Bucket.read_lines(), WITH LATENCY
+    """
+
+    def __init__(self, bad_keys=()):
+        self.name = "test-bucket"
+        self.bad_keys = bad_keys
+        self.locker = Lock()
+        self.reads = 0  # READS IN PROGRESS
+        self.max_reads = 0
+
+    def read_lines(self, key):
+        with self.locker:
+            self.reads += 1
+            self.max_reads = max(self.max_reads, self.reads)
+        time.sleep(S3_LATENCY)
+        with self.locker:
+            self.reads -= 1
+        if key in self.bad_keys:
+            Log.error("S3 read error")
+        return [
+            value2json({"_id": key + "." + text(i), "etl": {"id": i}, "run": {"timestamp": time.time()}})
+            for i in range(DOCS_PER_KEY)
+        ]
@@ -0,0 +1,164 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import division
+from __future__ import unicode_literals
+
+from activedata_etl.sinks.s3_bucket import S3Bucket
+from mo_dots import Data, wrap
+from mo_future import text
+from mo_json import json2value
+from mo_testing.fuzzytestcase import FuzzyTestCase
+
+
+class TestS3Bucket(FuzzyTestCase):
+    """
+    S3Bucket.extend() AGAINST IN-PROCESS BUCKETS
+    """
+
+    def test_manifest_first_write(self):
+        sink = _sink(manifest=True)
+        sink.extend(_docs("tc.1", range(3)))
+        self.assertEqual(_ids(sink.bucket, "tc.1"), [0, 1, 2])
+        manifest = json2value(sink.manifest.read("tc.1"))
+        self.assertEqual(manifest.etag, sink.bucket.etags["tc.1"])
+        self.assertEqual(set(manifest.records.keys()), {"0", "1", "2"})
+
+    def test_manifest_unchanged(self):
+        sink = _sink(manifest=True)
+        sink.extend(_docs("tc.1", range(3)))
+        sink.bucket.reset()
+        sink.extend(_docs("tc.1", range(3), timestamp=2))  # ONLY VOLATILE etl PROPERTIES DIFFER
+        self.assertEqual(sink.bucket.writes, [])
+        self.assertEqual(sink.bucket.reads, [])
+
+    def test_manifest_all_replaced(self):
+        sink = _sink(manifest=True)
+        sink.extend(_docs("tc.1", range(3)))
+        sink.bucket.reset()
+        sink.extend(_docs("tc.1", range(4), content="new"))
+        self.assertEqual(sink.bucket.writes, ["tc.1"])
+        self.assertEqual(sink.bucket.reads, [])  # THE OLD OBJECT IS NOT READ
+        self.assertEqual(_ids(sink.bucket, "tc.1"), [0, 1, 2, 3])
+        self.assertEqual(json2value(sink.bucket.objects["tc.1"][0]).content, "new")
+
+    def test_manifest_merge(self):
+        sink = _sink(manifest=True)
+        sink.extend(_docs("tc.1", range(3)))
+        sink.bucket.reset()
+        sink.extend(_docs("tc.1", [1, 5], content="new"))
+        self.assertEqual(sink.bucket.reads, ["tc.1"])
+        self.assertEqual(_ids(sink.bucket, "tc.1"), [1, 5, 0, 2])  # NEW, THEN THE OLD NOT REPLACED
+        manifest = json2value(sink.manifest.read("tc.1"))
+        self.assertEqual(manifest.etag, sink.bucket.etags["tc.1"])
+        self.assertEqual(set(manifest.records.keys()), {"0", "1", "2", "5"})
+
+    def test_manifest_etag_mismatch(self):
+        sink = _sink(manifest=True)
+        sink.extend(_docs("tc.1", range(3)))
+
+        # SOMEONE ELSE WRITES THE OBJECT, SO THE MANIFEST IS NOT TRUSTED
+        sink.bucket.write_lines("tc.1", list(sink.bucket.objects["tc.1"]) + [_line(7)])
+        sink.bucket.reset()
+        sink.extend(_docs("tc.1", range(3)))
+        self.assertEqual(sink.bucket.reads, ["tc.1"])
+        self.assertEqual(sink.bucket.writes, ["tc.1"])
+        self.assertEqual(_ids(sink.bucket, "tc.1"), [0, 1, 2, 7])
+        self.assertEqual(json2value(sink.manifest.read("tc.1")).etag, sink.bucket.etags["tc.1"])
+
+
+    def test_duplicate_ids(self):
+        sink = _sink()
+        docs = _docs("tc.1", [0, 1]) + _docs("tc.1", [1, 2], content="new")
+        sink.extend(docs)
+        self.assertEqual(_ids(sink.bucket, "tc.1"), [0, 1, 2])  # THE FIRST OF EACH etl.id IS KEPT
+        self.assertEqual(json2value(sink.bucket.objects["tc.1"][1]).content, "old")
+
+    def test_merge_order(self):
+        sink = _sink()
+        sink.extend(_docs("tc.1", range(3)))
+        sink.extend(_docs("tc.1", [1, 5], content="new"))
+        self.assertEqual(_ids(sink.bucket, "tc.1"), [1, 5, 0, 2])  # NEW, THEN THE OLD NOT REPLACED
+
+    def test_parent_not_contiguous(self):
+        sink = _sink()
+        docs = _docs("tc.1", [0, 1]) + _docs("tc.2", [0]) + _docs("tc.1", [2, 0])
+        self.assertEqual(sink.extend(docs, overwrite=True), {"tc.1", "tc.2"})
+        # ONE WRITE PER RUN OF SAME-PARENT DOCUMENTS, LATER RUNS MERGED IN FRONT
+        self.assertEqual(sink.bucket.writes, ["tc.1", "tc.2", "tc.1"])
+        self.assertEqual(sink.bucket.reads, ["tc.1"])
+        self.assertEqual(_ids(sink.bucket, "tc.1"), [2, 0, 1])
+        self.assertEqual(_ids(sink.bucket, "tc.2"), [0])
+
+
+def _sink(manifest=False):
+    sink = S3Bucket.__new__(S3Bucket)
+    sink.settings = wrap({"bucket": "test-bucket"})
+    sink.bucket = LocalBucket("test-bucket")
+    sink.manifest = LocalBucket("test-manifest") if manifest else None
+    return sink
+
+
+def _docs(parent, ids, content="old", timestamp=1):
+    return [
+        {
+            "id": parent + "." + text(i),
+            "value": {"content": content, "etl": {"id": i, "timestamp": timestamp, "source": {"id": 1, "source": {"id": "tc"}}}}
+        }
+        for i in ids
+    ]
+
+
+def _line(i):
+    return '{"content":"other","etl":{"id":' + text(i) + '}}'
+
+
+def _ids(bucket, key):
+    return [json2value(line).etl.id for line in bucket.objects[key]]
+
+
+class LocalBucket(object):
+    """
+    MIMIC THE PARTS OF s3.Bucket USED BY S3Bucket, COUNTING READS AND WRITES
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.objects = {}  # MAP FROM KEY TO LIST OF LINES
+        self.etags = {}
+        self.version = 0
+        self.reads = []
+        self.writes = []
+
+    def reset(self):
+        self.reads = []
+        self.writes = []
+
+    def get_meta(self, key):
+        if key not in self.objects:
+            return None
+        return Data(key=key, etag=self.etags[key])
+
+    def read_lines(self, key):
+        self.reads.append(key)
+        return list(self.objects[key])
+
+    def write_lines(self, key, lines):
+        self.writes.append(key)
+        self.objects[key] = list(lines)
+        self.version += 1
+        self.etags[key] = text(self.version)
+        return self.etags[key]
+
+    def read(self, key):
+        lines = self.objects.get(key)
+        return lines[0] if lines else None
+
+    def write(self, key, value):
+        self.write_lines(key, [value])
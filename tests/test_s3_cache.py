@@ -0,0 +1,123 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import division
+from __future__ import unicode_literals
+
+from activedata_etl.imports.s3_cache import S3Cache, parse_primary, prefix_range, setup_files
+from jx_sqlite.sqlite import Sqlite
+from mo_files import TempDirectory
+from mo_logs import Log
+from mo_testing.fuzzytestcase import FuzzyTestCase
+from mo_times.timer import Timer
+
+NUM_KEYS = 100000
+BUCKET = "active-data-test-result"
+OLD_SELECTOR = "cast(substr(name, 4, instr(substr(name, 4), ':') - 1) as decimal)"
+
+
+class TestS3Cache(FuzzyTestCase):
+    """
+    THE files TABLE OF S3Cache, AND THE QUERIES auto_backfill RUNS ON IT
+    """
+
+    def setUp(self):
+        self.temp = TempDirectory()
+
+    def tearDown(self):
+        self.temp.__exit__(None, None, None)
+
+    def test_upsert(self):
+        cache = self._cache("upsert.sqlite")
+        cache.upsert_to_db(_rows(0, 10))
+        cache.upsert_to_db(_rows(5, 15))  # OVERLAPPING KEYS ARE IGNORED
+        self.assertEqual(cache.db.query("SELECT count(1), max(primary_id) FROM files").data, [(15, 14)])
+        cache.db.close()
+
+    def test_migrate(self):
+        db = Sqlite(filename=(self.temp / "old.sqlite").abspath, upgrade=False)
+        with db.transaction() as t:
+            t.execute("""
+                CREATE TABLE files (
+                   bucket TEXT,
+                   key TEXT,
+                   name TEXT,
+                   last_modified REAL,
+                   size INTEGER,
+                   annotate TEXT,
+                   CONSTRAINT pk PRIMARY KEY (bucket, name)
+                )
+            """)
+            t.execute_many("INSERT INTO files (bucket, key, name, last_modified, size) VALUES (?,?,?,?,?)", [r[:5] for r in _rows(0, 10)])
+        setup_files(db)
+        self.assertEqual(
+            db.query("SELECT prefix, primary_id FROM files ORDER BY primary_id").data,
+            [("tc", i) for i in range(10)]
+        )
+        setup_files(db)  # NOTHING MORE TO DO
+        db.close()
+
+    def test_query_speed(self):
+        cache = self._cache("speed.sqlite")
+        cache.upsert_to_db(_rows(0, NUM_KEYS))
+        db = cache.db
+        prefix = "tc.1234"
+
+        with Timer("substr() scan") as scan:
+            for _ in range(20):
+                old = db.query("SELECT key FROM files WHERE substr(name, 1, ?)=?", (len(prefix), prefix)).data
+                old_max = db.query("SELECT max(" + OLD_SELECTOR + ") FROM files WHERE substr(name, 1, 2)='tc'").data
+        with Timer("indexed range") as ranged:
+            for _ in range(20):
+                in_range, params = prefix_range(prefix)
+                new = db.query("SELECT key FROM files WHERE bucket=? AND " + in_range, (BUCKET,) + params).data
+                new_max = db.query("SELECT max(primary_id) FROM files WHERE bucket=? AND prefix=?", (BUCKET, "tc")).data
+
+        self.assertEqual(sorted(new), sorted(old))
+        self.assertEqual(len(new), 11)  # tc.1234, AND tc.12340 TO tc.12349
+        self.assertEqual(new_max, old_max)
+        Log.note(
+            "{{num}} keys: substr() {{scan|round(places=3)}}sec, indexed {{ranged|round(places=3)}}sec",
+            num=NUM_KEYS,
+            scan=scan.duration.seconds,
+            ranged=ranged.duration.seconds
+        )
+
+        # BOTH QUERIES SEARCH AN INDEX, NOT SCAN THE TABLE
+        for plan in [
+            _plan(db, "SELECT key FROM files WHERE bucket=? AND " + in_range, (BUCKET,) + params),
+            _plan(db, "SELECT max(primary_id) FROM files WHERE bucket=? AND prefix=?", (BUCKET, "tc"))
+        ]:
+            self.assertIn("USING", plan)
+            self.assertNotIn("SCAN", plan)
+        self.assertIn("SCAN", _plan(db, "SELECT key FROM files WHERE substr(name, 1, ?)=?", (len(prefix), prefix)))
+        db.close()
+
+    def test_parse_primary(self):
+        self.assertEqual(parse_primary("tc", "tc.1234:123456.7.json.gz"), 1234)
+        self.assertEqual(parse_primary("", "1234:123456.7.json.gz"), 1234)
+        self.assertEqual(prefix_range(""), ("1=1", ()))
+        self.assertEqual(prefix_range("tc.19")[1], ("tc.19", "tc.1:"))
+
+    def _cache(self, name):
+        cache = object.__new__(S3Cache)  # NO S3 BUCKET, ONLY THE TABLE
+        cache.db = Sqlite(filename=(self.temp / name).abspath, upgrade=False)
+        setup_files(cache.db)
+        return cache
+
+
+def _plan(db, command, params):
+    return " ".join(row[-1] for row in db.query("EXPLAIN QUERY PLAN " + command, params).data)
+
+
+def _rows(start, end):
+    return [
+        (BUCKET, "tc." + str(i) + ":" + str(i * 10) + ".0", "tc." + str(i) + ":" + str(i * 10) + ".0.json.gz", 1500000000 + i, 1000, "tc", i)
+        for i in range(start, end)
+    ]
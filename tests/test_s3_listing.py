@@ -0,0 +1,183 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import division
+from __future__ import unicode_literals
+
+import time
+from bisect import bisect_left, bisect_right
+
+from activedata_etl.imports.s3_cache import S3Cache, setup_files
+from jx_sqlite.sqlite import Sqlite
+from mo_dots import wrap
+from mo_files import TempDirectory
+from mo_logs import Log
+from mo_testing.fuzzytestcase import FuzzyTestCase
+from mo_threads import Lock
+from mo_times.timer import Timer
+from pyLibrary.aws.s3 import digit_shards, list_shards
+
+NUM_KEYS = 100000
+PAGE_SIZE = 1000  # KEYS PER LIST REQUEST, LIKE S3
+LATENCY = 0.01  # SECONDS PER LIST REQUEST
+
+
+class TestS3Listing(FuzzyTestCase):
+    """
+    list_shards() AGAINST AN IN-PROCESS BUCKET WITH PAGED, SLOW, LISTING
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.bucket = LocalBucket(["tc." + str(i) + ":" + str(i * 10) + ".json.gz" for i in range(NUM_KEYS)])
+
+    def test_same_keys(self):
+        for marker in [None, "tc.", "tc.1234", "tc.5", "tc.99999:999990.json.gz"]:
+            expected = [k.name for k in self.bucket.list(prefix="tc.", marker=marker or "")]
+            result = [k.name for k in list_shards(self.bucket, digit_shards("tc.", marker))]
+            self.assertEqual(result, expected)
+
+    def test_delimiter(self):
+        shards = [{"prefix": "tc.12" + str(i), "delimiter": ":"} for i in reversed(range(10))]
+        result = [k.name for k in list_shards(self.bucket, shards, num_threads=3)]
+        expected = [k.name for s in shards for k in self.bucket.list(prefix=s["prefix"], delimiter=":")]
+        self.assertEqual(result, expected)
+        self.assertEqual(len(result), 10 * 111)  # tc.12N, tc.12NX, tc.12NXX
+
+    def test_speed(self):
+        with Timer("serial listing") as serial:
+            expected = [k.name for k in self.bucket.list(prefix="tc.")]
+        self.bucket.markers = []
+        self.bucket.max_active = 0
+        with Timer("sharded listing") as sharded:
+            result = [k.name for k in list_shards(self.bucket, digit_shards("tc."))]
+        self.assertEqual(result, expected)
+        Log.note(
+            "{{num}} keys: serial {{serial|round(places=3)}} keys/sec, sharded {{sharded|round(places=3)}} keys/sec",
+            num=NUM_KEYS,
+            serial=NUM_KEYS / serial.duration.seconds,
+            sharded=NUM_KEYS / sharded.duration.seconds
+        )
+        self.assertGreater(len(self.bucket.markers), 1)  # ONE LIST PER SHARD
+        self.assertGreater(self.bucket.max_active, 1)  # SHARDS WERE LISTED AT THE SAME TIME
+
+    def test_early_exit(self):
+        listing = list_shards(self.bucket, digit_shards("tc."))
+        first = [next(listing).name for _ in range(5)]
+        listing.close()  # MUST NOT HANG ON THE LISTERS STILL FILLING THEIR BUFFERS
+        self.assertEqual(first[0], "tc.0:0.json.gz")
+
+    def test_resume_top_up(self):
+        temp = TempDirectory()
+        try:
+            bucket = LocalBucket(["tc." + str(i) + ":" + str(i * 10) + ".json.gz" for i in range(5000)], fail_after=2500)
+            cache = _cache(temp, bucket)
+            try:
+                cache._top_up("tc").join()
+            except Exception:
+                pass
+            stored = cache.db.query("SELECT count(1) FROM files").data[0][0]
+            marker = cache.db.query("SELECT marker FROM listing").data[0][0]
+            self.assertGreater(stored, 0)
+            self.assertLess(stored, 5000)
+
+            bucket.fail_after = None
+            bucket.markers = []
+            cache._top_up("tc").join()
+            self.assertEqual(cache.db.query("SELECT count(1) FROM files").data[0][0], 5000)
+            # THE SECOND LISTING STARTED WHERE THE FIRST STOPPED
+            self.assertTrue(all(m >= marker for m in bucket.markers))
+            self.assertEqual(cache.db.query("SELECT count(1) FROM listing").data[0][0], 0)
+            cache.db.close()
+        finally:
+            temp.__exit__(None, None, None)
+
+    def test_top_up_is_serial(self):
+        temp = TempDirectory()
+        try:
+            bucket = LocalBucket(["tc." + str(i) + ":" + str(i * 10) + ".json.gz" for i in range(5000)])
+            cache = _cache(temp, bucket)
+            cache.upsert_to_db([("test-bucket", "tc.4990:49900", "tc.4990:49900.json.gz", 0, 1000, "tc", 4990)])
+            cache._top_up("tc").join()
+
+            # ONE LIST, FROM THE BIGGEST KEY, NOT ONE PER SHARD
+            self.assertEqual(bucket.markers, ["tc.4990"])
+            self.assertEqual(cache.db.query("SELECT count(1) FROM files").data[0][0], 10)
+            cache.db.close()
+        finally:
+            temp.__exit__(None, None, None)
+
+
+def _cache(temp, bucket):
+    cache = object.__new__(S3Cache)  # NO S3 CONNECTION, ONLY THE LISTING
+    cache.db = Sqlite(filename=(temp / "listing.sqlite").abspath, upgrade=False)
+    cache.settings = wrap({})
+    cache.bucket = wrap({"name": "test-bucket"})
+    cache.bucket.bucket = bucket
+    setup_files(cache.db)
+    return cache
+
+
+class LocalBucket(object):
+    """
+    MIMIC boto Bucket.list(): SORTED KEYS, ONE SLOW REQUEST PER PAGE
+    """
+
+    def __init__(self, names, fail_after=None):
+        self.name = "test-bucket"
+        self.names = sorted(names)
+        self.fail_after = fail_after
+        self.listed = 0
+        self.markers = []
+        self.active = 0  # LISTINGS IN PROGRESS
+        self.max_active = 0
+        self.locker = Lock()
+
+    def list(self, prefix="", marker="", delimiter=""):
+        with self.locker:
+            self.markers.append(marker)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            for key in self._list(prefix, marker, delimiter):
+                yield key
+        finally:
+            with self.locker:
+                self.active -= 1
+
+    def _list(self, prefix, marker, delimiter):
+        # KEYS AFTER marker, STARTING WITH prefix
+        start = max(bisect_right(self.names, marker) if marker else 0, bisect_left(self.names, prefix))
+        last = None
+        count = 0
+        for name in self.names[start:]:
+            if not name.startswith(prefix):
+                break
+            if delimiter:
+                d = name.find(delimiter, len(prefix))
+                if d != -1:
+                    name = name[:d + 1]
+                    if name == last:
+                        continue
+            last = name
+            if count % PAGE_SIZE == 0:
+                time.sleep(LATENCY)
+            count += 1
+            with self.locker:
+                self.listed += 1
+                if self.fail_after is not None and self.listed > self.fail_after:
+                    raise Exception("S3 is down")
+            yield LocalKey(name)
+
+
+class LocalKey(object):
+    def __init__(self, name):
+        self.name = self.key = name
+        self.last_modified = "2018-01-01T00:00:00.000Z"
+        self.size = 1000
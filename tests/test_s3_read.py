@@ -0,0 +1,167 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import division
+from __future__ import unicode_literals
+
+import time
+
+from boto.exception import S3ResponseError
+
+from mo_dots import wrap
+from mo_logs import Log
+from mo_testing.fuzzytestcase import FuzzyTestCase
+from mo_times.timer import Timer
+from pyLibrary import convert
+from pyLibrary.aws.s3 import SkeletonBucket
+
+NUM_KEYS = 200
+GET_LATENCY = 0.005  # SECONDS PER GET
+LIST_LATENCY = 0.02  # SECONDS PER LIST, WHICH IS SLOWER
+
+
+class TestS3Read(FuzzyTestCase):
+    """
+    Bucket.read() AND FRIENDS, AGAINST AN IN-PROCESS BUCKET THAT COUNTS REQUESTS
+    """
+
+    def test_direct_get(self):
+        bucket = _bucket({"tc.1:10.json.gz": _zip("line 1\nline 2\n")})
+        self.assertEqual(bucket.read("tc.1:10"), "line 1\nline 2\n")
+        self.assertEqual(list(bucket.read_lines("tc.1:10")), ["line 1", "line 2"])
+        self.assertEqual(bucket.bucket.requests, {"GET": 2, "LIST": 0})
+
+    def test_other_extension(self):
+        bucket = _bucket({"tc.1:10.json": b"small"})
+        self.assertEqual(bucket.read("tc.1:10"), "small")
+        self.assertEqual(bucket.bucket.requests, {"GET": 2, "LIST": 1})  # MISSED .json.gz, THEN LISTED
+
+        # THE EXTENSION IS REMEMBERED
+        self.assertEqual(bucket.read_bytes("tc.1:10"), b"small")
+        self.assertEqual(bucket.bucket.requests, {"GET": 3, "LIST": 1})
+
+    def test_favorite(self):
+        # THE PREFIX OF ONE KEY STILL FINDS IT
+        bucket = _bucket({"tc.1:10.3.json.gz": _zip("deeper")})
+        self.assertEqual(bucket.read("tc.1:10"), "deeper")
+        self.assertEqual(bucket.read("tc.1:10"), "deeper")
+        self.assertEqual(bucket.bucket.requests, {"GET": 3, "LIST": 1})  # THE NAME IS REMEMBERED
+
+    def test_missing(self):
+        bucket = _bucket({})
+        self.assertRaises(Exception, bucket.read_lines, "tc.1:10")
+
+    def test_ambiguous(self):
+        objects = {"tc.1:10.1.json.gz": _zip("a"), "tc.1:10.2.json.gz": _zip("b")}
+        self.assertRaises(Exception, _bucket(objects).read, "tc.1:10")
+
+        objects["tc.1:10.json.gz"] = _zip("exact")
+        bucket = _bucket(objects)
+        self.assertEqual(bucket.read("tc.1:10"), "exact")
+        self.assertEqual(bucket.bucket.requests["LIST"], 0)
+
+        bucket = _bucket(objects, check_ambiguous=True)
+        self.assertEqual(bucket.read("tc.1:10"), "exact")
+        self.assertEqual(bucket.bucket.requests["LIST"], 1)
+
+    def test_write_then_read(self):
+        bucket = _bucket({})
+        bucket.write("tc.1:10", "small")
+        self.assertEqual(bucket.read("tc.1:10"), "small")
+        self.assertEqual(bucket.bucket.requests, {"GET": 1, "LIST": 0})
+
+    def test_speed(self):
+        names = ["tc." + str(i) + ":" + str(i * 10) for i in range(NUM_KEYS)]
+        objects = {n + ".json.gz": _zip(n) for n in names}
+
+        listing = _bucket(objects, check_ambiguous=True)
+        with Timer("list, then get") as listed:
+            for n in names:
+                self.assertEqual(listing.read(n), n)
+        direct = _bucket(objects)
+        with Timer("get") as got:
+            for n in names:
+                self.assertEqual(direct.read(n), n)
+
+        self.assertEqual(listing.bucket.requests, {"GET": NUM_KEYS, "LIST": NUM_KEYS})
+        self.assertEqual(direct.bucket.requests, {"GET": NUM_KEYS, "LIST": 0})
+        Log.note(
+            "{{num}} reads: list then get {{listed|round(places=3)}}sec in {{listed_requests}} requests, get {{got|round(places=3)}}sec in {{got_requests}} requests",
+            num=NUM_KEYS,
+            listed=listed.duration.seconds,
+            listed_requests=NUM_KEYS * 2,
+            got=got.duration.seconds,
+            got_requests=NUM_KEYS
+        )
+
+
+def _zip(content):
+    return convert.bytes2zip(content.encode("utf8"))
+
+
+def _bucket(objects, check_ambiguous=False):
+    output = SkeletonBucket()
+    output.settings = wrap({"bucket": "test-bucket"})
+    output.bucket = LocalBucket(dict(objects))
+    output.check_ambiguous = check_ambiguous
+    return output
+
+
+class LocalBucket(object):
+    """
+    MIMIC THE PARTS OF boto Bucket THAT pyLibrary.aws.s3.Bucket USES
+    """
+
+    def __init__(self, objects):
+        self.name = "test-bucket"
+        self.objects = objects
+        self.requests = {"GET": 0, "LIST": 0}
+
+    def list(self, prefix=""):
+        self.requests["LIST"] += 1
+        time.sleep(LIST_LATENCY)
+        return [LocalKey(self, n) for n in sorted(self.objects.keys()) if n.startswith(prefix)]
+
+    def new_key(self, name):
+        return LocalKey(self, name)
+
+    def delete_key(self, name):
+        self.objects.pop(name, None)
+
+
+class LocalKey(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = self.key = name
+        self.content = None
+        self.size = None
+
+    def open_read(self):
+        if self.content is not None:
+            return
+        self.bucket.requests["GET"] += 1
+        time.sleep(GET_LATENCY)
+        if self.name not in self.bucket.objects:
+            raise S3ResponseError(404, "Not Found")
+        self.content = self.bucket.objects[self.name]
+        self.size = len(self.content)
+
+    def read(self, size=0):
+        self.open_read()
+        if not size:
+            output, self.content = self.content, b""
+        else:
+            output, self.content = self.content[:size], self.content[size:]
+        return output
+
+    def close(self):
+        pass
+
+    def set_contents_from_string(self, value, headers=None):
+        self.bucket.objects[self.name] = value if isinstance(value, bytes) else value.encode("utf8")
@@ -0,0 +1,243 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import division
+from __future__ import unicode_literals
+
+import gzip
+import hashlib
+import time
+
+from mo_dots import Data, wrap
+from mo_future import BytesIO
+from mo_logs import Log
+from mo_testing.fuzzytestcase import FuzzyTestCase
+from mo_threads import Lock
+from mo_times.timer import Timer
+from pyLibrary.aws import s3
+from pyLibrary.aws.s3 import SkeletonBucket
+
+NUM_LINES = 200000
+PART_SIZE = 64 * 1024  # SMALL PARTS, SO A FEW MB MAKES MANY PARTS
+BANDWIDTH = 2 * 1000 * 1000  # BYTES PER SECOND, PER CONNECTION
+
+
+class TestS3Write(FuzzyTestCase):
+    """
+    Bucket.write_lines() AGAINST AN IN-PROCESS BUCKET WITH MULTIPART UPLOAD
+    """
+
+    def setUp(self):
+        self.part_size, s3.PART_SIZE = s3.PART_SIZE, PART_SIZE
+
+    def tearDown(self):
+        s3.PART_SIZE = self.part_size
+
+    def test_small(self):
+        bucket = _bucket()
+        etag = bucket.write_lines("tc.1:10", ["a", ["b", "c"]])
+        self.assertEqual(_lines(bucket.bucket.objects["tc.1:10.json.gz"]), ["a", "b", "c"])
+        self.assertEqual(etag, bucket.bucket.etags["tc.1:10.json.gz"])
+        self.assertEqual(bucket.bucket.uploads, [])  # ONE PUT, NO MULTIPART
+
+    def test_multipart(self):
+        bucket = _bucket()
+        lines = _json_lines(20000)
+        etag = bucket.write_lines("tc.1:10", lines)
+
+        upload = bucket.bucket.uploads[0]
+        self.assertGreater(len(upload.parts), 2)
+        self.assertTrue(all(len(upload.parts[n]) >= PART_SIZE for n in sorted(upload.parts.keys())[:-1]))
+        self.assertEqual(_lines(bucket.bucket.objects["tc.1:10.json.gz"]), lines)
+        self.assertEqual(etag, bucket.bucket.etags["tc.1:10.json.gz"])
+        self.assertEqual(list(bucket.read_lines("tc.1:10")), lines)
+
+    def test_part_retry(self):
+        bucket = _bucket()
+        bucket.bucket.failures = {2: 2}  # PART 2 FAILS TWICE, THEN WORKS
+        lines = _json_lines(20000)
+        bucket.write_lines("tc.1:10", lines)
+        self.assertEqual(_lines(bucket.bucket.objects["tc.1:10.json.gz"]), lines)
+        self.assertEqual(bucket.bucket.uploads[0].attempts[2], 3)
+        self.assertEqual(bucket.bucket.uploads[0].attempts[1], 1)  # ONLY THE FAILED PART IS SENT AGAIN
+
+    def test_part_failure(self):
+        bucket = _bucket()
+        bucket.bucket.failures = {2: 100}
+        self.assertRaises(Exception, bucket.write_lines, "tc.1:10", _json_lines(20000))
+        self.assertTrue(bucket.bucket.uploads[0].cancelled)
+        self.assertEqual(bucket.bucket.objects, {})
+
+    def test_producer_failure(self):
+        def lines():
+            for l in _json_lines(20000):
+                yield l
+            raise Exception("no more lines")
+
+        bucket = _bucket()
+        self.assertRaises(Exception, bucket.write_lines, "tc.1:10", lines())
+        self.assertTrue(bucket.bucket.uploads[0].cancelled)
+        self.assertEqual(bucket.bucket.objects, {})
+
+    def test_compression_level(self):
+        lines = _json_lines(20000)
+        fast = _bucket(compression_level=1)
+        fast.write_lines("tc.1:10", lines)
+        small = _bucket()
+        small.write_lines("tc.1:10", lines)
+        fast.write_lines("tc.1:11", lines, compression_level=9)
+        self.assertGreater(len(fast.bucket.objects["tc.1:10.json.gz"]), len(small.bucket.objects["tc.1:10.json.gz"]))
+        self.assertLess(len(fast.bucket.objects["tc.1:11.json.gz"]), len(fast.bucket.objects["tc.1:10.json.gz"]))  # OVERRIDE
+        self.assertEqual(_lines(fast.bucket.objects["tc.1:10.json.gz"]), lines)
+
+    def test_speed(self):
+        lines = _json_lines(NUM_LINES)
+
+        # WHAT write_lines() USED TO DO: COMPRESS IT ALL, THEN SEND IT ALL
+        serial = LocalBucket()
+        with Timer("compress, then upload") as before:
+            buff = BytesIO()
+            archive = gzip.GzipFile(fileobj=buff, mode="w")
+            for l in lines:
+                archive.write(l.encode("utf8"))
+                archive.write(b"\n")
+            archive.close()
+            serial.new_key("tc.1:10.json.gz").set_contents_from_file(BytesIO(buff.getvalue()))
+
+        bucket = _bucket()
+        with Timer("streaming upload") as streaming:
+            bucket.write_lines("tc.1:10", lines)
+
+        self.assertEqual(_lines(bucket.bucket.objects["tc.1:10.json.gz"]), lines)
+        upload = bucket.bucket.uploads[0]
+        self.assertGreater(len(upload.parts), 2)
+        self.assertGreater(upload.max_active, 1)  # PARTS WERE SENT AT THE SAME TIME
+        Log.note(
+            "{{num}} lines ({{bytes|comma}} compressed bytes): compress then upload {{before|round(places=3)}}sec, streaming {{streaming|round(places=3)}}sec",
+            num=NUM_LINES,
+            bytes=len(bucket.bucket.objects["tc.1:10.json.gz"]),
+            before=before.duration.seconds,
+            streaming=streaming.duration.seconds
+        )
+
+
+def _json_lines(num):
+    return [
+        '{"etl":{"id":' + str(i) + '},"source":{"file":"dom/base/file_' + str(i % 997) + '.cpp","covered":[' + ",".join(str(j * i % 1009) for j in range(8)) + ']}}'
+        for i in range(num)
+    ]
+
+
+def _lines(content):
+    return gzip.GzipFile(fileobj=BytesIO(content)).read().decode("utf8").split("\n")[:-1]
+
+
+def _bucket(**kwargs):
+    output = SkeletonBucket()
+    output.settings = wrap({"bucket": "test-bucket"})
+    output.bucket = LocalBucket()
+    for k, v in kwargs.items():
+        setattr(output, k, v)
+    return output
+
+
+def _upload_time(num_bytes):
+    time.sleep(num_bytes / BANDWIDTH)
+
+
+class LocalBucket(object):
+    """
+    MIMIC THE PARTS OF boto Bucket THAT Bucket.write_lines() USES
+    """
+
+    def __init__(self):
+        self.name = "test-bucket"
+        self.objects = {}
+        self.etags = {}
+        self.uploads = []
+        self.failures = {}  # MAP FROM PART NUMBER TO NUMBER OF TIMES IT WILL FAIL
+
+    def new_key(self, name):
+        return LocalKey(self, name)
+
+    def initiate_multipart_upload(self, name, headers=None):
+        upload = LocalUpload(self, name)
+        self.uploads.append(upload)
+        return upload
+
+    def save(self, name, content):
+        self.objects[name] = content
+        self.etags[name] = '"' + hashlib.md5(content).hexdigest() + '"'
+        return self.etags[name]
+
+
+class LocalKey(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = self.key = name
+        self.etag = None
+        self.content = None
+        self.size = None
+
+    def set_contents_from_file(self, fp, headers=None):
+        content = fp.read()
+        _upload_time(len(content))
+        self.etag = self.bucket.save(self.name, content)
+
+    def open_read(self):
+        if self.content is None:
+            self.content = self.bucket.objects[self.name]
+            self.size = len(self.content)
+
+    def read(self, size=0):
+        self.open_read()
+        if not size:
+            output, self.content = self.content, b""
+        else:
+            output, self.content = self.content[:size], self.content[size:]
+        return output
+
+    def close(self):
+        pass
+
+
+class LocalUpload(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.parts = {}
+        self.attempts = {}
+        self.cancelled = False
+        self.active = 0  # PARTS BEING SENT
+        self.max_active = 0
+        self.locker = Lock()
+
+    def upload_part_from_file(self, fp, part_num):
+        content = fp.read()
+        with self.locker:
+            self.attempts[part_num] = self.attempts.get(part_num, 0) + 1
+            fail = self.bucket.failures.get(part_num, 0) >= self.attempts[part_num]
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            _upload_time(len(content))
+        finally:
+            with self.locker:
+                self.active -= 1
+        if fail:
+            raise Exception("connection reset")
+        with self.locker:
+            self.parts[part_num] = content
+
+    def complete_upload(self):
+        content = b"".join(self.parts[n] for n in sorted(self.parts.keys()))
+        return Data(etag=self.bucket.save(self.name, content))
+
+    def cancel_upload(self):
+        self.cancelled = True
@@ -0,0 +1,128 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import division
+from __future__ import unicode_literals
+
+from jx_sqlite.sqlite import Sqlite
+from mo_dots import wrap
+from mo_files import TempDirectory
+from mo_logs import Log
+from mo_testing.fuzzytestcase import FuzzyTestCase
+from mo_threads import Lock, Thread
+from mo_times.timer import Timer
+
+NUM_ROWS = 20000
+NUM_QUERIES = 480
+WRITE_ROWS = 5000  # ROWS PER WRITE TRANSACTION
+QUERY = "SELECT count(1), sum(v) FROM data WHERE v<? AND id>?"
+
+
+class TestSqliteSpeed(FuzzyTestCase):
+    """
+    COMPARE QUERIES/SEC THROUGH THE SINGLE WRITER AND THROUGH THE READ-ONLY POOL,
+    WHILE ANOTHER THREAD KEEPS WRITING
+    """
+
+    def setUp(self):
+        self.temp = TempDirectory()
+
+    def tearDown(self):
+        self.temp.__exit__(None, None, None)
+
+    def test_queries_per_second(self):
+        single = self._run("single.sqlite", readers=0)
+        pooled = self._run("pooled.sqlite", readers=4)
+        Log.note(
+            "queries/sec during writes\n"
+            "threads  single writer  4 readers\n"
+            "      1  {{single.t1|round(places=3)}}  {{pooled.t1|round(places=3)}}\n"
+            "      4  {{single.t4|round(places=3)}}  {{pooled.t4|round(places=3)}}\n"
+            "     16  {{single.t16|round(places=3)}}  {{pooled.t16|round(places=3)}}",
+            single=single,
+            pooled=pooled
+        )
+        queries = sum(NUM_QUERIES // n * n for n in (1, 4, 16))
+        self.assertEqual(single.pooled, 0)
+        self.assertEqual(pooled.pooled, queries)  # EVERY SELECT WENT TO THE READ-ONLY POOL
+        self.assertGreater(pooled.max_reads, 1)  # READERS RAN AT THE SAME TIME
+
+    def test_readers_see_commits(self):
+        db = self._make("commits.sqlite", readers=2)
+        with db.transaction() as t:
+            t.execute("INSERT INTO data (id, v) VALUES (?, ?)", (NUM_ROWS + 1, -1))
+        self.assertEqual(db.query("SELECT v FROM data WHERE id=?", (NUM_ROWS + 1,)).data, [(-1,)])
+
+        # WRITES THROUGH query() STILL GO TO THE WRITER
+        db.query("DELETE FROM data WHERE id=?", (NUM_ROWS + 1,))
+        self.assertEqual(db.query("SELECT v FROM data WHERE id=?", (NUM_ROWS + 1,)).data, [])
+        db.close()
+
+    def test_memory_has_no_readers(self):
+        db = Sqlite(readers=4)
+        self.assertEqual(db.num_readers, 0)
+        self.assertEqual(db.query("SELECT ?", (42,)).data, [(42,)])
+        db.close()
+
+    def _make(self, name, readers):
+        db = Sqlite(filename=(self.temp / name).abspath, readers=readers, upgrade=False)
+        with db.transaction() as t:
+            t.execute("CREATE TABLE data (id INTEGER PRIMARY KEY, v INTEGER, s TEXT)")
+            t.execute("CREATE TABLE log (id INTEGER, s TEXT)")
+            t.execute(
+                "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x+1 FROM c WHERE x<?) "
+                "INSERT INTO data SELECT x, x % 97, 'row ' || x FROM c",
+                (NUM_ROWS,)
+            )
+        return db
+
+    def _run(self, name, readers):
+        db = self._make(name, readers)
+        expected = db.query(QUERY, (50, 100)).data
+        output = {"pooled": 0, "reads": 0, "max_reads": 0}
+        locker = Lock()
+        read = db._read
+
+        def counted_read(command, params):
+            with locker:
+                output["pooled"] += 1
+                output["reads"] += 1
+                output["max_reads"] = max(output["max_reads"], output["reads"])
+            try:
+                return read(command, params)
+            finally:
+                with locker:
+                    output["reads"] -= 1
+
+        db._read = counted_read
+
+        def writer(please_stop):
+            while not please_stop:
+                with db.transaction() as t:
+                    t.execute(
+                        "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x+1 FROM c WHERE x<?) "
+                        "INSERT INTO log SELECT x, 'log ' || x FROM c",
+                        (WRITE_ROWS,)
+                    )
+
+        writes = Thread.run("writer", writer)
+        for num_threads in (1, 4, 16):
+            def worker(please_stop):
+                for _ in range(NUM_QUERIES // num_threads):
+                    self.assertEqual(db.query(QUERY, (50, 100)).data, expected)
+
+            with Timer("{{num}} threads with {{readers}} readers", {"num": num_threads, "readers": readers}) as timer:
+                threads = [Thread.run("query " + str(i), worker) for i in range(num_threads)]
+                for t in threads:
+                    t.join()
+            output["t" + str(num_threads)] = NUM_QUERIES / timer.duration.seconds
+        writes.stop()
+        writes.join()
+        db.close()
+        return wrap(output)
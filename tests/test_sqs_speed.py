@@ -0,0 +1,176 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import division
+from __future__ import unicode_literals
+
+import time
+
+from boto.sqs.message import Message
+
+from mo_dots import wrap
+from mo_json import json2value
+from mo_logs import Log
+from mo_testing.fuzzytestcase import FuzzyTestCase
+from mo_times.timer import Timer
+from pyLibrary import aws
+
+NUM_MESSAGES = 200
+LATENCY = 0.002  # SECONDS PER SQS REQUEST
+
+
+class TestSqsSpeed(FuzzyTestCase):
+    """
+    COMPARE SINGLE AND BATCHED aws.Queue AGAINST A LOCAL SQS STAND-IN
+    """
+
+    def setUp(self):
+        self.connect_to_region = aws.sqs.connect_to_region
+        self.fake = FakeSqsQueue()
+        aws.sqs.connect_to_region = lambda **kwargs: FakeSqsConnection(self.fake)
+
+    def tearDown(self):
+        aws.sqs.connect_to_region = self.connect_to_region
+
+    def test_single_vs_batch(self):
+        single = self._run(batch_size=1)
+        batched = self._run(batch_size=10)
+        Log.note(
+            "single: {{single.rate|round(places=3)}} msg/sec, batched: {{batched.rate|round(places=3)}} msg/sec",
+            single=single,
+            batched=batched
+        )
+        self.assertLess(batched.requests, single.requests / 2)
+
+    def test_rollback_returns_messages(self):
+        queue = aws.Queue(name="test", region="us-west-2", batch_size=10)
+        queue.extend({"key": i} for i in range(15))
+        first = queue.pop()
+        queue.rollback()
+        queue.close()
+        self.assertEqual(first.key, 0)
+        self.assertEqual(len(self.fake.invisible), 0)
+        self.assertEqual(
+            set(json2value(m.get_body()).key for m in self.fake.messages),
+            set(range(15))
+        )
+
+    def test_prefetch_within_visibility(self):
+        self.fake.visibility = 60
+        queue = aws.Queue(name="test", region="us-west-2", batch_size=10)
+        self.assertEqual(queue.prefetch_timeout, 30)  # HALF OF THE VisibilityTimeout, NOT 5 MINUTES
+        queue = aws.Queue(name="test", region="us-west-2", batch_size=10, prefetch_timeout="10second")
+        self.assertEqual(queue.prefetch_timeout, 10)
+
+    def _run(self, batch_size):
+        self.fake.requests = 0
+        queue = aws.Queue(name="test", region="us-west-2", batch_size=batch_size)
+        with Timer("fill queue with batch_size={{size}}", {"size": batch_size}):
+            queue.extend({"key": i} for i in range(NUM_MESSAGES))
+
+        with Timer("drain queue with batch_size={{size}}", {"size": batch_size}) as timer:
+            with queue:
+                count = 0
+                while queue.pop() != None:
+                    queue.commit()
+                    count += 1
+
+        self.assertEqual(count, NUM_MESSAGES)
+        self.assertEqual(len(self.fake.messages), 0)
+        Log.note("batch_size={{size}} made {{num}} requests", size=batch_size, num=self.fake.requests)
+        return wrap({"rate": NUM_MESSAGES / timer.duration.seconds, "requests": self.fake.requests})
+
+
+class FakeSqsConnection(object):
+    def __init__(self, queue):
+        self.queue = queue
+
+    def get_queue(self, name):
+        return self.queue
+
+
+class FakeBatchResults(object):
+    def __init__(self):
+        self.errors = []
+
+
+class FakeSqsQueue(object):
+    """
+    MINIMUM OF THE boto Queue API, WITH LATENCY ON EACH CALL
+    """
+
+    def __init__(self):
+        self.messages = []  # VISIBLE
+        self.invisible = {}  # MAP FROM receipt_handle TO MESSAGE
+        self.requests = 0
+        self.next_handle = 0
+        self.visibility = 30  # SECONDS, THE SQS DEFAULT
+
+    def _request(self):
+        self.requests += 1
+        time.sleep(LATENCY)
+
+    def _receive(self, num):
+        output = []
+        for m in self.messages[:num]:
+            self.next_handle += 1
+            received = Message(body=m.get_body())
+            received.receipt_handle = self.next_handle
+            self.invisible[self.next_handle] = received
+            output.append(received)
+        self.messages = self.messages[num:]
+        return output
+
+    def _send(self, body):
+        m = Message()
+        m.set_body(m.decode(body))
+        self.messages.append(m)
+
+    def get_attributes(self, name):
+        self._request()
+        if name == "VisibilityTimeout":
+            return {name: str(self.visibility)}
+        return {name: str(len(self.messages))}
+
+    def read(self, wait_time_seconds=None):
+        self._request()
+        output = self._receive(1)
+        return output[0] if output else None
+
+    def get_messages(self, num_messages=1, wait_time_seconds=None):
+        self._request()
+        return self._receive(num_messages)
+
+    def write(self, message):
+        self._request()
+        self._send(message.get_body_encoded())
+
+    def write_batch(self, messages):
+        self._request()
+        for _, body, _ in messages:
+            self._send(body)
+        return FakeBatchResults()
+
+    def delete_message(self, message):
+        self._request()
+        self.invisible.pop(message.receipt_handle, None)
+
+    def delete_message_batch(self, messages):
+        self._request()
+        for m in messages:
+            self.invisible.pop(m.receipt_handle, None)
+        return FakeBatchResults()
+
+    def change_message_visibility_batch(self, messages):
+        self._request()
+        for m, timeout in messages:
+            m = self.invisible.pop(m.receipt_handle, None)
+            if m:
+                self.messages.append(m)
+        return FakeBatchResults()
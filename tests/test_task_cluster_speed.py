@@ -0,0 +1,280 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import division
+from __future__ import unicode_literals
+
+import time
+
+from activedata_etl.transforms import pulse_block_to_task_cluster
+from activedata_etl.transforms.pulse_block_to_task_cluster import (
+    BuildTasks,
+    HostLimit,
+    SeenTasks,
+    TaskPrefetch,
+    get_build_task,
+)
+from mo_dots import unwrap, wrap
+from mo_json import json2value, value2json
+from mo_logs import Log
+from mo_testing.fuzzytestcase import FuzzyTestCase
+from mo_threads import Signal, Thread
+from mo_times.timer import Timer
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+NUM_TASKS = 40
+LATENCY = 0.02  # SECONDS PER TASKCLUSTER REQUEST
+MISSING = "task-missing"
+
+
+class TestTaskClusterSpeed(FuzzyTestCase):
+    """
+    MEASURE THE TaskCluster PREFETCH AGAINST A LOCAL HTTP STAND-IN
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalTaskCluster(("localhost", 0), TaskClusterHandler)
+        cls.thread = Thread.run("local taskcluster", cls.server.serve)
+        url = "http://localhost:" + str(cls.server.server_address[1]) + "/task/{{task_id}}"
+        cls.templates = (
+            pulse_block_to_task_cluster.TC_MAIN_URL,
+            pulse_block_to_task_cluster.TC_STATUS_URL,
+            pulse_block_to_task_cluster.TC_ARTIFACTS_URL,
+        )
+        pulse_block_to_task_cluster.TC_MAIN_URL = url
+        pulse_block_to_task_cluster.TC_STATUS_URL = url + "/status"
+        pulse_block_to_task_cluster.TC_ARTIFACTS_URL = url + "/artifacts"
+
+    @classmethod
+    def tearDownClass(cls):
+        (
+            pulse_block_to_task_cluster.TC_MAIN_URL,
+            pulse_block_to_task_cluster.TC_STATUS_URL,
+            pulse_block_to_task_cluster.TC_ARTIFACTS_URL,
+        ) = cls.templates
+        cls.server.shutdown()
+        cls.thread.join()
+
+    def test_prefetch_speed(self):
+        serial = self._run(num_threads=1)
+        concurrent = self._run(num_threads=pulse_block_to_task_cluster.MAX_THREADS)
+        Log.note(
+            "serial: {{serial.rate|round(places=3)}} tasks/sec, concurrent: {{concurrent.rate|round(places=3)}} tasks/sec",
+            serial=serial,
+            concurrent=concurrent
+        )
+        self.assertEqual(serial.max_active, 1)
+        self.assertGreater(concurrent.max_active, 1)  # TASKS WERE FETCHED AT THE SAME TIME
+
+    def test_missing_task(self):
+        task_ids = ["task-0", MISSING, None, "task-3"]
+        fetched = TaskPrefetch(task_ids)
+        try:
+            self.assertEqual(fetched.get(1, pulse_block_to_task_cluster.TC_MAIN_URL, MISSING).code, "ResourceNotFound")
+            # THE SERIAL CODE STOPS AT A MISSING TASK, SO THERE IS NOTHING MORE TO FETCH
+            self.assertEqual(fetched.results[1], {})
+            # LINES THAT COULD NOT BE PARSED ARE FETCHED ON DEMAND
+            self.assertEqual(fetched.get(2, pulse_block_to_task_cluster.TC_MAIN_URL, "task-2").taskId, "task-2")
+            self.assertEqual(fetched.get(3, pulse_block_to_task_cluster.TC_ARTIFACTS_URL, "task-3").artifacts[0].name, "task-3/live_backing.log")
+        finally:
+            fetched.stop()
+
+    def test_host_limit(self):
+        self.server.max_active = 0
+        fetched = TaskPrefetch(["task-" + str(i) for i in range(20)], num_threads=8, limit=HostLimit(2))
+        fetched.stop()
+        self.assertLessEqual(self.server.max_active, 2)
+
+    def test_seen_tasks(self):
+        seen = SeenTasks(max_size=3)
+        doc = wrap([{"status": {"state": "completed"}}, {"expires": 1.5}, [{"name": "a"}]])
+        self.assertTrue(seen.check("task-0", doc))
+        self.assertTrue(seen.check("task-0", wrap([{"status": {"state": "completed"}}, {"expires": 1.5}, [{"name": "a"}]])))
+        self.assertFalse(seen.check("task-0", wrap([{"status": {"state": "failed"}}, {"expires": 1.5}, [{"name": "a"}]])))
+        self.assertEqual(seen.stats.duplicates, 2)
+        self.assertEqual(seen.stats.identical, 1)  # THE SAME MESSAGE AGAIN IS NOT DECOMPRESSED
+        self.assertEqual(seen.stats.mismatches, 1)
+
+        for i in range(1, 4):
+            seen.check("task-" + str(i), doc)
+        # task-0 WAS LEAST RECENTLY SEEN
+        self.assertEqual(len(seen), 3)
+        self.assertEqual(seen.stats.evicted, 1)
+        self.assertTrue(seen.check("task-0", wrap([{"status": {"state": "failed"}}])))
+
+        expired = SeenTasks(duration=0)
+        expired.check("task-0", doc)
+        expired.check("task-1", doc)
+        self.assertEqual(len(expired), 1)
+
+    def test_seen_tasks_later_message(self):
+        seen = SeenTasks()
+        first = wrap([{"status": {"state": "completed"}, "runId": 0, "_meta": {"a": 1}}, {"expires": 1.5}, []])
+        self.assertTrue(seen.check("task-0", first, strip=pulse_block_to_task_cluster._strip_message))
+        self.assertEqual(first[0].runId, 0)  # THE MESSAGE ITSELF IS NOT CHANGED
+
+        # ONLY runId AND _meta DIFFER, SO THE DIGESTS MATCH
+        again = wrap([{"status": {"state": "completed"}, "runId": 1, "_meta": {"a": 3}}, {"expires": 1.5}, []])
+        self.assertTrue(seen.check("task-0", again, strip=pulse_block_to_task_cluster._strip_message))
+        self.assertEqual(seen.stats.identical, 1)
+
+        # A LATER MESSAGE WITH AN EXTRA KEY, OTHER runId AND _meta, AND FLOAT NOISE
+        later = wrap([
+            {"status": {"state": "completed", "deadline": 12}, "runId": 1, "_meta": {"a": 2}},
+            {"expires": 1.5 + 1e-14, "extra": "value"},
+            []
+        ])
+        self.assertTrue(seen.check("task-0", later, strip=pulse_block_to_task_cluster._strip_message))
+        self.assertEqual(seen.stats.identical, 1)  # COMPARED ONE-SIDED, NOT BY DIGEST
+        self.assertFalse(seen.check("task-0", wrap([{}, {"expires": 2.5}, []])))
+        self.assertEqual(seen.stats.mismatches, 1)
+
+    def test_build_tasks(self):
+        resources = wrap({"local_es_node": {"host": "http://localhost", "port": self.server.server_address[1]}})
+        cache = BuildTasks()
+        builds, pulse_block_to_task_cluster.build_tasks = pulse_block_to_task_cluster.build_tasks, cache
+        try:
+            self.server.searches = 0
+            cache.prefetch("test", resources, [["build-1", "build-2", "image-1"]])
+            self.assertEqual(self.server.searches, 1)
+
+            # TESTS SHARING BUILDS NEED NO MORE QUERIES
+            for i in range(10):
+                test = wrap({"task": {"id": "test-" + str(i), "dependencies": ["build-" + str(i % 2 + 1), "image-1"]}})
+                build = get_build_task("test", resources, test)
+                self.assertEqual(build.task.id, "build-" + str(i % 2 + 1))
+                build.task.id = None  # CALLERS CHANGE THE BUILD, THE CACHE MUST NOT SEE IT
+            self.assertEqual(self.server.searches, 1)
+            self.assertEqual(cache.stats.hits, 20)
+
+            # MISSING BUILDS ARE REMEMBERED, BUT NOT FOR LONG
+            missing = wrap({"task": {"id": "test-x", "dependencies": "image-2"}})
+            self.assertEqual(get_build_task("test", resources, missing), None)
+            self.assertEqual(get_build_task("test", resources, missing), None)
+            self.assertEqual(self.server.searches, 2)
+            cache.missing_duration = 0
+            cache.cache.clear()
+            self.assertEqual(get_build_task("test", resources, missing), None)
+            self.assertEqual(get_build_task("test", resources, missing), None)
+            self.assertEqual(self.server.searches, 4)
+        finally:
+            pulse_block_to_task_cluster.build_tasks = builds
+
+    def test_build_tasks_bounded(self):
+        resources = wrap({"local_es_node": {"host": "http://localhost", "port": self.server.server_address[1]}})
+        cache = BuildTasks(max_size=5)
+        cache.prefetch("test", resources, [["build-" + str(i) for i in range(8)]])
+        self.assertEqual(len(cache.cache), 5)
+        self.assertEqual(cache.stats.evicted, 3)
+
+    def test_dependencies(self):
+        fetched = TaskPrefetch(["task-" + str(i) for i in range(10)])
+        try:
+            batches = list(fetched.dependencies(Signal(), batch_size=3))
+        finally:
+            fetched.stop()
+        self.assertTrue(all(len(b) <= 3 for b in batches))
+        self.assertEqual([d for b in batches for d in b], ["build-" + str(i) for i in range(10)])
+
+    def test_build_task_in_flight(self):
+        resources = wrap({"local_es_node": {"host": "http://localhost", "port": self.server.server_address[1]}})
+        cache = BuildTasks()
+        done = cache.pending["build-1"] = Signal()
+        found = []
+        waiting = Thread.run("get build", lambda please_stop: found.extend(cache.get(resources, ["build-1"])))
+
+        # THE PREFETCH ANSWERS, THE WAITING get() DOES NOT ASK AGAIN
+        self.server.searches = 0
+        cache._search(resources, ["build-1"])
+        del cache.pending["build-1"]
+        done.go()
+        waiting.join()
+        self.assertEqual(self.server.searches, 1)
+        self.assertEqual(found[0].task.id, "build-1")
+
+    def _run(self, num_threads):
+        task_ids = ["task-" + str(i) for i in range(NUM_TASKS)]
+        self.server.max_active = 0
+        with Timer("prefetch with {{num}} threads", {"num": num_threads}) as timer:
+            fetched = TaskPrefetch(task_ids, num_threads=num_threads)
+            try:
+                for i, task_id in enumerate(task_ids):
+                    # IN LINE ORDER, EACH LINE GETS ITS OWN TASK
+                    self.assertEqual(fetched.get(i, pulse_block_to_task_cluster.TC_MAIN_URL, task_id).taskId, task_id)
+                    self.assertEqual(fetched.get(i, pulse_block_to_task_cluster.TC_STATUS_URL, task_id).status.taskId, task_id)
+                    self.assertEqual(fetched.get(i, pulse_block_to_task_cluster.TC_ARTIFACTS_URL, task_id).artifacts[0].name, task_id + "/live_backing.log")
+            finally:
+                fetched.stop()
+        return wrap({"rate": NUM_TASKS / timer.duration.seconds, "max_active": self.server.max_active})
+
+
+class LocalTaskCluster(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    active = 0
+    max_active = 0
+    searches = 0
+
+    def serve(self, please_stop):
+        self.serve_forever(poll_interval=0.1)
+
+
+class TaskClusterHandler(BaseHTTPRequestHandler):
+    """
+    ANSWER TaskCluster task, status AND artifacts REQUESTS, AFTER A DELAY
+
+    task/task/_search IS ANSWERED LIKE THE task INDEX: TASK IDS STARTING
+    WITH "build-" ARE BUILDS, THE REST ARE NOT FOUND
+    """
+
+    def do_POST(self):
+        self.server.searches += 1
+        request = json2value(self.rfile.read(int(self.headers["Content-Length"])).decode("utf8"))
+        hits = [
+            {"_source": {"task": {"id": t}, "treeherder": {"jobKind": "build"}, "run": {"start_time": i}}}
+            for i, t in enumerate(unwrap(request.query.terms)["task.id"])
+            if t.startswith("build-")
+        ]
+        self._send(200, {"hits": {"hits": hits}})
+
+    def do_GET(self):
+        server = self.server
+        server.active += 1
+        server.max_active = max(server.max_active, server.active)
+        time.sleep(LATENCY)
+        # DONE BEFORE THE RESPONSE, SO A SERIAL CLIENT IS NEVER COUNTED TWICE
+        server.active -= 1
+
+        path = self.path.split("/")
+        task_id = path[2]
+        if task_id == MISSING:
+            self._send(404, {"code": "ResourceNotFound"})
+        elif len(path) == 3:
+            self._send(200, {"taskId": task_id, "created": time.time(), "dependencies": ["build-" + task_id.split("-")[-1]]})
+        elif path[3] == "status":
+            self._send(200, {"status": {"taskId": task_id, "runs": [{"state": "completed", "resolved": time.time()}]}})
+        else:
+            self._send(200, {"artifacts": [{"name": task_id + "/live_backing.log"}]})
+
+    def _send(self, code, doc):
+        content = value2json(wrap(doc)).encode("utf8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,130 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import division
+from __future__ import unicode_literals
+
+import gzip
+from io import BytesIO
+
+from activedata_etl.imports import text_log
+from activedata_etl.imports.text_log import process_tc_live_backing_log
+from mo_dots import wrap
+from mo_future import text
+from mo_json import value2json
+from mo_http.big_data import ibytes2ilines, icompressed2ibytes
+from mo_logs import Log
+from mo_testing.fuzzytestcase import FuzzyTestCase
+from mo_times import Date, SECOND
+from mo_times.timer import Timer
+
+NUM_LINES = 20000
+LINES_PER_STEP = 2000
+TASK_ID = "abzkq-CjS_KJzNEhE6nVhA"
+START = Date("2016-10-04 17:09:02")
+
+
+class TestTextLogSpeed(FuzzyTestCase):
+    """
+    MEASURE process_tc_live_backing_log() ON A GENERATED live_backing.log
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.log = _make_log()
+
+    def test_same_result(self):
+        fast = self._parse()
+        slow = self._parse_slow()
+        # Duration DOES NOT COMPARE, SO COMPARE THE JSON
+        self.assertEqual(value2json(fast), value2json(slow))
+        # taskcluster (pre task), task, mozharness, taskcluster (post task), AND THE HARNESS STEPS
+        self.assertEqual(len(fast.timings), 4 + NUM_LINES // LINES_PER_STEP)
+
+    def test_speed(self):
+        with Timer("parse with Date()") as slow:
+            self._parse_slow()
+        with Timer("parse with prefilter") as fast:
+            result = self._parse()
+        mb = result.etl.total_bytes / 1000000
+        Log.note(
+            "{{mb|round(places=3)}}MB log: Date() {{slow|round(places=3)}} MB/sec, prefilter {{fast|round(places=3)}} MB/sec",
+            mb=mb,
+            slow=mb / slow.duration.seconds,
+            fast=mb / fast.duration.seconds
+        )
+
+        # COUNT THE TIMESTAMPS THAT STILL GO THROUGH THE SLOW, TRY-EVERY-FORMAT, Date() PARSE
+        parsed = []
+        date = text_log.Date
+        text_log.Date = lambda *a, **k: (len(a) == 1 and not k and isinstance(a[0], text) and parsed.append(a[0])) or date(*a, **k)
+        try:
+            self._parse()
+        finally:
+            text_log.Date = date
+        self.assertEqual(parsed, [])
+
+    def test_stop_after(self):
+        full = self._parse()
+        early = self._parse(stop_after="=== Task Finished ===")
+        self.assertLess(early.etl.total_bytes, full.etl.total_bytes)
+        self.assertEqual(
+            [t.harness.step for t in early.timings if t.harness],
+            [t.harness.step for t in full.timings if t.harness]
+        )
+
+    def _parse(self, stop_after=None):
+        lines = ibytes2ilines(icompressed2ibytes(_blocks(self.log)), encoding=None)
+        task = wrap({"task": {"id": TASK_ID}})
+        return process_tc_live_backing_log("test", lines, "http://localhost/live_backing.log", task, stop_after=stop_after)
+
+    def _parse_slow(self):
+        parse_tc_timestamp, text_log.parse_tc_timestamp = text_log.parse_tc_timestamp, Date
+        try:
+            return self._parse()
+        finally:
+            text_log.parse_tc_timestamp = parse_tc_timestamp
+
+
+def _blocks(compressed, size=64 * 1024):
+    for i in range(0, len(compressed), size):
+        yield compressed[i:i + size]
+
+
+def _make_log():
+    """
+    :return: GZIPPED LOG WITH A HEADER, MOZHARNESS STEPS, AND ARTIFACT UPLOADS
+    """
+    def tc(step, seconds, line):
+        return "[" + step + " " + (START + seconds * SECOND).format("%Y-%m-%dT%H:%M:%S.%fZ") + "] " + line
+
+    lines = [
+        tc("taskcluster", 0, "Task ID: " + TASK_ID),
+        tc("taskcluster", 0, "Worker Node Type: m3.xlarge"),
+        tc("taskcluster", 0, "Worker Type: desktop-test-xlarge"),
+        tc("taskcluster", 1, "=== Task Starting ===")
+    ]
+    for i in range(NUM_LINES):
+        seconds = 2 + i // 10
+        clock = (START + seconds * SECOND).format("%H:%M:%S")
+        if i % LINES_PER_STEP == 0:
+            harness = (START + seconds * SECOND).format("%Y-%m-%d %H:%M:%S.%fZ")
+            line = clock + "     INFO - [mozharness: " + harness + "] Running step-" + str(i) + " step."
+        else:
+            line = clock + "     INFO - TEST-PASS | dom/tests/test_" + str(i) + ".html | assertion passed"
+        lines.append(tc("task", seconds, line))
+    end = 3 + NUM_LINES // 10
+    lines.append(tc("taskcluster", end, "=== Task Finished ==="))
+    for i in range(100):
+        lines.append(tc("taskcluster", end + 1, "Uploading artifact public/logs/" + str(i) + ".log"))
+
+    buffer = BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb") as archive:
+        archive.write("\n".join(lines).encode("utf8"))
+    return buffer.getvalue()
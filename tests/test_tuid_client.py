@@ -0,0 +1,176 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import division
+from __future__ import unicode_literals
+
+import time
+
+from mo_dots import wrap
+from mo_files import TempDirectory
+from mo_json import json2value, value2json
+from mo_logs import Log
+from mo_testing.fuzzytestcase import FuzzyTestCase
+from mo_threads import Thread
+from mo_times.timer import Timer
+from tuid import client
+from tuid.client import TuidClient
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+NUM_FILES = 200
+LINES_PER_FILE = 300
+LATENCY = 0.1  # SECONDS PER TUID SERVICE REQUEST
+REVISION = "0123456789abcdef"
+NO_TUIDS = "no/tuids.js"
+
+
+class TestTuidClient(FuzzyTestCase):
+    """
+    TuidClient AGAINST A LOCAL TUID SERVICE STAND-IN
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalTuidService(("localhost", 0), TuidHandler)
+        cls.thread = Thread.run("local tuid service", cls.server.serve)
+        cls.endpoint = "http://localhost:" + str(cls.server.server_address[1]) + "/tuid"
+        cls.debug, client.DEBUG = client.DEBUG, False
+
+    @classmethod
+    def tearDownClass(cls):
+        client.DEBUG = cls.debug
+        cls.server.shutdown()
+        cls.thread.join()
+
+    def setUp(self):
+        self.temp = TempDirectory()
+        self.server.requests = 0
+
+    def tearDown(self):
+        self.temp.__exit__(None, None, None)
+
+    def test_same_result(self):
+        tuids = self._client("same.sqlite")
+        files = ["/" + _file(i) for i in range(3)] + [NO_TUIDS]
+        fetched = tuids.get_tuids("mozilla-central", REVISION, files)
+        cached = tuids.get_tuids("mozilla-central", REVISION, files)
+        stored = self._client("same.sqlite").get_tuids("mozilla-central", REVISION, files)
+
+        expected = _tuids(_file(1))
+        self.assertEqual(fetched[_file(1)], expected)
+        self.assertEqual(cached[_file(1)], expected)
+        self.assertEqual(stored[_file(1)], expected)
+        # LINES WITHOUT A TUID ARE STILL null
+        self.assertEqual(cached[_file(1)][1], None)
+        self.assertEqual(cached[NO_TUIDS], None)
+        self.assertEqual(self.server.requests, 3)  # NO_TUIDS IS NEVER STORED, SO EACH CALL ASKS FOR IT AGAIN
+
+    def test_repeat_lookups(self):
+        tuids = self._client("repeat.sqlite")
+        files = [_file(i) for i in range(NUM_FILES)]
+        with Timer("first lookup") as first:
+            tuids.get_tuids("mozilla-central", REVISION, files)
+
+        with Timer("from sqlite") as stored:
+            self._client("repeat.sqlite").get_tuids("mozilla-central", REVISION, files)
+
+        db, tuids.db = tuids.db, None  # THE CACHE MUST NOT TOUCH THE DB
+        try:
+            with Timer("from memory") as cached:
+                result = tuids.get_tuids("mozilla-central", REVISION, files)
+        finally:
+            tuids.db = db
+
+        self.assertEqual(result[_file(7)], _tuids(_file(7)))
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(tuids.stats.hits, NUM_FILES)
+        Log.note(
+            "{{num}} files: service {{first|round(places=3)}}sec, sqlite {{stored|round(places=3)}}sec, memory {{cached|round(places=3)}}sec",
+            num=NUM_FILES,
+            first=first.duration.seconds,
+            stored=stored.duration.seconds,
+            cached=cached.duration.seconds
+        )
+
+    def test_coalesce(self):
+        tuids = self._client("coalesce.sqlite")
+        files = [_file(i) for i in range(10)]
+        results = []
+
+        def ask(please_stop):
+            results.append(tuids.get_tuids("mozilla-central", REVISION, files))
+
+        threads = [Thread.run("ask " + str(i), ask) for i in range(4)]
+        for t in threads:
+            t.join()
+
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(len(results), 4)
+        for r in results:
+            self.assertEqual(r[_file(9)], _tuids(_file(9)))
+
+    def test_bounded(self):
+        tuids = self._client("bounded.sqlite", cache_lines=LINES_PER_FILE * 5)
+        tuids.get_tuids("mozilla-central", REVISION, [_file(i) for i in range(8)])
+        self.assertEqual(len(tuids.cache), 5)
+        self.assertEqual(tuids.stats.evicted, 3)
+
+    def _client(self, name, **kwargs):
+        return TuidClient(endpoint=self.endpoint, db=wrap({"filename": (self.temp / name).abspath}), **kwargs)
+
+
+def _file(i):
+    return "dom/base/file_" + str(i) + ".cpp"
+
+
+def _tuids(file):
+    """
+    :return: ONE TUID PER LINE, WITH EVERY THIRD LINE HAVING NONE
+    """
+    base = (sum(ord(c) for c in file) % 1000) * 100000
+    return [None if i % 3 == 1 else base + i + 1 for i in range(LINES_PER_FILE)]
+
+
+class LocalTuidService(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    requests = 0
+
+    def serve(self, please_stop):
+        self.serve_forever(poll_interval=0.1)
+
+
+class TuidHandler(BaseHTTPRequestHandler):
+    """
+    ANSWER TUID REQUESTS, AFTER A DELAY
+    """
+
+    def do_POST(self):
+        self.server.requests += 1
+        request = json2value(self.rfile.read(int(self.headers["Content-Length"])).decode("utf8"))
+        time.sleep(LATENCY)
+        paths = request.where["and"][1]["in"].path
+        data = [
+            {"path": p, "tuids": None if p == NO_TUIDS else _tuids(p)}
+            for p in paths
+        ]
+        content = value2json(wrap({"data": data})).encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass